@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+性能基准测试
+
+用 data/fixtures 中录制的接口数据（以及把它们放大到 1 万首歌的数据），测量
+反序列化、provider 方法、rpc 请求构造和签名的 CPU 开销。所有网络请求都被替换成
+直接返回 fixture 数据，所以结果只反映这个插件自身的开销。
+
+用法（在仓库根目录执行）::
+
+    python benchmarks/bench.py -o before.json
+    python benchmarks/bench.py -o after.json --compare before.json
+    python benchmarks/bench.py -k deserialize
+
+每一项报告：
+- ops: 每秒执行的次数
+- peak_bytes: 执行一次的内存峰值（tracemalloc）
+- alloc_blocks: 执行一次之后新增的、仍然存活的内存块数量（包括返回值）
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import wait
+from contextlib import ExitStack
+from unittest.mock import patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fuo_qqmusic import codec  # noqa: E402
+from fuo_qqmusic.api import API, _get_sign  # noqa: E402
+from fuo_qqmusic.metrics import Metrics  # noqa: E402
+from fuo_qqmusic.provider import (  # noqa: E402
+    provider,
+    _deserialize,
+)
+from fuo_qqmusic.schemas import (  # noqa: E402
+    set_deserialize_mode,
+    QQAlbumSchema,
+    QQSongSchema,
+    SearchArtistSchema,
+    SearchPlaylistSchema,
+)
+from fuo_qqmusic.store import MetadataStore  # noqa: E402
+from feeluown.library import (  # noqa: E402
+    BriefAlbumModel,
+    BriefPlaylistModel,
+    SearchType,
+)
+
+SCALE = 10000
+
+BENCHMARKS = []
+
+
+def bench(name):
+    """注册一个基准测试
+
+    被装饰的函数负责准备数据，返回 (op, patches)。op 是要测量的无参函数，
+    patches 是测量期间需要生效的 mock.patch 列表。
+    """
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+def read_fixture(name):
+    with open(os.path.join(ROOT, 'data/fixtures', name), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def scale_tracks(tracks, count):
+    """复制 tracks 直到有 count 首歌，每首歌的 id 不同"""
+    result = []
+    for i in range(count):
+        track = copy.deepcopy(tracks[i % len(tracks)])
+        track['id'] = 10 ** 8 + i
+        track['mid'] = f'{i:014d}'
+        result.append(track)
+    return result
+
+
+TRACKS = read_fixture('cgi_get_track_info.json')['data']['tracks']
+TRACKS_10K = scale_tracks(TRACKS, SCALE)
+ALBUM = read_fixture('album_3913679.json')
+ALBUM_10K = dict(ALBUM, getSongInfo=scale_tracks(ALBUM['getSongInfo'], SCALE))
+DISS = read_fixture('get_diss_info.json')['req']['data']
+FEED = read_fixture('get_recommend_feed.json')['data']
+SEARCH_ARTISTS = read_fixture('search_artists.json')
+SEARCH_PLAYLISTS = read_fixture('search_playlists.json')
+
+
+def playlist_detail_data(tracks):
+    """把 get_diss_info 的数据转换成 playlist_detail 接口的格式"""
+    dirinfo = DISS['dirinfo']
+    return {
+        'disstid': dirinfo['id'],
+        'dirid': dirinfo['dirid'],
+        'dissname': dirinfo['title'],
+        'logo': dirinfo['picurl'],
+        'total_song_num': len(tracks),
+        'songlist': tracks,
+    }
+
+
+DISS_TRACKS_10K = scale_tracks(DISS['songlist'], SCALE)
+
+
+def fake_playlist_detail(pid, offset=0, limit=50):
+    data = playlist_detail_data(DISS_TRACKS_10K)
+    data['songlist'] = DISS_TRACKS_10K[offset:offset + limit]
+    return data
+
+
+# ---------- 反序列化 ----------
+
+DESERIALIZE_CASES = [
+    ('song', TRACKS, QQSongSchema),
+    ('song_10k', TRACKS_10K, QQSongSchema),
+    ('diss_songs', DISS['songlist'], QQSongSchema),
+    ('album', [ALBUM], QQAlbumSchema),
+    ('album_10k', [ALBUM_10K], QQAlbumSchema),
+    ('search_artists', SEARCH_ARTISTS, SearchArtistSchema),
+    ('search_playlists', SEARCH_PLAYLISTS, SearchPlaylistSchema),
+]
+
+
+def _deserialize_bench(mode, items, schema_cls):
+    def setup():
+        def op():
+            set_deserialize_mode(mode)
+            try:
+                # 返回结果，这样内存峰值中包含了所有 model
+                return [_deserialize(item, schema_cls) for item in items]
+            finally:
+                set_deserialize_mode('fast')
+        return op, []
+    return setup
+
+
+for _mode in ('fast', 'strict'):
+    for _name, _items, _schema_cls in DESERIALIZE_CASES:
+        bench(f'deserialize.{_mode}.{_name}')(
+            _deserialize_bench(_mode, _items, _schema_cls))
+
+
+# ---------- provider ----------
+
+def _empty_store():
+    # 每次都从“接口”获取数据，不受本地存储的影响
+    return [patch.object(provider.store, 'get', return_value=None),
+            patch.object(provider.store, 'put', return_value=None)]
+
+
+@bench('provider.album_get')
+def _():
+    patches = _empty_store() + [
+        patch.object(API, 'album_detail', return_value=ALBUM)]
+    return (lambda: provider.album_get('3913679')), patches
+
+
+@bench('provider.album_get.store_hit')
+def _():
+    tmpdir = tempfile.mkdtemp()
+    store = MetadataStore(os.path.join(tmpdir, 'metadata.sqlite3'))
+    store.put('album', '3913679', ALBUM)
+    patches = [patch.object(provider, 'store', store)]
+    return (lambda: provider.album_get('3913679')), patches
+
+
+@bench('provider.album_songs_rd_10k.first_30')
+def _():
+    album = BriefAlbumModel(source='qqmusic', identifier='1', name='')
+    patches = _empty_store() + [
+        patch.object(API, 'album_detail', return_value=ALBUM_10K)]
+
+    def op():
+        return provider.album_create_songs_rd(album).read_range(0, 30)
+    return op, patches
+
+
+def _playlist_read_bench(read):
+    """每次都从第一页开始读取歌单
+
+    provider 会缓存歌单的页，所以每次读取之前先丢掉它们。读取之后等待后台的
+    预取结束，否则它们会被算到下一次（或者下一项）测量中。
+    """
+    playlist = BriefPlaylistModel(source='qqmusic', identifier='1', name='')
+    patches = _empty_store() + [
+        patch.object(API, 'playlist_detail', side_effect=fake_playlist_detail)]
+
+    def op():
+        provider._discard_playlist_pages(playlist.identifier)
+        try:
+            return read(provider.playlist_create_songs_rd(playlist))
+        finally:
+            pages = provider._get_playlist_pages(playlist.identifier, fetch=False)
+            if pages is not None:
+                wait(list(pages._pages.values()))
+    return op, patches
+
+
+@bench('provider.playlist_songs_rd_10k.first_30')
+def _():
+    return _playlist_read_bench(lambda reader: reader.read_range(0, 30))
+
+
+@bench('provider.playlist_songs_rd_10k.readall')
+def _():
+    return _playlist_read_bench(lambda reader: reader.readall())
+
+
+@bench('provider.rec_list_daily_playlists')
+def _():
+    patches = [patch.object(API, 'get_recommend_feed', return_value=FEED)]
+
+    def op():
+        # 每次都重新解析 feed
+        provider.rec_feed.invalidate()
+        provider.rec_list_daily_playlists()
+    return op, patches
+
+
+@bench('provider.rec_a_collection_of_songs')
+def _():
+    patches = [patch.object(API, 'get_recommend_feed', return_value=FEED),
+               patch.object(API, 'batch_song_details', return_value=TRACKS)]
+
+    def op():
+        provider.rec_feed.invalidate()
+        list(provider.rec_a_collection_of_songs().models)
+    return op, patches
+
+
+# search() 会等待一个很短的时间窗口来合并请求，所以这里测量 search_many
+
+@bench('provider.search.artists')
+def _():
+    patches = [patch.object(API, 'search_multi', return_value={1: SEARCH_ARTISTS})]
+    return (lambda: provider.search_many('x', [SearchType.ar])), patches
+
+
+@bench('provider.search.playlists')
+def _():
+    patches = [patch.object(API, 'search_multi', return_value={3: SEARCH_PLAYLISTS})]
+    return (lambda: provider.search_many('x', [SearchType.pl])), patches
+
+
+@bench('provider.search_many.songs_artists_playlists')
+def _():
+    data = {0: TRACKS[:30], 1: SEARCH_ARTISTS, 3: SEARCH_PLAYLISTS}
+    patches = [patch.object(API, 'search_multi', return_value=data)]
+    types = [SearchType.so, SearchType.ar, SearchType.pl]
+    return (lambda: provider.search_many('x', types)), patches
+
+
+# ---------- rpc 请求构造和签名 ----------
+
+@bench('rpc.search_request')
+def _():
+    api = API()
+
+    def op():
+        payload, _ = api._search_payload('李宗盛', 0, 30, 1)
+        api._rpc_request(payload)
+    return op, []
+
+
+@bench('rpc.batch_song_details_request_1k')
+def _():
+    api = API()
+    song_ids = [track['id'] for track in TRACKS_10K[:1000]]
+
+    def op():
+        api._rpc_request(api._batch_song_details_payload(song_ids))
+    return op, []
+
+
+@bench('rpc.song_urls_request_500')
+def _():
+    api = API()
+    items = [(track['mid'], track['file']['media_mid'], 'M500')
+             for track in TRACKS_10K[:500]]
+
+    def op():
+        payload = api._song_urls_payload(items)
+        payload['comm'] = api.get_common_params()
+        api._rpc_request(payload)
+    return op, []
+
+
+@bench('rpc.get_sign')
+def _():
+    data = json.dumps(read_fixture('cgi_get_track_info.json'))
+    return (lambda: _get_sign(data)), []
+
+
+# ---------- JSON 编解码和日志 ----------
+
+CODEC_CASES = [
+    ('recommend_feed', read_fixture('get_recommend_feed.json')),
+    ('playlist_10k', {'code': 0, 'cdlist': [playlist_detail_data(DISS_TRACKS_10K)]}),
+]
+
+
+def _codec_bench(name, data, action):
+    def setup():
+        dumps, loads = codec.JSON_CODECS[name]
+        content = dumps(data).encode('utf-8')
+        if action == 'loads':
+            return (lambda: loads(content)), []
+        return (lambda: dumps(data)), []
+    return setup
+
+
+for _codec in codec.JSON_CODECS:
+    for _case, _data in CODEC_CASES:
+        for _action in ('loads', 'dumps'):
+            bench(f'codec.{_codec}.{_action}.{_case}')(
+                _codec_bench(_codec, _data, _action))
+
+
+def _log_bench(lazy):
+    # 和线上一样，debug 日志是关闭的
+    logger = logging.getLogger('fuo_qqmusic.bench')
+    logger.setLevel(logging.INFO)
+    js = CODEC_CASES[0][1]
+
+    def setup():
+        if lazy:
+            return (lambda: logger.debug('rpc response json: %s',
+                                         codec.LogRepr(js))), []
+        return (lambda: logger.debug(f'rpc response json: {js}')), []
+    return setup
+
+
+bench('log.eager.recommend_feed')(_log_bench(lazy=False))
+bench('log.lazy.recommend_feed')(_log_bench(lazy=True))
+
+
+# ---------- 监控指标 ----------
+# 每个请求都会调用，和请求本身的耗时（几十毫秒）相比应该可以忽略
+
+@bench('metrics.record_request')
+def _():
+    metrics = Metrics()
+    return (lambda: metrics.record_request('album_detail', 0.08, 500, 30000)), []
+
+
+@bench('metrics.record_rpc')
+def _():
+    metrics = Metrics()
+    payload = API()._batch_song_details_payload([1, 2, 3])
+    js = {'code': 0, 'req_0': {'code': 0, 'data': {}}}
+    return (lambda: metrics.record_rpc('batch_song_details', payload, js)), []
+
+
+# ---------- 运行 ----------
+
+def measure(op, min_time):
+    op()  # warmup
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time or count < 3:
+        op()
+        count += 1
+        elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    result = op()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename')
+                 if stat.count_diff > 0)
+    return {
+        'ops': count / elapsed,
+        'mean_ms': elapsed / count * 1000,
+        'peak_bytes': peak,
+        'alloc_blocks': blocks,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=ROOT, stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-o', '--output', help='把结果保存为 JSON 文件')
+    parser.add_argument('-k', '--keyword', help='只运行名字中包含这个字符串的测试')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='每一项至少运行这么多秒')
+    parser.add_argument('--compare', help='和之前保存的 JSON 结果对比')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    for name, setup in BENCHMARKS:
+        if args.keyword and args.keyword not in name:
+            continue
+        op, patches = setup()
+        with ExitStack() as stack:
+            for p in patches:
+                stack.enter_context(p)
+            result = measure(op, args.min_time)
+        results[name] = result
+        line = (f'{name:<45} {result["ops"]:>12.1f} ops/s '
+                f'{result["peak_bytes"] / 1024:>10.1f} KiB peak '
+                f'{result["alloc_blocks"]:>8} blocks')
+        if name in baseline:
+            line += f'  x{result["ops"] / baseline[name]["ops"]:.2f}'
+        print(line, flush=True)
+
+    if args.output:
+        report = {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+边输入边搜索：统计节省的请求数
+
+在本地模拟服务器上模拟一个用户在搜索框中输入、修改关键词，
+报告输入次数、实际发送的请求数，以及和每次输入都搜索一次相比节省的请求数。
+
+用法（在仓库根目录执行）::
+
+    python benchmarks/live_search.py --gap 0.12 --delay 0.3
+"""
+
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.standin import StandinServer  # noqa: E402
+from fuo_qqmusic.api import API  # noqa: E402
+from fuo_qqmusic.search import LiveSearch, SearchEngine  # noqa: E402
+
+# (要输入的文本, 从哪个文本开始输入)。从长的文本到短的文本表示删除
+SCRIPT = [
+    ('jay chou', ''),
+    ('jay chou qing tian', 'jay chou'),
+    ('jay chou', 'jay chou qing tian'),
+    ('jay', ''),
+    ('jay chou', 'jay'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--gap', type=float, default=0.12, help='两次输入的间隔，单位是秒')
+    parser.add_argument('--pause', type=float, default=0.8,
+                        help='输入完一个关键词之后停顿的时间，单位是秒')
+    parser.add_argument('--delay', type=float, default=0.3)
+    args = parser.parse_args()
+
+    types = ['so', 'ar', 'pl']
+    with StandinServer(latency=(0.05, 0.15), seed=0) as server:
+        engine = SearchEngine(API(base_url=server.base_url))
+        live = LiveSearch(engine, types, lambda *args: None, delay=args.delay)
+        for text, start in SCRIPT:
+            if len(text) >= len(start):
+                steps = range(len(start) + 1, len(text) + 1)
+            else:
+                steps = range(len(start) - 1, len(text) - 1, -1)
+            for i in steps:
+                live.feed((text if len(text) >= len(start) else start)[:i])
+                time.sleep(args.gap)
+            time.sleep(args.pause)
+        live.close()
+    stats = live.stats()
+    for key, value in stats.items():
+        print(f'{key:<12} {value:>6}')
+    print(f'{"saved ratio":<12} {stats["saved"] / stats["inputs"]:>6.0%}')
+    # 以前每次输入、每种类型都是一个请求
+    print(f'{"naive":<12} {stats["inputs"] * len(types):>6}')
+
+
+if __name__ == '__main__':
+    main()
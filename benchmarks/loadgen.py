@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+压力测试
+
+模拟多个用户同时使用插件：打开歌单、专辑，播放歌曲，获取歌词，搜索，
+浏览首页推荐。默认会启动一个本地模拟服务器（见 tests/standin.py），也可以用
+--base-url 指定一个已经在运行的服务器。
+
+用法（在仓库根目录执行）::
+
+    python benchmarks/loadgen.py --users 20 --duration 30 --latency 0.02,0.08
+    python benchmarks/loadgen.py --users 20 --error-rate 0.02 -o load.json
+
+报告每一种操作以及总体的吞吐量、p50/p90/p99 延迟和错误数量。
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.standin import StandinServer, parse_latency  # noqa: E402
+from fuo_qqmusic.api import API  # noqa: E402
+from fuo_qqmusic.feed import RecommendFeedSnapshots  # noqa: E402
+from fuo_qqmusic.provider import QQProvider  # noqa: E402
+from fuo_qqmusic.search import SearchEngine  # noqa: E402
+from fuo_qqmusic.store import MetadataStore  # noqa: E402
+from feeluown.library import BriefPlaylistModel  # noqa: E402
+from feeluown.media import Quality  # noqa: E402
+
+
+def op_playlist(provider, rand):
+    pid = str(rand.randint(1, 500))
+    provider.playlist_get(pid)
+    playlist = BriefPlaylistModel(source='qqmusic', identifier=pid, name='')
+    provider.playlist_create_songs_rd(playlist).read_range(0, 30)
+
+
+def op_album(provider, rand):
+    album = provider.album_get('3913679')
+    provider.album_create_songs_rd(album).read_range(0, 30)
+
+
+def op_play(provider, rand):
+    song = provider.song_get(str(rand.randint(1, 100000)))
+    provider.song_get_media(song, Quality.Audio.sq)
+    provider.song_get_lyric(song)
+
+
+def op_search(provider, rand):
+    # 全局搜索页面：歌曲、歌手、歌单
+    provider.search_many(f'keyword{rand.randint(1, 1000)}', ['so', 'ar', 'pl'])
+
+
+def op_recommend(provider, rand):
+    provider.rec_list_daily_playlists()
+    provider.rec_list_daily_songs()
+
+
+OPERATIONS = [
+    # (名字, 函数, 权重)
+    ('playlist', op_playlist, 3),
+    ('album', op_album, 2),
+    ('play', op_play, 4),
+    ('search', op_search, 2),
+    ('recommend', op_recommend, 1),
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(latencies, count, errors, elapsed):
+    return {
+        'count': count,
+        'errors': errors,
+        'throughput': count / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run(base_url, users, duration, seed=0):
+    provider = QQProvider()
+    provider.api = API(base_url=base_url, pool_size=users)
+    provider.store = MetadataStore(
+        os.path.join(tempfile.mkdtemp(), 'metadata.sqlite3'))
+    # rec_feed 和 searcher 在 __init__ 中绑定了默认的 api
+    provider.rec_feed = RecommendFeedSnapshots(provider.api, ttl=5)
+    provider.searcher = SearchEngine(provider.api)
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    names = [name for name, _, _ in OPERATIONS]
+    funcs = {name: func for name, func, _ in OPERATIONS}
+    weights = [weight for _, _, weight in OPERATIONS]
+
+    def user(index):
+        rand = random.Random(seed + index)
+        while time.monotonic() < deadline:
+            name = rand.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                funcs[name](provider, rand)
+            except Exception:  # noqa
+                with lock:
+                    errors[name] += 1
+                continue
+            cost = time.perf_counter() - start
+            with lock:
+                latencies[name].append(cost)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    report = {}
+    for name in names:
+        report[name] = summarize(latencies[name], len(latencies[name]),
+                                 errors[name], elapsed)
+    all_latencies = [cost for costs in latencies.values() for cost in costs]
+    report['total'] = summarize(all_latencies, len(all_latencies),
+                                sum(errors.values()), elapsed)
+    provider.prefetcher.shutdown()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--base-url', help='不启动模拟服务器，直接使用这个地址')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10, help='单位是秒')
+    parser.add_argument('--latency', type=parse_latency, default=(0.02, 0.08),
+                        help='模拟服务器的延迟，比如 0.05 或者 0.02,0.08')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--code-error-rate', type=float, default=0)
+    parser.add_argument('-o', '--output', help='把结果保存为 JSON 文件')
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server = StandinServer(latency=args.latency, error_rate=args.error_rate,
+                               code_error_rate=args.code_error_rate, seed=0)
+        base_url = server.start().base_url
+    try:
+        report = run(base_url, args.users, args.duration)
+    finally:
+        if server is not None:
+            server.stop()
+
+    print(f'{"":<12} {"count":>8} {"errors":>7} {"ops/s":>9} '
+          f'{"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9}')
+    for name, r in report.items():
+        print(f'{name:<12} {r["count"]:>8} {r["errors"]:>7} {r["throughput"]:>9.1f} '
+              f'{r["p50_ms"]:>9.1f} {r["p90_ms"]:>9.1f} {r["p99_ms"]:>9.1f}')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'users': args.users, 'duration': args.duration,
+                       'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+asyncio 版本的 API
+
+AsyncAPI 和 API 共享同一套请求构造（签名、公共参数）和响应解析（错误检查），
+它只负责用异步的 HTTP 客户端把请求发出去。AsyncAPI 需要一个 API 对象，
+登录状态（cookies）、响应缓存和监控指标也是和这个 API 对象共享的。
+
+请求使用 API 的策略表中的超时时间和重试次数，但是不发送对冲请求（hedge），
+rpc 请求也不会被合并（batch_window）。
+
+注：AsyncAPI 依赖 aiohttp，它是一个可选依赖。
+"""
+
+import asyncio
+import logging
+import time
+
+from . import codec
+from .api import CodeShouldBe0, VKEY_CHUNK_SIZE, VKEY_CHUNKS_PER_RPC
+from .cache import async_cached
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAPI:
+
+    def __init__(self, api, pool_size=100):
+        """
+        :param api: :class:`fuo_qqmusic.api.API` 对象
+        :param pool_size: 每个 host 最多同时打开的连接数
+        """
+        if aiohttp is None:
+            raise RuntimeError('AsyncAPI requires aiohttp, please install it')
+        self._api = api
+        self._pool_size = pool_size
+        # aiohttp.ClientSession 必须在事件循环中创建，所以延迟到第一次请求时
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=0,
+                                             limit_per_host=self._pool_size)
+            timeout = aiohttp.ClientTimeout(total=self._api._timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get_json(self, endpoint, url, params, cookies=None):
+        return await self._request_json(endpoint, 'GET', url, params,
+                                        cookies=cookies)
+
+    async def _request_json(self, endpoint, method, url, params,
+                            body=None, cookies=None):
+        """和 API._request 一样，遇到连接错误或者超时时按照接口的策略重试"""
+        policy = self._api.get_policy(endpoint)
+        max_attempts = policy.max_attempts()
+        for attempt in range(max_attempts):
+            try:
+                return await self._send(endpoint, policy, method, url, params,
+                                        body, cookies)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt + 1 >= max_attempts:
+                    raise
+                self._api._metrics.record_retry(endpoint)
+                delay = policy.backoff_delay(attempt)
+                logger.info(f'request {endpoint} failed: {e!r}, '
+                            f'retry after {delay:.2f}s')
+                await asyncio.sleep(delay)
+
+    async def _send(self, endpoint, policy, method, url, params, body, cookies):
+        session = self._get_session()
+        timeout = aiohttp.ClientTimeout(total=policy.timeout)
+        start = time.monotonic()
+        try:
+            async with session.request(method, url, params=params, data=body,
+                                       headers=self._api._headers,
+                                       cookies=cookies, timeout=timeout) as resp:
+                # 部分 fcg 接口返回的 Content-Type 是 text/html，所以不检查它
+                content = await resp.read()
+                js = codec.loads_content(content, resp.charset)
+                bytes_in = len(content)
+        except Exception:
+            self._api._metrics.record_request(endpoint, time.monotonic() - start,
+                                              error=True)
+            raise
+        self._api._metrics.record_request(
+            endpoint, time.monotonic() - start,
+            bytes_out=len(str(resp.url)) + len(body or b''),
+            bytes_in=bytes_in,
+            error=resp.status >= 400)
+        return js
+
+    async def rpc(self, payload, endpoint='rpc'):
+        if 'comm' not in payload:
+            payload['comm'] = self._api.get_common_params()
+        method, url, params, body = self._api._rpc_request(payload)
+        js = await self._request_json(endpoint, method, url, params, body,
+                                      self._api._cookies)
+        self._api._metrics.record_rpc(endpoint, payload, js)
+        return self._api._parse_rpc(js)
+
+    async def search(self, keyword, type_=0, limit=20, page=1):
+        payload, key_ = self._api._search_payload(keyword, type_, limit, page)
+        js = await self.rpc(payload, endpoint='search')
+        return js['search']['data']['body'][key_]['list']
+
+    @async_cached('song_detail')
+    async def song_detail(self, song_id):
+        payload = self._api._song_detail_payload(song_id)
+        js = await self.rpc(payload, endpoint='song_detail')
+        return self._api._parse_song_detail(js)
+
+    async def batch_song_details(self, song_ids):
+        payload = self._api._batch_song_details_payload(song_ids)
+        js = await self.rpc(payload, endpoint='batch_song_details')
+        return js['req_0']['data']['tracks']
+
+    @async_cached('artist_detail')
+    async def artist_detail(self, artist_mid):
+        payload = self._api._artist_detail_payload(artist_mid)
+        js = await self.rpc(payload, endpoint='artist_detail')
+        return self._api._parse_artist_detail(js)
+
+    @async_cached('artist_songs')
+    async def artist_songs(self, artist_id, page=1, page_size=50):
+        payload = self._api._artist_songs_payload(artist_id, page, page_size)
+        js = await self.rpc(payload, endpoint='artist_songs')
+        return js['req_0']['data']
+
+    @async_cached('album_detail')
+    async def album_detail(self, album_id):
+        url, params = self._api._album_detail_request(album_id)
+        js = await self._get_json('album_detail', url, params)
+        return js['data']
+
+    @async_cached('playlist_detail')
+    async def playlist_detail(self, pid, offset=0, limit=50):
+        url, params = self._api._playlist_detail_request(pid, offset, limit)
+        js = await self._get_json('playlist_detail', url, params,
+                                  self._api._cookies)
+        return self._api._parse_playlist_detail(js)
+
+    async def get_recommend_feed(self, page=1):
+        payload = self._api._recommend_feed_payload(page)
+        js = await self.rpc(payload, endpoint='get_recommend_feed')
+        return js['req_0']['data']
+
+    @async_cached('get_lyric_by_songmid')
+    async def get_lyric_by_songmid(self, songmid):
+        url, params = self._api._lyric_request(songmid)
+        js = await self._get_json('get_lyric_by_songmid', url, params)
+        return self._api._parse_lyric(js)
+
+    async def get_song_url_v2(self, song_mid, media_id, quality):
+        items = [(song_mid, media_id, quality)]
+        payload = self._api._song_urls_payload(items)
+        try:
+            js = await self.rpc(payload, endpoint='get_song_url_v2')
+        except CodeShouldBe0 as e:
+            # 和 API.get_song_url_v2 一样，调用方只处理空字符串
+            logger.info(f'get song:{song_mid} url failed: {e}')
+            return ''
+        urls, _ = self._api._parse_song_urls(js, items)
+        return urls[0]
+
+    async def get_song_urls(self, items):
+        """和 API.get_song_urls 一样分块，每个 rpc 请求最多包含
+        VKEY_CHUNKS_PER_RPC 个子请求，多个 rpc 请求并发发送
+        """
+        urls, _ = await self.get_song_urls_with_expiration(items)
+        return urls
+
+    async def get_song_urls_with_expiration(self, items):
+        step = VKEY_CHUNK_SIZE * VKEY_CHUNKS_PER_RPC
+        results = await asyncio.gather(*[
+            self._get_song_urls(items[i:i + step]) for i in range(0, len(items), step)])
+        urls = []
+        expiration = None
+        for chunk_urls, chunk_expiration in results:
+            urls.extend(chunk_urls)
+            if chunk_expiration is not None:
+                expiration = min(expiration or chunk_expiration, chunk_expiration)
+        return urls, expiration
+
+    async def _get_song_urls(self, items):
+        payload = self._api._song_urls_payload(items)
+        js = await self.rpc(payload, endpoint='get_song_urls')
+        return self._api._parse_song_urls(js, items)
@@ -3,19 +3,39 @@
 
 import base64
 import hashlib
+import http.cookiejar
+import json
 import logging
 import math
-import json
 import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from enum import Enum
 
 import requests
+from requests.adapters import HTTPAdapter
+from .batch import RpcBatch, RpcCoalescer
+from . import codec
+from .cache import ResponseCache, cached, invalidates
+from .capture import CaptureSession, ReplaySession
 from .excs import QQIOError
+from .policy import ENDPOINT_POLICIES, RequestPolicy, LatencyTracker, HedgeStats
+from .metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
 api_base_url = 'http://c.y.qq.com'
+rpc_url = 'https://u.y.qq.com/cgi-bin/musicu.fcg'
+# data 字段超过这个长度时，rpc 请求使用 POST 发送 data，避免 URL 过长
+RPC_GET_MAX_DATA_LENGTH = 1000
+# 一个 CgiGetVkey 子请求最多包含的文件数，以及一个 rpc 请求最多包含的子请求数
+VKEY_CHUNK_SIZE = 50
+VKEY_CHUNKS_PER_RPC = 10
+# 搜索接口每页最多返回的数量
+SEARCH_MAX_PAGE_SIZE = 30
+
 
 class CodeShouldBe200(QQIOError):
     def __init__(self, data):
@@ -61,16 +81,73 @@ class CodeShouldBe0(QQIOError):
             raise cls(data)
 
 
+def _message_sizes(resp):
+    """
+    :return: (发送的字节数, 接收的字节数, 是否失败)。字节数不包括 header
+    """
+    if not isinstance(resp, requests.Response):  # 比如测试中 mock 的 session
+        return 0, 0, False
+    request = resp.request
+    bytes_out = len(request.url) + len(request.body or b'')
+    return bytes_out, len(resp.content), resp.status_code >= 400
+
+
 class API(object):
     """qq music api
 
     Please http capture request from (mobile) qqmusic mobile web page
     """
 
-    def __init__(self, timeout=2):
-        # TODO: 暂时无脑统一一个 timeout
-        # 正确的应该是允许不同接口有不同的超时时间
+    def __init__(self, timeout=2, pool_size=10, batch_window=0, policies=None,
+                 cache_size=32 * 1024 * 1024, base_url=None):
+        """
+        :param timeout: 没有在策略表中的接口的超时时间
+        :param policies: 覆盖默认的接口策略，参考 policy.ENDPOINT_POLICIES
+        :param pool_size: 每个 host 最多保持的 keep-alive 连接数。
+            provider 的方法通常在 run_fn 的线程池中被调用，
+            这个值不应该小于线程池的大小，否则多出来的连接用完就会被关闭。
+        :param batch_window: 单位是秒。大于 0 时，在这个时间窗口内发出的
+            rpc 请求会被合并成一个 musicu.fcg 请求。
+        :param cache_size: 只读接口响应缓存的最大字节数，0 表示不缓存。
+        :param base_url: 所有接口（包括 musicu.fcg）都使用这个地址，
+            比如 http://127.0.0.1:8000 。用于把请求发给一个本地的模拟服务器。
+        """
+        if base_url:
+            base_url = base_url.rstrip('/')
+            self._base_url = base_url
+            self._rpc_url = base_url + '/cgi-bin/musicu.fcg'
+        else:
+            self._base_url = api_base_url
+            self._rpc_url = rpc_url
         self._timeout = timeout
+        # 不同接口有不同的超时时间和重试策略
+        self._default_policy = RequestPolicy(timeout=timeout, retries=1)
+        self._policies = dict(ENDPOINT_POLICIES)
+        self._policies.update(policies or {})
+        self._latency = LatencyTracker()
+        self._hedge_stats = HedgeStats()
+        self._metrics = Metrics()
+        # 对冲请求和原请求都在这个线程池中发送
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix='qqmusic-hedge')
+        self._hedge_lock = threading.Lock()
+        self._hedge_running = 0  # 已经提交到线程池、还没有结束的请求数
+        self._pool_size = pool_size
+        self._cache = ResponseCache(cache_size) if cache_size > 0 else None
+        # 所有接口共用一个 session，这样同一个 host 的 TCP/TLS 连接可以被复用。
+        # requests.Session 底层的 urllib3 连接池是线程安全的。
+        self._session = requests.Session()
+        # cookies 只由 set_cookies 设置，每次请求显式传入。不保存响应中的 Set-Cookie，
+        # 否则切换用户或者退出登录之后，它们依然会被发送
+        self._session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        # 录制或者回放时，_session 会被替换，参考 start_capture
+        self._http_session = self._session
+        self._local = threading.local()
+        self._coalescer = RpcCoalescer(self, batch_window) if batch_window > 0 else None
         self._headers = {
             'Accept': '*/*',
             'Accept-Encoding': 'gzip,deflate,sdch',
@@ -88,6 +165,7 @@ class API(object):
 
         :type cookies: dict
         """
+        self._session.cookies.clear()
         if cookies:
             self._cookies = cookies
             self._uin = self.get_uin_from_cookies(cookies)
@@ -97,6 +175,156 @@ class API(object):
             self._uin = '0'
             self._guid = str(int(random.random() * 1000000000))  # 暂时不知道 guid 有什么用
 
+    def connection_stats(self):
+        """统计连接池中新建的连接数和被复用的次数
+
+        只统计当前还存活在连接池中的 host。
+        """
+        opened = requests_count = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:  # evicted by other threads
+                continue
+            opened += pool.num_connections
+            requests_count += pool.num_requests
+        return {
+            'opened': opened,
+            'reused': max(requests_count - opened, 0),
+            'requests': requests_count,
+        }
+
+    def hedge_stats(self):
+        return self._hedge_stats.snapshot()
+
+    def cache_stats(self):
+        return self._cache.stats() if self._cache is not None else {}
+
+    def metrics_snapshot(self):
+        """每个接口的耗时、流量、错误、重试和缓存命中情况，参考 metrics.Metrics"""
+        return self._metrics.snapshot()
+
+    def metrics_prometheus(self):
+        return self._metrics.to_prometheus()
+
+    def start_capture(self, path):
+        """把之后的请求和响应（去掉了 cookies 等用户信息）追加到文件 path 中"""
+        self._restore_session()
+        self._session = CaptureSession(self._http_session, path)
+
+    def stop_capture(self):
+        self._restore_session()
+
+    def start_replay(self, path, speed=1):
+        """之后的请求都从录制的文件中返回，不会发送到服务器
+
+        :param speed: 1 表示按照录制时的耗时返回，0 表示不等待
+        """
+        self._restore_session()
+        self._session = ReplaySession(path, speed=speed)
+
+    def stop_replay(self):
+        self._restore_session()
+
+    def _restore_session(self):
+        if self._session is not self._http_session:
+            self._session.close()
+            self._session = self._http_session
+
+    def close(self):
+        self._restore_session()
+        self._session.close()
+        self._hedge_executor.shutdown(wait=False)
+
+    def get_policy(self, endpoint):
+        return self._policies.get(endpoint, self._default_policy)
+
+    def _request(self, endpoint, method, url, **kwargs):
+        """所有 HTTP 请求的入口，按照接口的策略处理超时、重试和对冲请求
+
+        :param endpoint: 接口名，一般是 API 的方法名
+        """
+        policy = self.get_policy(endpoint)
+        kwargs.setdefault('timeout', policy.timeout)
+        max_attempts = policy.max_attempts()
+        for attempt in range(max_attempts):
+            try:
+                if policy.hedge:
+                    resp = self._hedged_send(endpoint, policy, method, url, kwargs)
+                else:
+                    resp = self._send(endpoint, method, url, kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt + 1 >= max_attempts:
+                    raise
+                self._metrics.record_retry(endpoint)
+                delay = policy.backoff_delay(attempt)
+                logger.info(f'request {endpoint} failed: {e}, '
+                            f'retry after {delay:.2f}s')
+                time.sleep(delay)
+            else:
+                # 给 cache.cached 估算缓存的大小
+                local = self._local
+                local.response_bytes = getattr(local, 'response_bytes', 0) \
+                    + _message_sizes(resp)[1]
+                return resp
+
+    def _send(self, endpoint, method, url, kwargs):
+        start = time.monotonic()
+        try:
+            resp = self._session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._metrics.record_request(endpoint, time.monotonic() - start,
+                                         error=True)
+            raise
+        seconds = time.monotonic() - start
+        self._latency.record(endpoint, seconds)
+        self._metrics.record_request(endpoint, seconds, *_message_sizes(resp))
+        return resp
+
+    def _hedged_send(self, endpoint, policy, method, url, kwargs):
+        delay = self._latency.percentile(endpoint, 0.95)
+        if delay is None:  # 样本不够时，用一个保守的值
+            delay = policy.timeout / 2
+        started = threading.Event()
+        first = self._submit_hedge(started, endpoint, method, url, kwargs)
+        # 在线程池中排队的时间不算在对冲的延迟里
+        started.wait()
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        with self._hedge_lock:
+            saturated = self._hedge_running >= self._pool_size
+        if saturated:
+            # 线程池已经满了，对冲请求只会继续排队，让过载更严重
+            return first.result()
+
+        self._hedge_stats.incr(endpoint, 'fired')
+        second = self._submit_hedge(None, endpoint, method, url, kwargs)
+        pending = [first, second]
+        while True:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                # 其中一个失败时，等待另外一个
+                if future.exception() is None or not pending:
+                    if future is second and future.exception() is None:
+                        self._hedge_stats.incr(endpoint, 'won')
+                    return future.result()
+
+    def _submit_hedge(self, started, endpoint, method, url, kwargs):
+        def send():
+            if started is not None:
+                started.set()
+            try:
+                return self._send(endpoint, method, url, kwargs)
+            finally:
+                with self._hedge_lock:
+                    self._hedge_running -= 1
+
+        with self._hedge_lock:
+            self._hedge_running += 1
+        return self._hedge_executor.submit(send)
+
     def get_uin_from_cookies(self, cookies):
         if 'wxuin' in cookies:
             # a sample wxuin: o1152921504803324670
@@ -130,6 +358,34 @@ class API(object):
             .format(type_, mid)
 
     def search(self, keyword, type_=0, limit=20, page=1):
+        payload, key_ = self._search_payload(keyword, type_, limit, page)
+        js = self.rpc(payload, endpoint='search')
+        result = js['search']['data']['body'][key_]['list']
+        return result
+
+    def search_multi(self, keyword, types, limit=20, page=1):
+        """在一个请求中搜索多种类型
+
+        :param types: search 的 type_ 列表
+        :return: {type_: list}。失败的类型不在结果中
+        """
+        payload, keys = {}, {}
+        for type_ in types:
+            sub_payload, key_ = self._search_payload(keyword, type_, limit, page)
+            payload[f'search_{type_}'] = sub_payload['search']
+            keys[type_] = key_
+        js = self.rpc(payload, endpoint='search')
+        result = {}
+        for type_, key_ in keys.items():
+            sub = js.get(f'search_{type_}') or {}
+            if sub.get('code') != 0:
+                logger.warning(f'search {keyword} type:{type_} failed, '
+                               f'code:{sub.get("code")}')
+                continue
+            result[type_] = sub['data']['body'][key_]['list']
+        return result
+
+    def _search_payload(self, keyword, type_, limit, page):
         # Other supported types: songlist, user, mv, qc, gedantip, zhida.
         if type_ == 0:
             key_ = 'song'
@@ -142,28 +398,31 @@ class API(object):
         elif type_ == 4:
             key_ = 'mv'  # video
         else:
-            raise QQIOError('invalid search type_:%d', type_)
+            raise QQIOError(f'invalid search type_:{type_}')
         payload = {
             "search": {
                 "method": "DoSearchForQQMusicDesktop",
                 "module": "music.search.SearchCgiService",
                 "param": {
                     # People said that the max num_per_page is 30.
-                    "num_per_page": max(limit, 30),
+                    "num_per_page": min(limit, SEARCH_MAX_PAGE_SIZE),
                     "page_num": page,
                     "search_type": type_,
                     "query": keyword,
                 }
             }
         }
-        js = self.rpc(payload)
-        result = js['search']['data']['body'][key_]['list']
-        return result
+        return payload, key_
 
     def search_playlists(self, query, limit=20, page=1):
         raise QQIOError('search api is not available')
 
+    @cached('song_detail')
     def song_detail(self, song_id):
+        js = self.rpc(self._song_detail_payload(song_id), endpoint='song_detail')
+        return self._parse_song_detail(js)
+
+    def _song_detail_payload(self, song_id):
         uin = self._uin
         song_id = int(song_id)
         # 往 payload 添加字段，有可能还可以获取相似歌曲、歌单等
@@ -184,7 +443,9 @@ class API(object):
                 'param': {'song_id': song_id}
             }
         }
-        js = self.rpc(payload)
+        return payload
+
+    def _parse_song_detail(self, js):
         data_song = js['detail']['data']['track_info']
         if data_song['id'] <= 0:
             return None
@@ -194,6 +455,11 @@ class API(object):
         """
         song_ids should be a list of int
         """
+        payload = self._batch_song_details_payload(song_ids)
+        js = self.rpc(payload, endpoint='batch_song_details')
+        return js['req_0']['data']['tracks']
+
+    def _batch_song_details_payload(self, song_ids):
         payload = {
             'comm': self.get_wkv17_common_params(),
             'req_0': {
@@ -206,8 +472,7 @@ class API(object):
                 }
             }
         }
-        js = self.rpc(payload)
-        return js['req_0']['data']['tracks']
+        return payload
 
     def song_similar(self, song_id):
         payload = {
@@ -219,11 +484,16 @@ class API(object):
                 }
             }
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='song_similar')
         data_songs = js['simsongs']['data']['songInfoList']
         return data_songs
 
+    @cached('artist_detail')
     def artist_detail(self, artist_mid):
+        js = self.rpc(self._artist_detail_payload(artist_mid), endpoint='artist_detail')
+        return self._parse_artist_detail(js)
+
+    def _artist_detail_payload(self, artist_mid):
         payload = {
             'req_0': {
                 'module': 'music.musichallSinger.SingerInfoInter',
@@ -241,7 +511,9 @@ class API(object):
                 'format': 'json',
             }
         }
-        js = self.rpc(payload)
+        return payload
+
+    def _parse_artist_detail(self, js):
         data = js['req_0']['data']['singer_list'][0]
         data = {
             'singer_id': data['basic_info']['singer_id'],
@@ -251,7 +523,13 @@ class API(object):
         }
         return data
 
+    @cached('artist_songs')
     def artist_songs(self, artist_id, page=1, page_size=50):
+        payload = self._artist_songs_payload(artist_id, page, page_size)
+        js = self.rpc(payload, endpoint='artist_songs')
+        return js['req_0']['data']
+
+    def _artist_songs_payload(self, artist_id, page, page_size):
         payload = {
             'req_0': {
                 'module': 'music.musichallSong.SongListInter',
@@ -270,31 +548,36 @@ class API(object):
                 'format': 'json',
             }
         }
-        js = self.rpc(payload)
-        return js['req_0']['data']
+        return payload
 
     def artist_albums(self, artist_id, page=1, page_size=20):
-        url = api_base_url + '/v8/fcg-bin/fcg_v8_singer_album.fcg'
+        url = self._base_url + '/v8/fcg-bin/fcg_v8_singer_album.fcg'
         params = {
             'singerid': artist_id,
             'order': 'time',
             'begin': (page - 1) * page_size,  # TODO: 这里应该代表偏移量
             'num': page_size
         }
-        response = requests.get(url, params=params)
-        js = response.json()
+        response = self._request('artist_albums', 'GET', url, params=params)
+        js = codec.loads_response(response)
         return js['data']
 
+    @cached('album_detail')
     def album_detail(self, album_id):
-        url = api_base_url + '/v8/fcg-bin/fcg_v8_album_detail_cp.fcg'
+        url, params = self._album_detail_request(album_id)
+        resp = self._request('album_detail', 'GET', url, params=params)
+        return codec.loads_response(resp)['data']
+
+    def _album_detail_request(self, album_id):
+        url = self._base_url + '/v8/fcg-bin/fcg_v8_album_detail_cp.fcg'
         params = {
             'albumid': album_id,
             'format': 'json',
             'newsong': 1
         }
-        resp = requests.get(url, params=params)
-        return resp.json()['data']
+        return url, params
 
+    @invalidates('playlist_remove_songs')
     def playlist_remove_songs(self, playlist_id, song_id_list):
         payload = {
             'req_0': {
@@ -306,9 +589,10 @@ class API(object):
                 }
             }
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='playlist_remove_songs')
         return js['req_0']['code'] == 0
 
+    @invalidates('playlist_add_songs')
     def playlist_add_songs(self, playlist_id, song_id_list):
         payload = {
             'req_0': {
@@ -320,11 +604,18 @@ class API(object):
                 }
             }
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='playlist_add_songs')
         return js['req_0']['code'] == 0
 
+    @cached('playlist_detail')
     def playlist_detail(self, pid, offset=0, limit=50):
-        url = api_base_url + '/qzone/fcg-bin/fcg_ucc_getcdinfo_byids_cp.fcg'
+        url, params = self._playlist_detail_request(pid, offset, limit)
+        resp = self._request('playlist_detail', 'GET', url, params=params,
+                             headers=self._headers, cookies=self._cookies)
+        return self._parse_playlist_detail(codec.loads_response(resp))
+
+    def _playlist_detail_request(self, pid, offset, limit):
+        url = self._base_url + '/qzone/fcg-bin/fcg_ucc_getcdinfo_byids_cp.fcg'
         params = {
             'type': '1',
             'utf8': '1',
@@ -334,28 +625,27 @@ class API(object):
             'song_begin': offset,
             'song_num': limit,
         }
-        resp = requests.get(url, params=params, headers=self._headers,
-                            cookies=self._cookies, timeout=self._timeout)
-        js = resp.json()
-        if js['code'] != 0:
-            raise CodeShouldBe0(js)
+        return url, params
+
+    def _parse_playlist_detail(self, js):
+        CodeShouldBe0.check(js)
         return js['cdlist'][0]
 
     def user_detail(self, uid):
         """
         this API can be called only when user has logged in
         """
-        url = api_base_url + '/rsc/fcgi-bin/fcg_get_profile_homepage.fcg'
+        url = self._base_url + '/rsc/fcgi-bin/fcg_get_profile_homepage.fcg'
         params = {
             # 这两个字段意义不明，不过至少固定为此值时可正常使用
             'cid': 205360838,
             'reqfrom': 1,
             'userid': uid
         }
-        resp = requests.get(url, params=params, headers=self._headers,
-                            cookies=self._cookies, timeout=self._timeout)
-        js = resp.json()
-        logger.debug(f"user detail response: {js}")
+        resp = self._request('user_detail', 'GET', url, params=params,
+                             headers=self._headers, cookies=self._cookies)
+        js = codec.loads_response(resp)
+        logger.debug('user detail response: %s', codec.LogRepr(js))
         if js['code'] != 0:
             raise CodeShouldBe0(js)
         return js['data']
@@ -383,11 +673,11 @@ class API(object):
                 'needNewCode': 1,
             }
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='user_favorite_artists')
         return js['req_1']['data']['List']
 
     def user_favorite_albums(self, uid, start=0, end=100):
-        url = api_base_url + '/fav/fcgi-bin/fcg_get_profile_order_asset.fcg'
+        url = self._base_url + '/fav/fcgi-bin/fcg_get_profile_order_asset.fcg'
         params = {
             'ct': 20,  # 不知道此字段什么含义
             'reqtype': 2,
@@ -397,15 +687,15 @@ class API(object):
             'reqfrom': 1,
             'userid': uid
         }
-        resp = requests.get(url, params=params, headers=self._headers,
-                            cookies=self._cookies, timeout=self._timeout)
-        js = resp.json()
+        resp = self._request('user_favorite_albums', 'GET', url, params=params,
+                             headers=self._headers, cookies=self._cookies)
+        js = codec.loads_response(resp)
         if js['code'] != 0:
             raise CodeShouldBe0(js)
         return js['data']['albumlist']
 
     def user_favorite_playlists(self, uid, mid, start=0, end=100):
-        url = api_base_url + '/fav/fcgi-bin/fcg_get_profile_order_asset.fcg'
+        url = self._base_url + '/fav/fcgi-bin/fcg_get_profile_order_asset.fcg'
 
         params = {
             'loginUin': uid,
@@ -417,9 +707,9 @@ class API(object):
             'ct': 20,  # 没有该字段 返回中文字符是乱码
         }
 
-        resp = requests.get(url, params=params, headers=self._headers,
-                            cookies=self._cookies, timeout=self._timeout)
-        js = resp.json()
+        resp = self._request('user_favorite_playlists', 'GET', url, params=params,
+                             headers=self._headers, cookies=self._cookies)
+        js = codec.loads_response(resp)
         if js['code'] != 0:
             raise CodeShouldBe0(js)
         return js['data']['cdlist']
@@ -435,11 +725,15 @@ class API(object):
                 }
             },
         }
-        js = self.rpc(data)
+        js = self.rpc(data, endpoint='recommend_playlists')
         playlist = js['recomPlaylist']
         return playlist['data']['v_hot']
 
     def get_recommend_feed(self, page=1):
+        js = self.rpc(self._recommend_feed_payload(page), endpoint='get_recommend_feed')
+        return js['req_0']['data']
+
+    def _recommend_feed_payload(self, page):
         # APIs are found in https://y.qq.com/wk_v17/#/recommend
         data = {
             'req_0': {
@@ -455,45 +749,95 @@ class API(object):
             },
             'comm': self.get_wkv17_common_params(),
         }
-        js = self.rpc(data)
-        return js['req_0']['data']
+        return data
 
     def get_comment(self, comment_id):
-        url = api_base_url + f'/base/fcgi-bin/fcg_global_comment_h5.fcg?biztype=1&cmd=8&topid={comment_id}&pagenum=0&pagesize=25'
-        res_data = requests.get(url, headers=self._headers)
+        url = self._base_url + f'/base/fcgi-bin/fcg_global_comment_h5.fcg?biztype=1&cmd=8&topid={comment_id}&pagenum=0&pagesize=25'
+        res_data = self._request('get_comment', 'GET', url, headers=self._headers)
         if res_data.status_code == 200:
-            return res_data.json()
+            return codec.loads_response(res_data)
         raise CodeShouldBe200(res_data)
 
+    @cached('get_lyric_by_songmid')
     def get_lyric_by_songmid(self, songmid):
-        url = api_base_url + '/lyric/fcgi-bin/fcg_query_lyric_new.fcg'
+        url, params = self._lyric_request(songmid)
+        response = self._request('get_lyric_by_songmid', 'GET', url,
+                                 params=params, headers=self._headers)
+        return self._parse_lyric(codec.loads_response(response))
+
+    def _lyric_request(self, songmid):
+        url = self._base_url + '/lyric/fcgi-bin/fcg_query_lyric_new.fcg'
         params = {
             'songmid': songmid,
             'pcachetime': int(round(time.time() * 1000)),
             'format': 'json',
         }
-        response = requests.get(url, params=params, headers=self._headers,
-                                timeout=self._timeout)
-        js = response.json()
+        return url, params
+
+    def _parse_lyric(self, js):
         CodeShouldBe0.check(js)
         lyric = js['lyric'] or ''
         return base64.b64decode(lyric).decode()
 
-    def rpc(self, payload):
+    @contextmanager
+    def batch(self):
+        """把 with 语句块中的 rpc 请求合并成一个请求发送
+
+        >>> with api.batch() as batch:  # doctest: +SKIP
+        ...     song = batch.submit(api.song_detail, 123)
+        ...     feed = batch.submit(api.get_recommend_feed)
+        >>> song.result(), feed.result()  # doctest: +SKIP
+        """
+        batch = RpcBatch(self)
+        try:
+            yield batch
+        except:  # noqa
+            batch.cancel()
+            raise
+        batch.send()
+
+    def rpc(self, payload, endpoint='rpc'):
+        """
+        :param endpoint: 发起请求的接口名，用来选择请求策略
+        """
         if 'comm' not in payload:
             payload['comm'] = self.get_common_params()
-        logger.debug(f"rpc payload: {payload}")
-        data_str = json.dumps(payload, ensure_ascii=False)
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            return batch.wait_rpc(payload, endpoint)
+        if self._coalescer is not None:
+            return self._coalescer.rpc(payload, endpoint)
+        return self._send_rpc(payload, endpoint)
+
+    def _send_rpc(self, payload, endpoint='rpc'):
+        method, url, params, body = self._rpc_request(payload)
+        resp = self._request(endpoint, method, url, params=params, data=body,
+                             headers=self._headers, cookies=self._cookies)
+        js = codec.loads_response(resp)
+        self._metrics.record_rpc(endpoint, payload, js)
+        return self._parse_rpc(js)
+
+    def _rpc_request(self, payload):
+        """
+        :return: (method, url, params, body)
+        """
+        logger.debug('rpc payload: %s', codec.LogRepr(payload))
+        data_str = codec.dumps(payload)
         params = {
             '_': int(round(time.time() * 1000)),
             'sign': _get_sign(data_str),
-            'data': data_str,
         }
-        url = 'https://u.y.qq.com/cgi-bin/musicu.fcg'
-        resp = requests.get(url, params=params, headers=self._headers,
-                            cookies=self._cookies, timeout=self._timeout)
-        js = resp.json()
-        logger.debug(f"rpc response json: {js}")
+        url = self._rpc_url
+        # 小的请求依然用 GET，和网页版的行为保持一致。大的请求（比如
+        # 几百首歌的 batch_song_details，或者合并后的请求）放在 body 里，
+        # 这样不会受 URL 长度限制，也省去了 urlencode 的开销。
+        if len(data_str) <= RPC_GET_MAX_DATA_LENGTH:
+            params['data'] = data_str
+            return 'GET', url, params, None
+        return 'POST', url, params, data_str.encode('utf-8')
+
+    def _parse_rpc(self, js):
+        logger.debug('rpc response json: %s', codec.LogRepr(js))
         CodeShouldBe0.check(js)
         return js
 
@@ -536,7 +880,7 @@ class API(object):
                 }
             }
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='get_mv')
         return js['getMvUrl']['data'][vid]
 
     def get_radio_music(self, num=10):
@@ -551,7 +895,7 @@ class API(object):
                 },
             },
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='get_radio_music')
         return js['songlist']['data']['tracks']
 
     def get_diss_info(self, dissid, offset=0, limit=50):
@@ -578,7 +922,7 @@ class API(object):
                 }
             }
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='get_diss_info')
         return js['req']['data']
 
     def get_song_url(self, song_mid):
@@ -632,11 +976,14 @@ class API(object):
         }
         # 这里没有把 data=data_str 放在 params 中，因为 QQ 服务端不识别这种写法
         # 另外测试发现：python(flask) 是可以识别这两种写法的
-        url = 'http://u.y.qq.com/cgi-bin/musicu.fcg?data=' + data_str
+        url = self._rpc_url + '?data=' + data_str
         # 如果是绿钻会员，这里带上 cookies，就能请求到收费歌曲的 url
-        resp = requests.get(url, params=params,
-                            headers=self._headers, cookies=self._cookies)
-        js = resp.json()
+        resp = self._request('get_song_url', 'GET', url, params=params,
+                             headers=self._headers, cookies=self._cookies)
+        js = codec.loads_response(resp)
+        if js.get('code', 0) != 0:
+            logger.info(f'get song:{song_mid} url failed: {CodeShouldBe0(js)}')
+            return {}
         midurlinfo = js['req_0'].get('data', {}).get('midurlinfo')
         if midurlinfo:
             purl = midurlinfo[0]['purl']
@@ -676,8 +1023,8 @@ class API(object):
                 # 通过抓客户端接口可以发现，这个 uin 和用户 uin 不是一个东西
                 # 这个 uin 似乎只有三位数
                 url = f'{prefix}{q_filename}?{params_str}'
-                print(url)
-                _resp = requests.head(url, headers=self._headers, cookies=self._cookies)
+                _resp = self._request('get_song_url', 'HEAD', url,
+                                      headers=self._headers, cookies=self._cookies)
                 if _resp.status_code == 200:
                     valid_urls[quality] = url
                     logger.info(f'song:{song_mid} quality:{q} url is valid')
@@ -696,6 +1043,53 @@ class API(object):
         return {}
 
     def get_song_url_v2(self, song_mid, media_id, quality):
+        # TODO: 似乎存在一种有效时间更长的cookies, https://github.com/PeterDing/chord
+        try:
+            urls, _ = self._get_song_urls([(song_mid, media_id, quality)],
+                                          'get_song_url_v2')
+        except CodeShouldBe0 as e:
+            # 以前这个接口不检查顶层的 code，调用方只处理空字符串
+            logger.info(f'get song:{song_mid} url failed: {e}')
+            return ''
+        return urls[0]
+
+    def get_song_urls(self, items):
+        """批量获取歌曲的播放链接
+
+        CgiGetVkey 接口的 filename/songmid 参数本身就是列表，所以多首歌曲、
+        多个音质可以在一个请求中获取。items 较多时会被分成多个子请求，
+        但它们依然在同一个 HTTP 请求中发送。
+
+        :param items: list of (song_mid, media_id, quality)，
+            quality 是 F000/M800 这样的文件前缀
+        :return: 和 items 一一对应的 url 列表，没有权限的为空字符串
+        """
+        urls, _ = self.get_song_urls_with_expiration(items)
+        return urls
+
+    def get_song_urls_with_expiration(self, items):
+        """
+        :return: (urls, expiration)，expiration 是服务端返回的链接有效时间，
+            单位是秒，服务端没有返回时为 None
+        """
+        urls = []
+        expiration = None
+        step = VKEY_CHUNK_SIZE * VKEY_CHUNKS_PER_RPC
+        for i in range(0, len(items), step):
+            chunk_urls, chunk_expiration = self._get_song_urls(items[i:i + step],
+                                                               'get_song_urls')
+            urls.extend(chunk_urls)
+            if chunk_expiration is not None:
+                expiration = min(expiration or chunk_expiration, chunk_expiration)
+        return urls, expiration
+
+    def _get_song_urls(self, items, endpoint):
+        payload = self._song_urls_payload(items)
+        js = self.rpc(payload, endpoint=endpoint)
+        return self._parse_song_urls(js, items)
+
+    @staticmethod
+    def _song_filename(media_id, quality):
         switcher = {
             'F000': 'flac',
             'A000': 'ape',
@@ -703,55 +1097,68 @@ class API(object):
             'C600': 'm4a',
             'M500': 'mp3'
         }
+        return '{}{}.{}'.format(quality, media_id, switcher.get(quality))
 
+    def _song_urls_payload(self, items):
         uin = self._uin
         guid = self._guid
-        filename = '{}{}.{}'.format(quality, media_id, switcher.get(quality))
         data = {
-            "req_0": {
+            "comm": {
+                "uin": str(uin),
+                "format": "json",
+                "ct": 19,
+                "cv": 0
+            }
+        }
+        for i in range(0, len(items), VKEY_CHUNK_SIZE):
+            chunk = items[i:i + VKEY_CHUNK_SIZE]
+            filenames = [self._song_filename(media_id, quality)
+                         for _, media_id, quality in chunk]
+            data[f'req_{i // VKEY_CHUNK_SIZE}'] = {
                 "module": "vkey.GetVkeyServer",
                 "method": "CgiGetVkey",
                 "param": {
-                    "filename": [filename],
+                    "filename": filenames,
                     "guid": guid,
-                    "songmid": [song_mid],
-                    "songtype": [0],
+                    "songmid": [song_mid for song_mid, _, _ in chunk],
+                    "songtype": [0] * len(chunk),
                     "uin": str(uin),  # NOTE: must be a string
                     "loginflag": 1,
                     "platform": "20"
                 }
-            },
-            "comm": {
-                "uin": str(uin),
-                "format": "json",
-                "ct": 19,
-                "cv": 0
             }
-        }
-        data_str = json.dumps(data, ensure_ascii=False)
+        return data
 
-        sign = _get_sign(data_str)
-        params = {
-            'sign': sign,
-            'g_tk': 5381,
-            'loginUin': '',
-            'hostUin': 0,
-            'format': 'json',
-            'inCharset': 'utf8',
-            'outCharset': 'utf-8¬ice=0',
-            'platform': 'yqq.json',
-            'needNewCode': 0,
-            'data': data_str
-        }
-        url = 'https://u.y.qq.com/cgi-bin/musicu.fcg'
-        # TODO: 似乎存在一种有效时间更长的cookies, https://github.com/PeterDing/chord
-        resp = requests.get(url, params=params,
-                            headers=self._headers, cookies=self._cookies)
-        js = resp.json()
-        midurlinfo = js['req_0'].get('data', {}).get('midurlinfo')
-        if midurlinfo and midurlinfo[0]['purl']:
-            return 'http://isure.stream.qqmusic.qq.com/{}'.format(midurlinfo[0]['purl'])
-        return ''
+    def _parse_song_urls(self, js, items):
+        """
+        :param items: 请求的 (song_mid, media_id, quality) 列表
+        :return: (urls, expiration)
+        """
+        urls = []
+        expiration = None
+        for i in range(0, len(items), VKEY_CHUNK_SIZE):
+            chunk = items[i:i + VKEY_CHUNK_SIZE]
+            req = js.get(f'req_{i // VKEY_CHUNK_SIZE}') or {}
+            data = req.get('data') or {}
+            # 链接的有效时间，单位是秒，比如 80400
+            if data.get('expiration'):
+                expiration = min(expiration or data['expiration'], data['expiration'])
+            # 不依赖 midurlinfo 的顺序，服务端可能会调整顺序或者少返回一些
+            purls = {}
+            for info in data.get('midurlinfo') or []:
+                key = info.get('filename') or info.get('songmid')
+                purls[key] = info.get('purl') or ''
+            for song_mid, media_id, quality in chunk:
+                filename = self._song_filename(media_id, quality)
+                purl = purls.get(filename, '')
+                if not purl and filename not in purls:
+                    # 服务端没有返回 filename 时，用 songmid 匹配
+                    purl = purls.get(song_mid, '')
+                if purl:
+                    urls.append('http://isure.stream.qqmusic.qq.com/{}'.format(purl))
+                else:
+                    urls.append('')
+        return urls, expiration
 
     class DislikeListType(Enum):
         singer = 2
@@ -773,7 +1180,7 @@ class API(object):
                 },
             },
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='get_dislike_list')
         if type_ == API.DislikeListType.song:
             return js["req_0"]["data"]["Songs"]
         elif type_ == API.DislikeListType.singer:
@@ -802,7 +1209,7 @@ class API(object):
                  "param": req_param,
              },
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='add_to_dislike_list')
         # Response example, {'code': 0, 'data': {'Retcode': 0, 'Msg': '', 'Token': ''}}
         CodeShouldBe0.check(js['req_0'])
         return js['req_0']['data']
@@ -828,7 +1235,7 @@ class API(object):
                 "param": req_param,
             },
         }
-        js = self.rpc(payload)
+        js = self.rpc(payload, endpoint='remove_from_dislike_list')
         CodeShouldBe0.check(js)
         CodeShouldBe0.check(js['req_0'])
         return js['req_0']['data']
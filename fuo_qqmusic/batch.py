@@ -0,0 +1,188 @@
+"""
+把多个 musicu.fcg 子请求合并成一个 HTTP 请求
+
+musicu.fcg 的 payload 本身就是一个 dict，每个 key 对应一个子请求，
+服务端会把每个子请求的结果放在同名 key 下返回。所以只要保证 key 不重复，
+不同接口的子请求就可以放在一个 payload 里一起发送。
+
+需要注意的是，一个 payload 只能有一个 comm 字段，所以只有 comm 相同的
+子请求才能被合并在一起。合并后的请求超时时会被重试，所以非幂等的写接口
+不参与合并，它们总是单独发送。
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class RpcBatch:
+    """收集 rpc 请求，在 :meth:`send` 时一次性发送
+
+    有两种使用方式::
+
+        with api.batch() as batch:
+            f1 = batch.rpc(payload1)  # 直接提交 payload
+            f2 = batch.submit(api.song_detail, 123)  # 提交一个 API 方法
+        f1.result(), f2.result()
+
+    :meth:`submit` 会在一个新的线程中运行 API 方法，这个方法中的 rpc 调用
+    会被挂起，直到整个 batch 被发送。
+    """
+
+    def __init__(self, api):
+        self._api = api
+        self._cond = threading.Condition()
+        self._pending = []  # list of (payload, endpoint, future)
+        # 已经 submit 但还没有走到 rpc（或者结束）的调用的个数
+        self._running = 0
+        self._closed = False
+
+    def rpc(self, payload, endpoint='rpc'):
+        """添加一个 rpc 请求
+
+        :return: concurrent.futures.Future，结果和 API.rpc 的返回值一致
+        """
+        if 'comm' not in payload:
+            payload['comm'] = self._api.get_common_params()
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('batch has been sent')
+            self._pending.append((payload, endpoint, future))
+        return future
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('batch has been sent')
+            self._running += 1
+        thread = threading.Thread(target=self._run,
+                                  args=(future, func, args, kwargs),
+                                  daemon=True)
+        thread.start()
+        return future
+
+    def _run(self, future, func, args, kwargs):
+        local = self._api._local
+        local.batch = self
+        local.batch_waiting = False
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:  # noqa
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            local.batch = None
+            if not local.batch_waiting:
+                self._mark_not_running()
+
+    def _mark_not_running(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def wait_rpc(self, payload, endpoint='rpc'):
+        """在 submit 的线程中被 API.rpc 调用，阻塞直到 batch 被发送"""
+        with self._cond:
+            if self._closed:
+                # 同一个方法里的第二个 rpc 请求，batch 已经发送过了
+                future = None
+            else:
+                future = Future()
+                self._pending.append((payload, endpoint, future))
+                self._api._local.batch_waiting = True
+                self._running -= 1
+                self._cond.notify_all()
+        if future is None:
+            return self._api._send_rpc(payload, endpoint)
+        return future.result()
+
+    def send(self):
+        with self._cond:
+            # 等待所有 submit 的调用都走到 rpc 这一步
+            self._cond.wait_for(lambda: self._running <= 0)
+            self._closed = True
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        groups = {}
+        for i, (payload, endpoint, future) in enumerate(pending):
+            if self._api.get_policy(endpoint).idempotent:
+                group_key = json.dumps(payload.get('comm'), sort_keys=True)
+            else:
+                group_key = i  # 写接口单独发送，使用它自己的（不重试的）策略
+            groups.setdefault(group_key, []).append((payload, endpoint, future))
+        for calls in groups.values():
+            self._send_group(calls)
+
+    def cancel(self):
+        with self._cond:
+            self._closed = True
+            pending, self._pending = self._pending, []
+        for _, _, future in pending:
+            future.cancel()
+
+    def _send_group(self, calls):
+        merged = {'comm': calls[0][0].get('comm')}
+        keys_mapping = []  # [(future, {origin_key: merged_key})]
+        endpoints = set()
+        for i, (payload, endpoint, future) in enumerate(calls):
+            endpoints.add(endpoint)
+            mapping = {}
+            for key, value in payload.items():
+                if key == 'comm':
+                    continue
+                merged_key = key if len(calls) == 1 else f'{key}_b{i}'
+                merged[merged_key] = value
+                mapping[key] = merged_key
+            keys_mapping.append((future, mapping))
+        logger.debug(f'send {len(calls)} rpc requests in one batch')
+        try:
+            # 不同接口合并在一起时，使用 rpc 的通用策略。写接口不会被合并，
+            # 所以这里都是幂等的读接口
+            endpoint = endpoints.pop() if len(endpoints) == 1 else 'rpc'
+            js = self._api._send_rpc(merged, endpoint)
+        except Exception as e:  # noqa
+            for future, _ in keys_mapping:
+                future.set_exception(e)
+            return
+        common = {k: v for k, v in js.items() if k not in merged}
+        for future, mapping in keys_mapping:
+            result = dict(common)
+            for key, merged_key in mapping.items():
+                if merged_key in js:
+                    result[key] = js[merged_key]
+            future.set_result(result)
+
+
+class RpcCoalescer:
+    """把一个时间窗口内（来自不同线程）的 rpc 请求合并成一个请求
+
+    第一个到达的请求负责等待窗口结束并发送整个 batch，其它请求等待结果。
+    """
+
+    def __init__(self, api, window):
+        self._api = api
+        self._window = window
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def rpc(self, payload, endpoint='rpc'):
+        with self._lock:
+            is_leader = self._batch is None
+            if is_leader:
+                self._batch = RpcBatch(self._api)
+            batch = self._batch
+            future = batch.rpc(payload, endpoint)
+        if is_leader:
+            time.sleep(self._window)
+            with self._lock:
+                self._batch = None
+            batch.send()
+        return future.result()
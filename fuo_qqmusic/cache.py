@@ -0,0 +1,203 @@
+"""
+API 层的响应缓存
+
+只缓存只读接口的结果。缓存的 key 是 (接口名, 参数, uin)，不同用户的结果互不影响。
+缓存按照 LRU 淘汰，总大小（按响应的字节数估算）不超过 max_bytes。
+
+注意：为了避免拷贝，命中缓存时调用方拿到的是同一个对象。被 :func:`cached`
+装饰的 API 方法返回的数据是只读的，调用方不能修改它，需要修改时先拷贝一份。
+"""
+
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+from . import codec
+
+# 单位是秒。只有在这个表中的接口才会被缓存。
+ENDPOINT_TTLS = {
+    'song_detail': 3600,
+    'album_detail': 3600,
+    'artist_detail': 3600,
+    'artist_songs': 600,
+    'playlist_detail': 300,
+    'get_lyric_by_songmid': 24 * 3600,
+}
+
+
+def _same_playlist(value, playlist_id, *args, **kwargs):
+    # 写接口的参数是 dirid，而 playlist_detail 的 key 是 disstid
+    return str(value.get('dirid')) == str(playlist_id)
+
+
+# 写接口 -> [(需要被清掉的读接口, match)]。
+# match(缓存的值, 写接口的参数) 为 True 的缓存才会被清掉
+ENDPOINT_INVALIDATIONS = {
+    'playlist_add_songs': [('playlist_detail', _same_playlist)],
+    'playlist_remove_songs': [('playlist_detail', _same_playlist)],
+}
+
+
+class ResponseCache:
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        # key -> (value, size, expired_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """
+        :return: (value, exists)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, size, expired_at = entry
+                if expired_at >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value, True
+                self._pop(key)
+            self.misses += 1
+            return None, False
+
+    def set(self, key, value, ttl, size):
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, endpoint, match=None):
+        """
+        :param match: match(value)，为 None 时清掉这个接口的所有缓存
+        """
+        with self._lock:
+            for key in [key for key, (value, _, _) in self._entries.items()
+                        if key[0] == endpoint and (match is None or match(value))]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _pop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def _estimate_size(value):
+    return len(codec.dumps(value))
+
+
+def _cache_key(endpoint, signature, api, args, kwargs):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    # 参数统一转换成字符串，这样 album_detail(1) 和 album_detail('1')
+    # 会命中同一个缓存
+    params = tuple((name, str(value))
+                   for name, value in bound.arguments.items()
+                   if name != 'self')
+    return (endpoint, params, api._uin)
+
+
+def cached(endpoint):
+    """缓存 API 方法的返回值，返回值为 None 时不缓存
+
+    返回值是和缓存共享的，调用方不能修改它。
+    """
+    ttl = ENDPOINT_TTLS[endpoint]
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            cache = self._cache
+            if cache is None:
+                return func(self, *args, **kwargs)
+            key = _cache_key(endpoint, signature, self, (self,) + args, kwargs)
+            value, exists = cache.get(key)
+            self._metrics.record_cache(endpoint, exists)
+            if exists:
+                return value
+            local = self._local
+            local.response_bytes = 0
+            value = func(self, *args, **kwargs)
+            if value is not None:
+                # 用响应的字节数估算大小，这样不需要再把结果编码一遍。
+                # 响应在其它线程中收到时（比如被合并的 rpc 请求），才编码一遍
+                size = local.response_bytes or _estimate_size(value)
+                cache.set(key, value, ttl, size)
+            return value
+        return wrapper
+    return decorator
+
+
+def async_cached(endpoint):
+    """AsyncAPI 方法的 :func:`cached`
+
+    和对应的 API 方法共用 API 对象的缓存，参数名相同时 key 也相同。
+    """
+    ttl = ENDPOINT_TTLS[endpoint]
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            api = self._api
+            cache = api._cache
+            if cache is None:
+                return await func(self, *args, **kwargs)
+            key = _cache_key(endpoint, signature, api, (self,) + args, kwargs)
+            value, exists = cache.get(key)
+            api._metrics.record_cache(endpoint, exists)
+            if exists:
+                return value
+            value = await func(self, *args, **kwargs)
+            if value is not None:
+                cache.set(key, value, ttl, _estimate_size(value))
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidates(endpoint):
+    """写接口调用之后，清除被它影响的读接口的缓存"""
+    affected = ENDPOINT_INVALIDATIONS[endpoint]
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                if self._cache is not None:
+                    for each, match in affected:
+                        self._cache.invalidate(
+                            each, lambda value: match(value, *args, **kwargs))
+        return wrapper
+    return decorator
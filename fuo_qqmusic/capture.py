@@ -0,0 +1,227 @@
+"""
+录制和回放接口请求
+
+录制时，每个请求和响应被追加到一个 JSON Lines 文件中，一行一个请求。
+cookies、header 以及 uin/g_tk/vkey 等和用户身份相关的字段会被替换掉，
+所以录下来的文件可以分享给别人，用来复现一个慢的会话，或者转换成 fixture::
+
+    api.start_capture('session.jsonl')
+    ...
+    api.stop_capture()
+
+    api.start_replay('session.jsonl', speed=0)  # 0 表示不等待，尽快返回
+
+CaptureSession 和 ReplaySession 替换的是 API 的 requests.Session，所以超时、重试、
+缓存和监控指标都和正常请求一样。AsyncAPI 的请求不会被录制。
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+
+FORMAT_VERSION = 1
+REDACTED = '***'
+# 这些字段的值会被替换掉（字符串换成 REDACTED，数字换成 0），
+# 不论它们出现在请求参数、rpc payload 还是响应中
+REDACTED_KEYS = frozenset([
+    'uin', 'loginUin', 'hostUin', 'g_tk', 'guid', 'uid', 'sign',
+    'qqmusic_key', 'skey', 'p_skey', 'lskey', 'p_lskey', 'wxuin',
+    'encrypt_uin', 'euin', 'vkey', 'userid', 'HostUin',
+])
+# 和请求内容无关的参数（时间戳、随机数和签名等），匹配回放记录时忽略
+VOLATILE_PARAMS = frozenset(['_', '-', 'pcachetime', 'sign', 'data', 'format', 'g_tk'])
+_VKEY_RE = re.compile(r'(vkey=)[^&]+')
+
+
+def _redact_value(value):
+    # 保持类型不变，这样回放时 schema 依然可以正常解析
+    if not value or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return 0
+    return REDACTED
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: _redact_value(v) if k in REDACTED_KEYS else redact(v)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(each) for each in value]
+    if isinstance(value, str) and 'vkey=' in value:
+        # 播放链接中带有用户的 vkey
+        return _VKEY_RE.sub(r'\1' + REDACTED, value)
+    return value
+
+
+def _loads(text):
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def redact_request(method, url, kwargs):
+    """
+    :return: 去掉 cookies/header 之后的请求，rpc 的 payload 被解析成了 dict
+    """
+    params = dict(kwargs.get('params') or {})
+    body = kwargs.get('data')
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    # rpc 的 payload 小的时候放在 data 参数中，大的时候放在 body 中
+    payload = _loads(params.pop('data', None) or body)
+    if payload is not None:
+        body = None
+    return {
+        'method': method,
+        'url': url,
+        'params': {k: _redact_value(v) if k in REDACTED_KEYS else v
+                   for k, v in params.items()},
+        'payload': redact(payload),
+        'body': body if isinstance(body, str) else None,
+    }
+
+
+def request_key(request):
+    """同一个请求（除了时间戳、签名和用户信息之外都相同）有相同的 key"""
+    payload = request['payload']
+    if isinstance(payload, dict):
+        payload = {k: v for k, v in payload.items() if k != 'comm'}
+    params = {k: v for k, v in request['params'].items()
+              if k not in VOLATILE_PARAMS}
+    path = urlsplit(request['url']).path
+    return json.dumps([request['method'], path, params, payload, request['body']],
+                      sort_keys=True, ensure_ascii=False)
+
+
+class CaptureSession:
+    """把请求转发给 session，同时把请求和响应写到文件中"""
+
+    def __init__(self, session, path):
+        self._session = session
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._write({'version': FORMAT_VERSION, 'started_at': time.time()})
+
+    def request(self, method, url, **kwargs):
+        start = time.monotonic()
+        resp = self._session.request(method, url, **kwargs)
+        elapsed = time.monotonic() - start
+        js = _loads(resp.content)
+        self._write({
+            't': round(start - self._started_at, 4),
+            'elapsed': round(elapsed, 4),
+            'request': redact_request(method, url, kwargs),
+            'status': resp.status_code,
+            'json': redact(js),
+            'text': resp.text if js is None else None,
+        })
+        return resp
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayMissError(requests.RequestException):
+    """录制的文件中没有这个请求"""
+
+
+class ReplaySession:
+    """
+    用录制的响应代替真正的请求
+
+    同一个请求被录制了多次时，按照录制的顺序返回，用完之后一直返回最后一次的。
+
+    :param speed: 1 表示按照录制时的耗时返回，2 表示快一倍，0 表示不等待
+    """
+
+    def __init__(self, path, speed=1):
+        self._speed = speed
+        self._records = defaultdict(list)
+        self._served = defaultdict(int)
+        self._lock = threading.Lock()
+        for record in read_capture(path):
+            self._records[request_key(record['request'])].append(record)
+
+    def request(self, method, url, **kwargs):
+        key = request_key(redact_request(method, url, kwargs))
+        with self._lock:
+            records = self._records.get(key)
+            if not records:
+                raise ReplayMissError(f'request is not captured: {method} {url}')
+            index = min(self._served[key], len(records) - 1)
+            self._served[key] += 1
+        record = records[index]
+        if self._speed:
+            time.sleep(record['elapsed'] / self._speed)
+        return self._build_response(method, url, kwargs, record)
+
+    def _build_response(self, method, url, kwargs, record):
+        resp = requests.Response()
+        resp.status_code = record['status']
+        if record['json'] is not None:
+            resp._content = json.dumps(record['json'], ensure_ascii=False).encode()
+        else:
+            resp._content = (record['text'] or '').encode()
+        resp.encoding = 'utf-8'
+        resp.request = requests.Request(method, url, params=kwargs.get('params'),
+                                        data=kwargs.get('data')).prepare()
+        resp.url = resp.request.url
+        return resp
+
+    def close(self):
+        pass
+
+
+def read_capture(path):
+    """
+    :return: 录制的请求，不包括文件头
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'version' in record:  # 文件头，每次开始录制时写入一个
+                continue
+            yield record
+
+
+def export_fixtures(path, directory):
+    """把录制的 JSON 响应保存为 fixture，一个响应一个文件
+
+    :return: 保存的文件列表
+    """
+    os.makedirs(directory, exist_ok=True)
+    counts = defaultdict(int)
+    files = []
+    for record in read_capture(path):
+        if record['json'] is None:
+            continue
+        request = record['request']
+        payload = request['payload']
+        if isinstance(payload, dict):
+            # rpc 请求用子请求的 method 命名，比如 CgiGetTrackInfo
+            name = '_'.join(sorted({v.get('method', k) for k, v in payload.items()
+                                    if k != 'comm' and isinstance(v, dict)}))
+        else:
+            name = os.path.splitext(os.path.basename(urlsplit(request['url']).path))[0]
+        counts[name] += 1
+        filename = os.path.join(directory, f'captured_{name}_{counts[name]}.json')
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(record['json'], f, ensure_ascii=False, indent=2)
+        files.append(filename)
+    return files
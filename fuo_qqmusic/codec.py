@@ -0,0 +1,114 @@
+"""
+JSON 编解码，以及在日志中打印大对象
+
+安装了 orjson 时默认使用它（pip install fuo_qqmusic[fast]），否则使用标准库。
+歌单、推荐 feed 等接口的响应有几 MB，orjson 解析它们比标准库快好几倍。
+两种实现的编码结果完全相同（紧凑格式，不转义非 ASCII 字符），
+所以 rpc 请求的签名不受影响。
+"""
+
+import codecs
+import json
+import reprlib
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
+# name -> (dumps, loads)。dumps 返回 str，loads 接受 str 或者 bytes
+JSON_CODECS = {'json': (_json_dumps, json.loads)}
+if orjson is not None:
+    JSON_CODECS['orjson'] = (_orjson_dumps, orjson.loads)
+
+_codec_name = 'orjson' if orjson is not None else 'json'
+_dumps, _loads = JSON_CODECS[_codec_name]
+
+
+def set_json_codec(name):
+    global _codec_name, _dumps, _loads
+    if name not in JSON_CODECS:
+        raise ValueError(f'invalid json codec: {name}')
+    _codec_name = name
+    _dumps, _loads = JSON_CODECS[name]
+
+
+def get_json_codec():
+    return _codec_name
+
+
+def dumps(obj):
+    return _dumps(obj)
+
+
+def loads(data):
+    """直接从响应的 bytes 解码，不需要先转换成 str"""
+    return _loads(data)
+
+
+def _is_utf8(charset):
+    try:
+        return codecs.lookup(charset).name == 'utf-8'
+    except LookupError:  # 不认识的编码按照 UTF-8 处理
+        return True
+
+
+def loads_content(content, charset=None):
+    """解码响应的 bytes
+
+    :param charset: 响应头中声明的编码。UTF-8 以外的编码（比如 GBK）
+        需要先转换成 str
+    """
+    if charset and not _is_utf8(charset):
+        return _loads(content.decode(charset, errors='replace'))
+    try:
+        return _loads(content)
+    except ValueError:
+        # 带有 BOM 或者是 UTF-16 等编码时，由标准库检测编码
+        return json.loads(content)
+
+
+def loads_response(resp):
+    """解码 requests 的响应
+
+    requests 在响应头没有声明编码时也会猜一个（比如 text/html 是 ISO-8859-1），
+    所以只有响应头中真的声明了 charset 时才使用 resp.encoding
+    """
+    charset = None
+    if 'charset=' in resp.headers.get('Content-Type', '').lower():
+        charset = resp.encoding
+    return loads_content(resp.content, charset)
+
+
+_repr = reprlib.Repr()
+_repr.maxlevel = 4
+_repr.maxdict = 20
+_repr.maxlist = 10
+_repr.maxstring = 200
+_repr.maxother = 200
+
+
+class LogRepr:
+    """在日志中打印接口的 payload 或者响应
+
+    只有日志真的被输出时才会格式化，并且只格式化对象的一部分，
+    这样关闭 debug 日志时，几 MB 的响应不会被白白格式化一遍::
+
+        logger.debug('rpc response json: %s', LogRepr(js))
+    """
+    __slots__ = ('_obj',)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __str__(self):
+        return _repr.repr(self._obj)
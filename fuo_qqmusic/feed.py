@@ -0,0 +1,120 @@
+"""
+首页推荐 feed
+
+每日推荐、推荐歌单和推荐歌曲都来自同一个 get_recommend_feed 接口。
+这里为每个用户保存一份 feed 快照，解析一次并建立索引，供它们共享使用。
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class Shelf:
+    """feed 中的一个 shelf，它的 card 被展开成一个列表"""
+
+    def __init__(self, data):
+        self.data = data
+        self.module_id = data['extra_info'].get('moduleID', '')
+        self.jumptype = int(data['miscellany'].get('jumptype', 0))
+        self.title = data.get('title_content') or data.get('title_template', '')
+        self.cards = [card for batch in data['v_niche'] for card in batch['v_card']]
+
+    def cards_by_jumptype(self, jumptype):
+        return [card for card in self.cards if card['jumptype'] == jumptype]
+
+
+class RecommendFeed:
+
+    def __init__(self, data):
+        self.shelves = [Shelf(shelf) for shelf in data['v_shelf']]
+        self._shelves_by_jumptype = defaultdict(list)
+        # card 的 moduleID -> [(shelf, card)]
+        self._cards_by_module = defaultdict(list)
+        for shelf in self.shelves:
+            self._shelves_by_jumptype[shelf.jumptype].append(shelf)
+            for card in shelf.cards:
+                module_id = card['extra_info'].get('moduleID')
+                if module_id:
+                    self._cards_by_module[module_id].append((shelf, card))
+
+    def shelf_by_jumptype(self, jumptype):
+        shelves = self._shelves_by_jumptype.get(jumptype)
+        return shelves[0] if shelves else None
+
+    def shelf_by_module_prefix(self, prefix):
+        for shelf in self.shelves:
+            if shelf.module_id.startswith(prefix):
+                return shelf
+        return None
+
+    def cards_by_module_prefix(self, prefix):
+        """
+        :return: list of (shelf, card)
+        """
+        result = []
+        for module_id, cards in self._cards_by_module.items():
+            if module_id.startswith(prefix):
+                result.extend(cards)
+        return result
+
+
+class RecommendFeedSnapshots:
+    """
+    :param ttl: 快照的有效时间。过期之后，先返回旧的快照，同时在后台刷新
+    """
+
+    def __init__(self, api, ttl=600):
+        self._api = api
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # 同时只有一个线程请求 feed，其它线程等待它的结果
+        self._fetch_lock = threading.Lock()
+        # uin -> (feed, fetched_at)
+        self._snapshots = {}
+        self._refreshing = set()
+
+    def get(self):
+        uin = self._api._uin
+        with self._lock:
+            snapshot = self._snapshots.get(uin)
+            if snapshot is not None:
+                feed, fetched_at = snapshot
+                if time.monotonic() - fetched_at > self._ttl \
+                        and uin not in self._refreshing:
+                    self._refreshing.add(uin)
+                    threading.Thread(target=self._refresh, args=(uin,),
+                                     name='qqmusic-feed-refresher',
+                                     daemon=True).start()
+                return feed
+        with self._fetch_lock:
+            with self._lock:
+                snapshot = self._snapshots.get(uin)
+            if snapshot is not None:
+                return snapshot[0]
+            return self._fetch(uin)
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshots.pop(self._api._uin, None)
+
+    def _refresh(self, uin):
+        try:
+            with self._fetch_lock:
+                self._fetch(uin)
+        except Exception:  # noqa
+            logger.exception('refresh recommend feed failed')
+        finally:
+            with self._lock:
+                self._refreshing.discard(uin)
+
+    def _fetch(self, uin):
+        feed = RecommendFeed(self._api.get_recommend_feed())
+        with self._lock:
+            # 请求期间用户可能已经切换了
+            if uin == self._api._uin:
+                self._snapshots[uin] = (feed, time.monotonic())
+        return feed
@@ -0,0 +1,59 @@
+"""
+model 的 identity map
+
+同一个歌手、专辑或者歌曲，不论被反序列化多少次，都只有一个 model 对象。
+比如一个歌单中有 1000 首同一个歌手的歌，它们共享同一个 BriefArtistModel；
+分别获取到的同一首歌，也共享 mid/quality_suffix 等缓存。
+
+map 中保存的是弱引用，没有被使用的 model 会被正常回收。
+只有歌曲以及歌曲中的歌手、专辑会被合并，歌手详情、歌单、用户等 model 每次都是新的对象。
+"""
+
+import threading
+import weakref
+
+from feeluown.library import BriefAlbumModel, BriefArtistModel, SongModel
+
+INTERNED_MODELS = (SongModel, BriefArtistModel, BriefAlbumModel)
+# 用新数据更新已有的 model 时，这些值被认为是“没有数据”，不会覆盖已有的值。
+# 比如搜索结果中的歌曲没有文件信息，不应该覆盖歌曲详情中的信息。
+_EMPTY_VALUES = (None, '', [], {})
+
+
+class IdentityMap:
+
+    def __init__(self):
+        # (model class, identifier) -> model
+        self._models = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, model_cls, data):
+        """
+        :param data: 构造 model 的参数，必须包含 identifier
+        :return: 已有的 model（用 data 更新之后）或者新创建的 model
+        """
+        if model_cls not in INTERNED_MODELS:
+            return model_cls(**data)
+        key = (model_cls, str(data['identifier']))
+        # model 会在多个线程中被反序列化，更新也在锁中进行
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = model_cls(**data)
+                return model
+            for field, value in data.items():
+                if field in ('identifier', 'source') or value in _EMPTY_VALUES:
+                    continue
+                if getattr(model, field) != value:
+                    setattr(model, field, value)
+        return model
+
+    def __len__(self):
+        return len(self._models)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+identity_map = IdentityMap()
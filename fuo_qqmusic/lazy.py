@@ -0,0 +1,62 @@
+"""
+延迟创建 model 的序列
+
+歌单、专辑中的歌曲可能有上千首，而界面一开始只显示前面几十首。
+这里只保存接口返回的原始数据，在访问某一项时才把它反序列化为 model。
+"""
+
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+
+from .schemas import deserialize
+
+
+class LazyModelList(Sequence):
+    """
+    :param items: 接口返回的原始数据列表，也可以包含已经创建好的 model
+    :param schema_cls: 用来反序列化每一项的 schema
+    :param memo_size: 最近访问过的 model 会被保存下来，重复访问时返回同一个对象
+    """
+
+    def __init__(self, items, schema_cls, memo_size=128):
+        self._items = items
+        self._schema_cls = schema_cls
+        self._memo_size = memo_size
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._load(i) for i in range(*index.indices(len(self._items)))]
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError('index out of range')
+        return self._load(index)
+
+    @property
+    def items(self):
+        return self._items
+
+    def _load(self, index):
+        item = self._items[index]
+        if not isinstance(item, dict):
+            return item
+        with self._lock:
+            model = self._memo.get(index)
+            if model is not None:
+                self._memo.move_to_end(index)
+                return model
+        model = deserialize(item, self._schema_cls)
+        with self._lock:
+            self._memo[index] = model
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+        return model
+
+    def __repr__(self):
+        return f'<LazyModelList {self._schema_cls.__name__} len={len(self)}>'
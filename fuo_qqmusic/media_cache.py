@@ -0,0 +1,145 @@
+"""
+歌曲播放链接的缓存
+
+播放链接中带有 vkey，一段时间之后会过期。服务端在返回链接的同时会告诉我们
+有效时间（CgiGetVkey 的 expiration 字段），所以缓存的过期时间以它为准。
+
+缓存是 provider 级别的，key 是 (mid, quality)，同一首歌的不同 SongModel 对象
+共享缓存。对于播放列表中的歌曲，可以在链接过期之前在后台刷新它们。
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# 服务端没有返回有效时间时使用的值，单位是秒
+DEFAULT_EXPIRATION = 3600
+
+
+class MediaUrlCache:
+    """
+    :param refresh_func: func(songs)，刷新这些歌曲的播放链接
+    :param margin: 剩余有效时间小于这个值的链接被认为已经失效，
+        避免把一个马上就会失效的链接交给播放器
+    :param refresh_ahead: 被关注的歌曲，在链接失效前这么多秒在后台刷新
+    :param clock: 返回当前时间（单位是秒）的函数，测试时可以替换
+    """
+
+    min_refresh_interval = 30
+
+    def __init__(self, refresh_func=None, margin=120, refresh_ahead=600,
+                 capacity=10000, clock=time.time):
+        self._refresh_func = refresh_func
+        self._clock = clock
+        self._margin = margin
+        self._refresh_ahead = refresh_ahead
+        self._capacity = capacity
+        # (mid, quality) -> (media or None, expired_at)，None 表示没有这个音质的权限
+        self._entries = OrderedDict()
+        # mid -> 最近一次获取的链接的失效时间
+        self._mid_expired_at = {}
+        # mid -> 这首歌在 _entries 中的音质数
+        self._mid_counts = {}
+        self._lock = threading.Lock()
+        # mid -> song，需要在后台保持链接有效的歌曲，比如播放列表中的歌曲
+        self._watched = {}
+        self._wakeup = threading.Event()
+        self._refresher = None
+
+    def get_mapping(self, mid, qualities, margin=True):
+        """
+        :param margin: 为 False 时，只要链接还没有失效就返回
+        :return: {quality: media}，只包含可以播放的音质。
+            任何一个音质没有缓存或者即将失效时，返回 None
+        """
+        deadline = self._clock() + (self._margin if margin else 0)
+        mapping = {}
+        with self._lock:
+            for quality in qualities:
+                entry = self._entries.get((mid, quality))
+                if entry is None or entry[1] < deadline:
+                    return None
+                self._entries.move_to_end((mid, quality))
+                if entry[0] is not None:
+                    mapping[quality] = entry[0]
+        return mapping
+
+    def set_mapping(self, mid, mapping, expiration=None):
+        """
+        :param mapping: {quality: media or None}
+        :param expiration: 有效时间，单位是秒
+        """
+        expired_at = self._clock() + (expiration or DEFAULT_EXPIRATION)
+        with self._lock:
+            for quality, media in mapping.items():
+                if (mid, quality) not in self._entries:
+                    self._mid_counts[mid] = self._mid_counts.get(mid, 0) + 1
+                self._entries[(mid, quality)] = (media, expired_at)
+                self._entries.move_to_end((mid, quality))
+            self._mid_expired_at[mid] = expired_at
+            while len(self._entries) > self._capacity:
+                (mid_, _), _ = self._entries.popitem(last=False)
+                self._mid_counts[mid_] -= 1
+                # 这首歌的其它音质还在缓存中时，依然需要检查它们是否即将失效
+                if self._mid_counts[mid_] == 0:
+                    del self._mid_counts[mid_]
+                    self._mid_expired_at.pop(mid_, None)
+
+    def invalidate(self, mid):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == mid]:
+                self._entries.pop(key)
+            self._mid_counts.pop(mid, None)
+            self._mid_expired_at.pop(mid, None)
+
+    def watch(self, songs):
+        """设置需要在后台保持链接有效的歌曲，会替换之前的设置
+
+        :param songs: list of (mid, song)
+        """
+        with self._lock:
+            self._watched = dict(songs)
+        if self._watched and self._refresher is None and self._refresh_func:
+            self._refresher = threading.Thread(target=self._refresh_loop,
+                                               name='qqmusic-media-refresher',
+                                               daemon=True)
+            self._refresher.start()
+        self._wakeup.set()
+
+    def _expiring_songs(self):
+        """
+        :return: (需要刷新的歌曲, 距离下一次需要刷新的秒数)
+        """
+        now = self._clock()
+        songs = []
+        next_refresh = self._refresh_ahead
+        with self._lock:
+            for mid, song in self._watched.items():
+                expired_at = self._mid_expired_at.get(mid)
+                # 还没有获取过链接的歌曲，等它第一次被获取之后再刷新
+                if expired_at is None:
+                    continue
+                remain = expired_at - now
+                if remain <= self._refresh_ahead:
+                    songs.append(song)
+                else:
+                    next_refresh = min(next_refresh, remain - self._refresh_ahead)
+        return songs, next_refresh
+
+    def _refresh_loop(self):
+        # 最长 refresh_ahead 秒检查一次，所以新加入的链接不需要唤醒这个线程
+        while True:
+            songs, next_refresh = self._expiring_songs()
+            if songs:
+                logger.info(f'refresh media urls for {len(songs)} songs')
+                try:
+                    self._refresh_func(songs)
+                except Exception:  # noqa
+                    logger.exception('refresh media urls failed')
+                # 服务端给的有效时间比 refresh_ahead 还短时，避免不停地刷新
+                next_refresh = max(next_refresh, self.min_refresh_interval)
+            self._wakeup.wait(timeout=max(next_refresh, 1))
+            self._wakeup.clear()
@@ -0,0 +1,178 @@
+"""
+接口的监控指标
+
+按接口（API 的方法名，和请求策略使用同一个名字）统计：请求耗时的直方图、
+发送和接收的字节数、请求失败和重试的次数、响应缓存的命中率；
+按 musicu.fcg 的子请求（module.method）统计 code != 0 的比例。
+
+可以用 snapshot() 在进程内读取，也可以用 to_prometheus() 导出为
+Prometheus 的文本格式。每次记录只是在锁内更新几个计数器，耗时在微秒级。
+"""
+
+import threading
+from bisect import bisect_left
+
+# 直方图的上界，单位是秒
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _EndpointStats:
+    __slots__ = ('buckets', 'latency_sum', 'requests', 'errors', 'retries',
+                 'code_errors', 'bytes_out', 'bytes_in', 'cache_hits',
+                 'cache_misses')
+
+    def __init__(self):
+        # 最后一个是 +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.requests = self.errors = self.retries = self.code_errors = 0
+        self.bytes_out = self.bytes_in = 0
+        self.cache_hits = self.cache_misses = 0
+
+
+class Metrics:
+
+    def __init__(self):
+        self._endpoints = {}
+        # module.method -> [调用次数, code != 0 的次数]
+        self._rpc_methods = {}
+        self._lock = threading.Lock()
+
+    def _get(self, endpoint):
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = _EndpointStats()
+        return stats
+
+    def record_request(self, endpoint, seconds, bytes_out=0, bytes_in=0,
+                       error=False):
+        """
+        :param error: 连接错误、超时或者 HTTP 状态码 >= 400
+        """
+        index = bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            stats = self._get(endpoint)
+            stats.requests += 1
+            stats.buckets[index] += 1
+            stats.latency_sum += seconds
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+            if error:
+                stats.errors += 1
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self._get(endpoint).retries += 1
+
+    def record_cache(self, endpoint, hit):
+        with self._lock:
+            stats = self._get(endpoint)
+            if hit:
+                stats.cache_hits += 1
+            else:
+                stats.cache_misses += 1
+
+    def record_rpc(self, endpoint, payload, js):
+        """统计一个 musicu.fcg 请求中顶层和每个子请求的 code"""
+        methods = []
+        for key, req in payload.items():
+            if key == 'comm':
+                continue
+            sub = js.get(key)
+            failed = not isinstance(sub, dict) or sub.get('code', 0) != 0
+            methods.append((f"{req.get('module')}.{req.get('method')}", failed))
+        with self._lock:
+            if js.get('code', 0) != 0:
+                self._get(endpoint).code_errors += 1
+            for method, failed in methods:
+                counter = self._rpc_methods.get(method)
+                if counter is None:
+                    counter = self._rpc_methods[method] = [0, 0]
+                counter[0] += 1
+                if failed:
+                    counter[1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._rpc_methods.clear()
+
+    def snapshot(self):
+        """
+        :return: {'endpoints': {endpoint: {...}}, 'rpc': {module.method: {...}}}
+            直方图中每个桶的数量是累计的，和 Prometheus 一致
+        """
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self._endpoints.items():
+                cumulative, buckets = 0, {}
+                for le, count in zip(LATENCY_BUCKETS + ('+Inf',), stats.buckets):
+                    cumulative += count
+                    buckets[str(le)] = cumulative
+                lookups = stats.cache_hits + stats.cache_misses
+                endpoints[endpoint] = {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'retries': stats.retries,
+                    'code_errors': stats.code_errors,
+                    'bytes_out': stats.bytes_out,
+                    'bytes_in': stats.bytes_in,
+                    'latency_sum': stats.latency_sum,
+                    'latency_buckets': buckets,
+                    'cache_hits': stats.cache_hits,
+                    'cache_misses': stats.cache_misses,
+                    'cache_hit_ratio': stats.cache_hits / lookups if lookups else None,
+                }
+            rpc = {method: {'calls': calls,
+                            'code_errors': errors,
+                            'code_error_rate': errors / calls}
+                   for method, (calls, errors) in self._rpc_methods.items()}
+        return {'endpoints': endpoints, 'rpc': rpc}
+
+    def to_prometheus(self, prefix='qqmusic'):
+        snapshot = self.snapshot()
+        endpoints = sorted(snapshot['endpoints'].items())
+        lines = []
+
+        def metric(name, type_, help_, samples):
+            lines.append(f'# HELP {prefix}_{name} {help_}')
+            lines.append(f'# TYPE {prefix}_{name} {type_}')
+            for suffix, labels, value in samples:
+                label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f'{prefix}_{name}{suffix}{{{label_str}}} {value}')
+
+        samples = []
+        for endpoint, stats in endpoints:
+            for le, count in stats['latency_buckets'].items():
+                samples.append(('_bucket', (('endpoint', endpoint), ('le', le)), count))
+            samples.append(('_sum', (('endpoint', endpoint),), stats['latency_sum']))
+            samples.append(('_count', (('endpoint', endpoint),), stats['requests']))
+        metric('request_duration_seconds', 'histogram', 'Request latency.', samples)
+
+        counters = [
+            ('request_errors_total', 'errors', 'Failed requests.'),
+            ('request_retries_total', 'retries', 'Retried requests.'),
+            ('request_code_errors_total', 'code_errors',
+             'Responses whose top-level code is not 0.'),
+            ('request_bytes_sent_total', 'bytes_out', 'Bytes sent.'),
+            ('response_bytes_received_total', 'bytes_in', 'Bytes received.'),
+            ('cache_hits_total', 'cache_hits', 'Response cache hits.'),
+            ('cache_misses_total', 'cache_misses', 'Response cache misses.'),
+        ]
+        for name, field, help_ in counters:
+            metric(name, 'counter', help_,
+                   [('', (('endpoint', endpoint),), stats[field])
+                    for endpoint, stats in endpoints])
+
+        rpc = sorted(snapshot['rpc'].items())
+        metric('rpc_calls_total', 'counter', 'musicu.fcg sub-requests.',
+               [('', (('method', method),), stats['calls']) for method, stats in rpc])
+        metric('rpc_code_errors_total', 'counter',
+               'musicu.fcg sub-requests whose code is not 0.',
+               [('', (('method', method),), stats['code_errors'])
+                for method, stats in rpc])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,77 @@
+"""
+歌单修改（添加、删除歌曲）的合并队列
+
+一小段时间内对同一个歌单的修改会被合并成最多两个请求（AddSonglist 和 DelSonglist），
+它们的 v_songInfo 都支持多首歌曲。
+"""
+
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class PlaylistMutationQueue:
+    """
+    :param window: 第一个修改到达之后，等待这么多秒再发送请求
+    """
+
+    def __init__(self, api, window=0.05):
+        self._api = api
+        self._window = window
+        self._lock = threading.Lock()
+        # dirid -> list of (op, song_ids, future)
+        self._pending = {}
+
+    def add_songs(self, dirid, song_ids):
+        """
+        :return: Future，结果是 True 或 False
+        """
+        return self._enqueue('add', dirid, song_ids)
+
+    def remove_songs(self, dirid, song_ids):
+        return self._enqueue('remove', dirid, song_ids)
+
+    def _enqueue(self, op, dirid, song_ids):
+        future = Future()
+        with self._lock:
+            calls = self._pending.get(dirid)
+            if calls is None:
+                calls = self._pending[dirid] = []
+                timer = threading.Timer(self._window, self._flush, args=(dirid,))
+                timer.daemon = True
+                timer.start()
+            calls.append((op, [int(song_id) for song_id in song_ids], future))
+        return future
+
+    def _flush(self, dirid):
+        with self._lock:
+            calls = self._pending.pop(dirid)
+        # 同一首歌被多次修改时，只有最后一次修改需要发送给服务端
+        last_op = {}
+        for op, song_ids, _ in calls:
+            for song_id in song_ids:
+                last_op[song_id] = op
+        results = {}
+        for op, func in (('add', self._api.playlist_add_songs),
+                         ('remove', self._api.playlist_remove_songs)):
+            song_ids = [song_id for song_id, op_ in last_op.items() if op_ == op]
+            if not song_ids:
+                continue
+            logger.debug(f'{op} {len(song_ids)} songs, playlist dirid:{dirid}, '
+                         f'merged from {len(calls)} calls')
+            try:
+                results[op] = func(dirid, song_ids)
+            except Exception as e:  # noqa
+                results[op] = e
+        for op, song_ids, future in calls:
+            # 被后面的修改覆盖的歌曲，不影响这次调用的结果
+            if not any(last_op[song_id] == op for song_id in song_ids):
+                future.set_result(True)
+                continue
+            result = results[op]
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
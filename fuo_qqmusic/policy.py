@@ -0,0 +1,103 @@
+"""
+接口的请求策略：超时、重试和对冲请求（hedged request）
+"""
+
+import random
+import threading
+from collections import defaultdict, deque
+
+
+class RequestPolicy:
+    """
+    :param timeout: 单次请求的超时时间，单位是秒
+    :param retries: 遇到连接错误或者超时，最多重试的次数。
+        只有幂等的接口才会重试。
+    :param backoff: 第 n 次重试前最多等待 backoff * 2**n 秒（full jitter）
+    :param idempotent: 重复发送请求是否安全。写接口应该设置为 False。
+    :param hedge: 请求耗时超过该接口的 p95 时，再发一个相同的请求，
+        谁先返回就用谁的结果。只适用于幂等的、对延迟敏感的读接口。
+    """
+
+    def __init__(self, timeout=2, retries=0, backoff=0.2,
+                 idempotent=True, hedge=False):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.idempotent = idempotent
+        self.hedge = hedge and idempotent
+
+    def max_attempts(self):
+        return self.retries + 1 if self.idempotent else 1
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def __repr__(self):
+        return (f'RequestPolicy(timeout={self.timeout}, retries={self.retries}, '
+                f'idempotent={self.idempotent}, hedge={self.hedge})')
+
+
+# key 是 API 的方法名。合并（batch）后的 rpc 请求使用 rpc 的策略。
+ENDPOINT_POLICIES = {
+    'rpc': RequestPolicy(timeout=5, retries=1),
+    'search': RequestPolicy(timeout=3, retries=1),
+    'song_detail': RequestPolicy(timeout=2, retries=2, hedge=True),
+    'batch_song_details': RequestPolicy(timeout=5, retries=2),
+    'song_similar': RequestPolicy(timeout=3, retries=1),
+    'artist_detail': RequestPolicy(timeout=3, retries=2),
+    'artist_songs': RequestPolicy(timeout=3, retries=2),
+    'artist_albums': RequestPolicy(timeout=3, retries=2),
+    'album_detail': RequestPolicy(timeout=3, retries=2),
+    'playlist_detail': RequestPolicy(timeout=5, retries=2),
+    'get_recommend_feed': RequestPolicy(timeout=5, retries=1),
+    'get_comment': RequestPolicy(timeout=3, retries=1),
+    'get_lyric_by_songmid': RequestPolicy(timeout=2, retries=2),
+    'get_song_url': RequestPolicy(timeout=3, retries=1),
+    'get_song_url_v2': RequestPolicy(timeout=2, retries=2, hedge=True),
+    'get_song_urls': RequestPolicy(timeout=5, retries=2),
+    'playlist_add_songs': RequestPolicy(timeout=5, idempotent=False),
+    'playlist_remove_songs': RequestPolicy(timeout=5, idempotent=False),
+    'add_to_dislike_list': RequestPolicy(timeout=5, idempotent=False),
+    'remove_from_dislike_list': RequestPolicy(timeout=5, idempotent=False),
+}
+
+
+class LatencyTracker:
+    """记录每个接口最近若干次请求的耗时，用来估算 p95"""
+
+    def __init__(self, size=200, min_samples=20):
+        self._size = size
+        self._min_samples = min_samples
+        self._samples = defaultdict(lambda: deque(maxlen=self._size))
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            self._samples[endpoint].append(seconds)
+
+    def percentile(self, endpoint, p):
+        """样本数不足时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < self._min_samples:
+            return None
+        index = min(int(len(samples) * p), len(samples) - 1)
+        return samples[index]
+
+
+class HedgeStats:
+
+    def __init__(self):
+        self._stats = defaultdict(lambda: {'fired': 0, 'won': 0})
+        self._lock = threading.Lock()
+
+    def incr(self, endpoint, field):
+        with self._lock:
+            self._stats[endpoint][field] += 1
+
+    def snapshot(self):
+        """
+        :return: {endpoint: {'fired': 发出对冲请求的次数, 'won': 对冲请求先返回的次数}}
+        """
+        with self._lock:
+            return {endpoint: dict(stat) for endpoint, stat in self._stats.items()}
@@ -0,0 +1,90 @@
+"""
+播放预取：在当前歌曲播放时，提前准备接下来几首歌的数据
+
+切歌时需要歌曲详情（文件信息、mv_id）、播放链接和歌词，串行请求的话，
+每次切歌都要等好几个请求。预取之后，这些数据都已经在缓存中了。
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    :param provider: QQProvider
+    :param depth: 预取接下来多少首歌
+    :param workers: 最多同时预取多少首歌
+    """
+
+    def __init__(self, provider, depth=3, workers=2):
+        self._provider = provider
+        self.depth = depth
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='qqmusic-prefetch')
+        self._lock = threading.Lock()
+        # song identifier -> future
+        self._futures = {}
+        self.hits = self.misses = 0
+
+    def set_upcoming(self, songs):
+        """设置接下来要播放的歌曲（按播放顺序），会替换之前的设置
+
+        不在新列表中的歌曲，还没有开始的预取会被取消。
+        """
+        songs = songs[:self.depth]
+        identifiers = {str(song.identifier) for song in songs}
+        with self._lock:
+            for identifier in list(self._futures):
+                if identifier not in identifiers:
+                    # 已经开始的预取不能中断，它的结果依然会进入缓存
+                    self._futures.pop(identifier).cancel()
+            for song in songs:
+                identifier = str(song.identifier)
+                future = self._futures.get(identifier)
+                if future is not None and not future.done():
+                    continue
+                if future is not None and future.exception() is None:
+                    continue
+                self._futures[identifier] = self._executor.submit(self._prefetch, song)
+
+    def _prefetch(self, song):
+        provider = self._provider
+        try:
+            # 文件信息和 mv_id 在同一个请求中获取
+            provider._songs_fill_file_info([song])
+            provider.songs_resolve_media([song])
+            mid, _ = song.cache_get('mid')
+            if mid:
+                # API 层会缓存歌词
+                provider.api.get_lyric_by_songmid(mid)
+        except Exception:  # noqa
+            logger.exception(f'prefetch song:{song.identifier} failed')
+            raise
+
+    def record(self, hit):
+        """记录一次获取播放链接是否命中了缓存"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0,
+                'pending': sum(1 for f in self._futures.values() if not f.done()),
+            }
+
+    def shutdown(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=False)
@@ -1,4 +1,8 @@
 import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Optional, Protocol, Tuple
 from feeluown.excs import ModelNotFound
 from feeluown.library import (
@@ -39,15 +43,32 @@ from feeluown.library import (
 )
 from feeluown.media import Media, Quality
 from feeluown.utils.dispatch import Signal
-from feeluown.utils.reader import create_reader, SequentialReader
+from feeluown.utils.reader import (
+    create_reader,
+    RandomSequentialReader,
+    SequentialReader,
+)
 from .api import API
+from .aio_api import AsyncAPI
+from .cache import ENDPOINT_TTLS
+from .consts import METADATA_STORE_FILE
 from .login import read_cookies
 from .excs import QQIOError
+from .feed import RecommendFeedSnapshots
+from .lazy import LazyModelList
+from .media_cache import MediaUrlCache
+from .mutation import PlaylistMutationQueue
+from .prefetch import Prefetcher
+from .search import SEARCH_TYPES, LiveSearch, SearchEngine
+from .store import MetadataStore
 
 
 logger = logging.getLogger(__name__)
-UNFETCHED_MEDIA = object()
 SOURCE = "qqmusic"
+# 歌单中的歌曲按页获取，每页的数量
+PLAYLIST_PAGE_SIZE = 100
+# 最多保留这么多个歌单的页缓存
+PLAYLIST_PAGES_CACHE_SIZE = 16
 
 
 class Supports(
@@ -84,11 +105,32 @@ class QQProvider(AbstractProvider, ProviderV2):
     def __init__(self):
         super().__init__()
         self.api = API()
+        self._aio_api = None
+        # 歌曲、专辑、歌手的元数据存在本地，重启之后也不需要重新请求
+        self.store = MetadataStore(METADATA_STORE_FILE)
+        # 播放链接按照服务端返回的有效时间缓存，播放列表中的歌曲会在后台刷新
+        self.media_cache = MediaUrlCache(refresh_func=self._refresh_media)
+        # 提前准备接下来几首歌的数据，切歌时不需要等待
+        self.prefetcher = Prefetcher(self)
+        self._playlist_mutations = PlaylistMutationQueue(self.api)
+        # pid -> _PlaylistSongsPages，同一个歌单的 reader 共用已经获取的页
+        self._playlist_pages = OrderedDict()
+        self._playlist_pages_lock = threading.Lock()
+        # 首页的几个推荐共享同一份 feed
+        self.rec_feed = RecommendFeedSnapshots(self.api)
+        self.searcher = SearchEngine(self.api)
         self.current_user_changed = Signal()
 
     def _(self) -> Supports:
         return self
 
+    @property
+    def aio_api(self):
+        # 延迟创建，这样没有安装 aiohttp 时，同步的接口依然可以正常使用
+        if self._aio_api is None:
+            self._aio_api = AsyncAPI(self.api)
+        return self._aio_api
+
     @property
     def identifier(self):
         return "qqmusic"
@@ -133,7 +175,11 @@ class QQProvider(AbstractProvider, ProviderV2):
         )
 
     def song_get(self, identifier):
-        data = self.api.song_detail(identifier)
+        data = self.store.get('song', identifier)
+        if data is None:
+            data = self.api.song_detail(identifier)
+            if data is not None:
+                self.store.put('song', identifier, data, mid=data['mid'])
         return _deserialize(data, QQSongSchema)
 
     def song_get_mv(self, song):
@@ -236,77 +282,137 @@ class QQProvider(AbstractProvider, ProviderV2):
         :return: when quality is invalid, return None
         """
         q_media_mapping = self._song_get_q_media_mapping(song)
-        quality_suffix = self._model_cache_get_or_fetch(song, "quality_suffix")
-        mid = self._model_cache_get_or_fetch(song, "mid")
-        media_id = self._model_cache_get_or_fetch(song, "media_id")
-        media = q_media_mapping.get(quality)
-        if media is UNFETCHED_MEDIA:
-            for q, t, b, s in quality_suffix:
-                if quality == Quality.Audio(q):
-                    url = self.api.get_song_url_v2(mid, media_id, t)
-                    if url:
-                        media = Media(url, bitrate=b, format=s)
-                        q_media_mapping[quality] = media
-                    else:
-                        media = None
-                        q_media_mapping[quality] = None
-                    break
-            else:
-                media = None
-        return media
+        return q_media_mapping.get(quality)
 
     def _song_get_q_media_mapping(self, song):
-        q_media_mapping, exists = song.cache_get("q_media_mapping")
-        if exists is True:
+        q_media_mapping = self._song_media_cache_get(song)
+        self.prefetcher.record(q_media_mapping is not None)
+        if q_media_mapping is not None:
             return q_media_mapping
-        # FIXME: 三个字段应该合并成一个字段。现在看这三行代码，就很疑惑，
-        # 并且容易担心会触发三个请求。而这三个字段其实可以一次性拿到。
-        quality_suffix = self._model_cache_get_or_fetch(song, "quality_suffix")
-        mid = self._model_cache_get_or_fetch(song, "mid")
-        media_id = self._model_cache_get_or_fetch(song, "media_id")
-        q_media_mapping = {}
-        # 注：self.quality_suffix 这里可能会触发一次网络请求
-        for idx, (q, t, b, s) in enumerate(quality_suffix):
-            url = self.api.get_song_url_v2(mid, media_id, t)
-            if url:
-                q_media_mapping[Quality.Audio(q)] = Media(url,
-                                                          bitrate=b,
-                                                          format=s)
-                # 一般来说，高品质有权限 低品质也会有权限，减少网络请求。
-                # 这里把值设置为 UNFETCHED_MEDIA，作为一个标记。
-                for i in range(idx + 1, len(quality_suffix)):
-                    q_media_mapping[Quality.Audio(
-                        quality_suffix[i][0])] = UNFETCHED_MEDIA
-                break
-        # 根据过去经验，url 一段时间之后会过期。
-        # 具体多久，不是很清楚。
-        song.cache_set("q_media_mapping", q_media_mapping, ttl=3600)
-        return q_media_mapping
+        # 所有候选音质的文件在一个 vkey 请求中获取，拿到的就是实际可以播放的音质。
+        # 以前是从高到低逐个音质尝试，没有会员的用户最多需要四次请求。
+        self.songs_resolve_media([song], force=True)
+        return self._song_media_cache_get(song, margin=False) or {}
+
+    def _song_media_cache_get(self, song, margin=True):
+        self._songs_fill_file_info([song])
+        mid, _ = song.cache_get("mid")
+        if mid is None:
+            return None
+        quality_suffix, _ = song.cache_get("quality_suffix")
+        qualities = [Quality.Audio(q) for q, _, _, _ in quality_suffix or []]
+        return self.media_cache.get_mapping(mid, qualities, margin=margin)
+
+    def songs_resolve_media(self, songs, force=False):
+        """一次性获取多首歌曲所有音质的播放链接
+
+        结果存在 media_cache 中（和 song_get_media 使用的是同一个缓存），
+        这样开始播放一个歌单时，不需要为每首歌发送一次或多次请求。
+        链接还有效的歌曲会被跳过，force 为 True 时总是重新获取。
+        """
+        self._songs_fill_file_info(songs)
+        # 没有 mid 或者 media_id 的歌曲无法获取链接
+        songs = [song for song in songs
+                 if song.cache_get("mid")[0] is not None
+                 and song.cache_get("media_id")[0] is not None]
+        if not force:
+            songs = [song for song in songs
+                     if self._song_media_cache_get(song) is None]
+        if not songs:
+            return
+        items = []
+        owners = []  # 和 items 一一对应：(mid, quality, bitrate, format)
+        mappings = {}
+        for song in songs:
+            quality_suffix, _ = song.cache_get("quality_suffix")
+            mid, _ = song.cache_get("mid")
+            media_id, _ = song.cache_get("media_id")
+            mappings[mid] = {}
+            for q, t, b, s in quality_suffix or []:
+                items.append((mid, media_id, t))
+                owners.append((mid, q, b, s))
+        urls, expiration = self.api.get_song_urls_with_expiration(items)
+        for (mid, q, b, s), url in zip(owners, urls):
+            # 没有权限的音质也记下来，避免每次都重新请求
+            media = Media(url, bitrate=b, format=s) if url else None
+            mappings[mid][Quality.Audio(q)] = media
+        for mid, mapping in mappings.items():
+            self.media_cache.set_mapping(mid, mapping, expiration)
+
+    def songs_keep_media_fresh(self, songs):
+        """在后台刷新这些歌曲的播放链接，使它们在播放时总是有效的
+
+        一般传入当前播放列表中的歌曲，会替换之前的设置。
+        """
+        self._songs_fill_file_info(songs)
+        self.media_cache.watch([(song.cache_get("mid")[0], song) for song in songs])
+
+    def songs_prefetch(self, songs):
+        """预取接下来要播放的歌曲（按播放顺序）的播放链接、歌词和 mv_id
+
+        一般在每次切歌或者播放列表变化时调用，预取的数量由 prefetcher.depth 决定。
+        """
+        self.prefetcher.set_upcoming(songs)
+
+    def _refresh_media(self, songs):
+        self.songs_resolve_media(songs, force=True)
+
+    def _songs_fill_file_info(self, songs):
+        """对于没有文件信息（mid/media_id/quality_suffix）的歌曲，批量获取它们"""
+        songs = [song for song in songs
+                 if song.cache_get("quality_suffix")[1] is not True]
+        if not songs:
+            return
+        tracks = self.api.batch_song_details([int(song.identifier) for song in songs])
+        fetched = {}
+        for track in tracks:
+            fetched[str(track["id"])] = _deserialize(track, QQSongSchema)
+        for song in songs:
+            upgraded = fetched.get(str(song.identifier))
+            if upgraded is None:
+                continue
+            for field in ("mid", "media_id", "mv_id", "quality_suffix"):
+                song.cache_set(field, upgraded.cache_get(field)[0])
 
     def artist_get(self, identifier):
-        data_mid = self.api.artist_songs(int(identifier), 1, 0)["singerMid"]
-        data_artist = self.api.artist_detail(data_mid)
+        data_artist = self.store.get('artist', identifier)
+        if data_artist is None:
+            # 和 artist_create_songs_rd 的第一页是同一个请求，打开歌手页面时
+            # 第二次获取会命中 API 层的缓存
+            data_mid = self.api.artist_songs(int(identifier), 1)["singerMid"]
+            data_artist = self.api.artist_detail(data_mid)
+            self.store.put('artist', identifier, data_artist, mid=data_mid)
         artist = _deserialize(data_artist, QQArtistSchema)
         return artist
 
     def artist_create_songs_rd(self, artist):
         return create_g(self.api.artist_songs, int(artist.identifier),
-                        _ArtistSongSchema)
+                        _ArtistSongSchema, api=self.api)
 
     def artist_create_albums_rd(self, artist):
         return create_g(self.api.artist_albums, int(artist.identifier),
                         _BriefAlbumSchema)
 
     def album_get(self, identifier):
-        data_album = self.api.album_detail(int(identifier))
-        if data_album is None:
-            raise ModelNotFound
+        data_album = self._album_get_data(identifier)
         album = _deserialize(data_album, QQAlbumSchema)
         return album
 
+    def _album_get_data(self, identifier):
+        data_album = self.store.get('album', identifier)
+        if data_album is None:
+            data_album = self.api.album_detail(int(identifier))
+            if data_album is None:
+                raise ModelNotFound
+            mid = data_album.get('getAlbumInfo', {}).get('Falbum_mid')
+            self.store.put('album', identifier, data_album, mid=mid)
+        return data_album
+
     def album_create_songs_rd(self, album):
-        album = self.album_get(album.identifier)
-        return create_reader(album.songs)
+        # 不需要构造整个专辑，歌曲在被读取时才会被反序列化
+        data_album = self._album_get_data(album.identifier)
+        songs = LazyModelList(data_album.get('getSongInfo') or [], QQSongSchema)
+        return _create_lazy_reader(songs)
 
     def user_get(self, identifier):
         data = self.api.user_detail(identifier)
@@ -314,31 +420,102 @@ class QQProvider(AbstractProvider, ProviderV2):
         # 假设使用微信登陆，从网页拿到 cookie，cookie 里面的 uin 是正确的，
         # 而这个接口返回的 uin 则可能是 0，因此手动重置一下。
         data["creator"]["uin"] = identifier
+        # 顺便记下用户歌单的 dirid，修改歌单时不需要再请求歌单详情
+        for each in data["mydiss"]["list"]:
+            if each.get("dirid") is not None:
+                self.store.put('dirid', each["dissid"], each["dirid"])
         return _deserialize(data, QQUserSchema)
 
     def playlist_get(self, identifier):
-        data = self.api.playlist_detail(int(identifier), limit=1000)
-        return _deserialize(data, QQPlaylistSchema)
+        # 只获取第一页，歌曲由 playlist_create_songs_rd 按需获取。
+        # 第一页在歌单的页缓存中，创建 reader 时不需要再次请求。
+        return _deserialize_playlist(self._get_playlist_pages(identifier).first_page)
 
     def playlist_add_song(self, playlist, song):
-        # FIXME: 目前 playlist 相关接口用的都是 diss 结构体，而这里需要一个 dirid。
-        # 平台方也提供了 dir 相关的接口，我大胆猜测，diss 是一套老接口。
-        playlist._cache.pop("songs", None)
-        dirid = self._get_dirid_by_playlist_id(playlist.identifier)
-        return self.api.playlist_add_songs(dirid, [song.identifier])
+        return self.playlist_add_songs(playlist, [song])
+
+    def playlist_add_songs(self, playlist, songs):
+        """把多首歌添加到歌单中
+
+        短时间内对同一个歌单的修改会被合并成一个请求。
+        """
+        return self._playlist_mutate(playlist, songs, 'add')
 
     def playlist_remove_song(self, playlist, song):
-        playlist._cache.pop("songs", None)
+        return self.playlist_remove_songs(playlist, [song])
+
+    def playlist_remove_songs(self, playlist, songs):
+        return self._playlist_mutate(playlist, songs, 'remove')
+
+    def _playlist_mutate(self, playlist, songs, op):
         dirid = self._get_dirid_by_playlist_id(playlist.identifier)
-        return self.api.playlist_remove_songs(dirid, [song.identifier])
+        song_ids = [song.identifier for song in songs]
+        if op == 'add':
+            future = self._playlist_mutations.add_songs(dirid, song_ids)
+        else:
+            future = self._playlist_mutations.remove_songs(dirid, song_ids)
+        # 按照调用的顺序直接修改已经获取的页，这样不需要重新获取整个歌单。
+        # 修改失败时丢掉这个歌单的页缓存。
+        pages = self._get_playlist_pages(playlist.identifier, fetch=False)
+        if pages is not None:
+            if op == 'add':
+                pages.add_songs(songs)
+            else:
+                pages.remove_songs(song_ids)
+        try:
+            ok = future.result()
+        except Exception:  # noqa
+            self._discard_playlist_pages(playlist.identifier)
+            raise
+        if not ok:
+            self._discard_playlist_pages(playlist.identifier)
+        return ok
+
+    def _get_playlist_pages(self, pid, fetch=True):
+        """
+        :param fetch: 为 False 时，没有缓存就返回 None
+        """
+        pid = int(pid)
+        ttl = ENDPOINT_TTLS['playlist_detail']
+        with self._playlist_pages_lock:
+            pages = self._playlist_pages.get(pid)
+            # 和 API 层的缓存一样，过一段时间之后重新获取，以便看到其它客户端的修改
+            if pages is not None and time.monotonic() - pages.created_at < ttl:
+                self._playlist_pages.move_to_end(pid)
+                return pages
+        if not fetch:
+            return None
+        data = self.api.playlist_detail(pid, limit=PLAYLIST_PAGE_SIZE)
+        # 第一页中就有 dirid，修改这个歌单时不需要再请求一次歌单详情
+        if data.get('dirid') is not None and self.store.get('dirid', pid) is None:
+            self.store.put('dirid', pid, data['dirid'])
+        pages = _PlaylistSongsPages(self.api, pid, data)
+        with self._playlist_pages_lock:
+            self._playlist_pages[pid] = pages
+            self._playlist_pages.move_to_end(pid)
+            while len(self._playlist_pages) > PLAYLIST_PAGES_CACHE_SIZE:
+                self._playlist_pages.popitem(last=False)
+        return pages
+
+    def _discard_playlist_pages(self, pid):
+        with self._playlist_pages_lock:
+            self._playlist_pages.pop(int(pid), None)
 
     def _get_dirid_by_playlist_id(self, playlist_id):
-        data = self.api.playlist_detail(int(playlist_id), limit=1)
-        return data["dirid"]
+        # FIXME: 目前 playlist 相关接口用的都是 diss 结构体，而这里需要一个 dirid。
+        # 平台方也提供了 dir 相关的接口，我大胆猜测，diss 是一套老接口。
+        # disstid 和 dirid 的对应关系不会变化，所以它被存在本地。
+        dirid = self.store.get('dirid', playlist_id)
+        if dirid is None:
+            data = self.api.playlist_detail(int(playlist_id), limit=1)
+            dirid = data["dirid"]
+            self.store.put('dirid', playlist_id, dirid)
+        return dirid
 
     def playlist_create_songs_rd(self, playlist):
-        songs = self._model_cache_get_or_fetch(playlist, "songs")
-        return create_reader(songs)
+        pages = self._get_playlist_pages(playlist.identifier)
+        return RandomSequentialReader(pages.total, pages.read,
+                                      max_per_read=PLAYLIST_PAGE_SIZE)
 
     def __rec_hot_playlists(self):
         user = self.get_current_user()
@@ -356,19 +533,12 @@ class QQProvider(AbstractProvider, ProviderV2):
         ]
 
     def rec_list_daily_songs(self):
-        # TODO: cache API result
-        feed = self.api.get_recommend_feed()
+        feed = self.rec_feed.get()
         card = None
-        for shelf_ in feed['v_shelf']:
-            if 'moduleID' not in shelf_['extra_info']:
-                for batch in shelf_['v_niche']:
-                    for card in batch['v_card']:
-                        if (card['extra_info'].get(
-                                'moduleID', '').startswith('recforyou') and
-                                card['jumptype'] == 10014  # 10014->playlist
-                            ):
-                            card = card
-                            break
+        for shelf, card_ in feed.cards_by_module_prefix('recforyou'):
+            if not shelf.module_id and card_['jumptype'] == 10014:  # 10014->playlist
+                card = card_
+                break
         if card is None:
             logger.warning("No daily songs found")
             return []
@@ -377,60 +547,63 @@ class QQProvider(AbstractProvider, ProviderV2):
         return self.playlist_create_songs_rd(playlist).readall()
 
     def rec_list_daily_playlists(self):
-        # TODO: cache API result
-        feed = self.api.get_recommend_feed()
-        shelf = None
-        for shelf_ in feed['v_shelf']:
-            # I guess 10046 means 'song'.
-            if shelf_['extra_info'].get('moduleID', '').startswith('playlist'):
-                shelf = shelf_
-                break
+        feed = self.rec_feed.get()
+        shelf = feed.shelf_by_module_prefix('playlist')
         if shelf is None:
             return []
         playlists = []
-        for batch in shelf['v_niche']:
-            for card in batch['v_card']:
-                if card['jumptype'] == 10014:  # 10014->playlist
-                    playlists.append(
-                        PlaylistModel(
-                            identifier=str(card['id']),
-                            source=SOURCE,
-                            name=card['title'],
-                            cover=card['cover'],
-                            description=card['miscellany']['rcmdtemplate'],
-                            play_count=card['cnt']))
+        for card in shelf.cards_by_jumptype(10014):  # 10014->playlist
+            playlists.append(
+                PlaylistModel(
+                    identifier=str(card['id']),
+                    source=SOURCE,
+                    name=card['title'],
+                    cover=card['cover'],
+                    description=card['miscellany']['rcmdtemplate'],
+                    play_count=card['cnt']))
         return playlists
 
     def rec_a_collection_of_songs(self):
-        # TODO: cache API result
-        feed = self.api.get_recommend_feed()
-        shelf = None
-        for shelf_ in feed['v_shelf']:
-            # I guess 10046 means 'song'.
-            if int(shelf_['miscellany'].get('jumptype', 0)) == 10046:
-                shelf = shelf_
-                break
+        feed = self.rec_feed.get()
+        # I guess 10046 means 'song'.
+        shelf = feed.shelf_by_jumptype(10046)
         if shelf is None:
             return Collection(name='',
                               type_=CollectionType.only_songs,
                               models=[],
                               description='')
-        title = shelf['title_content'] or shelf['title_template']
         song_ids = []
-        for batch in shelf['v_niche']:
-            for card in batch['v_card']:
-                if card['jumptype'] == 10046:
-                    song_id = int(card['id'])
-                    if song_id not in song_ids:
-                        song_ids.append(song_id)
+        for card in shelf.cards_by_jumptype(10046):
+            song_id = int(card['id'])
+            if song_id not in song_ids:
+                song_ids.append(song_id)
 
         tracks = self.api.batch_song_details(song_ids)
         return Collection(
-            name=title,
+            name=shelf.title,
             type_=CollectionType.only_songs,
-            models=[_deserialize(track, QQSongSchema) for track in tracks],
+            models=LazyModelList(tracks, QQSongSchema),
             description='')
 
+    def search_many(self, keyword, type_in, limit=20):
+        """在一个请求中搜索多种类型，比如用于全局搜索页面"""
+        types = SearchType.batch_parse(type_in)
+        result = self.searcher.search_many(keyword, types, limit=limit)
+        return SimpleSearchResult(q=keyword, **{
+            SEARCH_TYPES[type_][2]: models for type_, models in result.items()})
+
+    def search_create_readers(self, keyword, type_in, page_size=20):
+        """
+        :return: {SearchType: reader}。第一页在一个请求中获取，后面的页按需获取
+        """
+        types = SearchType.batch_parse(type_in)
+        return self.searcher.create_readers(keyword, types, page_size=page_size)
+
+    def search_create_live(self, type_in, callback, delay=0.3, limit=20):
+        """边输入边搜索，参考 search.LiveSearch"""
+        types = SearchType.batch_parse(type_in)
+        return LiveSearch(self.searcher, types, callback, delay=delay, limit=limit)
+
     def current_user_list_radio_songs(self, count):
         songs_data = self.api.get_radio_music(count)
         return [_deserialize(s, QQSongSchema) for s in songs_data]
@@ -519,68 +692,269 @@ class QQProvider(AbstractProvider, ProviderV2):
     def current_user_dislike_add_song(self, song):
         items = [{'ID': song.identifier}]
         js = self.api.add_to_dislike_list(items, API.DislikeListType.song)
+        self.rec_feed.invalidate()
         return js.get('Retcode') == 0
 
     def current_user_dislike_remove_song(self, song):
         items = [{'ID': song.identifier}]
         js = self.api.remove_from_dislike_list(items, API.DislikeListType.song)
+        self.rec_feed.invalidate()
         return js.get('Retcode') == 0
 
+    # 以下是部分高频方法的 asyncio 版本，它们不需要在线程池中运行，
+    # 可以在一个事件循环中并发地执行大量请求。和同步版本一样使用本地的元数据。
+
+    async def a_song_get(self, identifier):
+        data = self.store.get('song', identifier)
+        if data is None:
+            data = await self.aio_api.song_detail(identifier)
+            if data is not None:
+                self.store.put('song', identifier, data, mid=data['mid'])
+        return _deserialize(data, QQSongSchema)
+
+    async def a_song_get_lyric(self, song):
+        mid, exists = song.cache_get("mid")
+        if exists is not True:
+            mid = (await self.a_song_get(song.identifier)).cache_get("mid")[0]
+        content = await self.aio_api.get_lyric_by_songmid(mid)
+        return LyricModel(identifier=mid, source=SOURCE, content=content)
+
+    async def a_songs_get(self, identifiers):
+        tracks = await self.aio_api.batch_song_details(
+            [int(identifier) for identifier in identifiers])
+        return [_deserialize(track, QQSongSchema) for track in tracks]
+
+    async def a_album_get(self, identifier):
+        data_album = self.store.get('album', identifier)
+        if data_album is None:
+            data_album = await self.aio_api.album_detail(int(identifier))
+            if data_album is None:
+                raise ModelNotFound
+            mid = data_album.get('getAlbumInfo', {}).get('Falbum_mid')
+            self.store.put('album', identifier, data_album, mid=mid)
+        return _deserialize(data_album, QQAlbumSchema)
+
+    async def a_artist_get(self, identifier):
+        data_artist = self.store.get('artist', identifier)
+        if data_artist is None:
+            data_mid = (await self.aio_api.artist_songs(int(identifier), 1))["singerMid"]
+            data_artist = await self.aio_api.artist_detail(data_mid)
+            self.store.put('artist', identifier, data_artist, mid=data_mid)
+        return _deserialize(data_artist, QQArtistSchema)
+
+    async def a_playlist_get(self, identifier):
+        data = await self.aio_api.playlist_detail(int(identifier),
+                                                  limit=PLAYLIST_PAGE_SIZE)
+        return _deserialize_playlist(data)
+
 
 def _deserialize(data, schema_cls):
-    schema = schema_cls()
-    obj = schema.load(data)
-    return obj
+    return deserialize(data, schema_cls)
+
+
+def _create_lazy_reader(models, max_per_read=50):
+    # create_reader 对于 Sequence 会一次读取所有数据，这里每次只读取一部分
+    return RandomSequentialReader(len(models),
+                                  lambda start, end: models[start:end],
+                                  max_per_read=max_per_read)
+
+
+def _deserialize_playlist(data):
+    # 这里只有第一页的歌曲，不把它们缓存为歌单的 songs
+    data = {k: v for k, v in data.items() if k != "songlist"}
+    return _deserialize(data, QQPlaylistSchema)
+
+
+# 所有歌单 reader 共用，这样打开很多歌单时线程数不会增长
+_playlist_pages_executor = ThreadPoolExecutor(max_workers=4,
+                                              thread_name_prefix='qqmusic-pages')
+
+
+class _PlaylistSongsPages:
+    """按页获取歌单中的歌曲
+
+    已经获取的页会被缓存，读取一页时会在后台预取后面的 prefetch 页。
+    歌单被修改时，直接修改已经获取的页，而不是重新获取整个歌单。
+
+    :param first_page: 第一页的接口数据，从中获取歌曲总数
+    """
+
+    def __init__(self, api, pid, first_page, page_size=PLAYLIST_PAGE_SIZE,
+                 prefetch=1):
+        self._api = api
+        self._pid = pid
+        self._page_size = page_size
+        self._prefetch = prefetch
+        self.created_at = time.monotonic()
+        songlist = first_page.get("songlist") or []
+        self.total = int(first_page.get("total_song_num")
+                         or first_page.get("songnum")
+                         or len(songlist))
+        # 歌单的信息，不包括歌曲
+        self.first_page = {k: v for k, v in first_page.items() if k != "songlist"}
+        self._lock = threading.Lock()
+        # page -> future of LazyModelList，歌曲在被读取时才会被反序列化
+        self._pages = {}
+        self._set_items(songlist)
+
+    def read(self, start, end):
+        first, last = start // self._page_size, (end - 1) // self._page_size
+        futures = [self._get_page(page) for page in range(first, last + 1)]
+        for page in range(last + 1, last + 1 + self._prefetch):
+            if page * self._page_size < self.total:
+                self._get_page(page)
+        songs = []
+        for page, future in enumerate(futures, start=first):
+            offset = page * self._page_size
+            songs.extend(future.result()[max(start - offset, 0):end - offset])
+        return songs
+
+    def add_songs(self, songs):
+        """新添加的歌曲在歌单的最前面"""
+        with self._lock:
+            items = self._loaded_items()
+            identifiers = {_song_item_id(item) for item in items}
+            new_songs = [song for song in songs
+                         if str(song.identifier) not in identifiers]
+            self._update(new_songs + items, self.total + len(new_songs))
+
+    def remove_songs(self, song_ids):
+        song_ids = {str(song_id) for song_id in song_ids}
+        with self._lock:
+            items = self._loaded_items()
+            remain = [item for item in items if _song_item_id(item) not in song_ids]
+            removed = len(items) - len(remain)
+            if len(items) < self.total:
+                # 没有找到的歌曲应该在还没有获取的页中
+                removed = len(song_ids)
+            self._update(remain, max(self.total - removed, len(remain)))
+
+    def _loaded_items(self):
+        """
+        :return: 从第一页开始，连续的已经获取的页中的歌曲
+        """
+        items = []
+        page = 0
+        while True:
+            future = self._pages.get(page)
+            if future is None or not future.done() or future.exception() is not None:
+                break
+            items.extend(future.result().items)
+            page += 1
+        return items
+
+    def _update(self, items, total):
+        self.total = total
+        self.first_page["total_song_num"] = self.first_page["songnum"] = total
+        # 后面的页中歌曲的位置都变了，它们需要重新获取
+        self._pages = {}
+        self._set_items(items)
+
+    def _set_items(self, items):
+        for page, offset in enumerate(range(0, len(items), self._page_size)):
+            page_items = items[offset:offset + self._page_size]
+            # 不满一页并且不是最后一页时，这一页需要重新获取
+            if len(page_items) < self._page_size \
+                    and offset + len(page_items) < self.total:
+                break
+            future = Future()
+            future.set_result(LazyModelList(page_items, QQSongSchema))
+            self._pages[page] = future
+
+    def _get_page(self, page):
+        with self._lock:
+            future = self._pages.get(page)
+            # 获取失败的页，下次读取时重新获取
+            if future is None or (future.done() and future.exception() is not None):
+                future = _playlist_pages_executor.submit(self._fetch_page, page)
+                self._pages[page] = future
+            return future
+
+    def _fetch_page(self, page):
+        data = self._api.playlist_detail(self._pid,
+                                         offset=page * self._page_size,
+                                         limit=self._page_size)
+        return LazyModelList(data.get("songlist") or [], QQSongSchema)
 
 
-def create_g(func, identifier, schema):
+def _song_item_id(item):
+    # item 是接口返回的原始数据，或者是添加到歌单中的 model
+    return str(item["id"]) if isinstance(item, dict) else str(item.identifier)
+
+
+def create_g(func, identifier, schema, fanout=4, api=None):
+    """创建一个分页获取数据的 reader
+
+    第一页返回之后就知道了总数，剩下的页最多 fanout 个同时请求，
+    结果依然按照顺序返回。遇到不满一页的数据时停止。
+
+    :param api: func 是 rpc 接口时传入。每 fanout 页在一个 batch 中获取，
+        合并成一个 musicu.fcg 请求
+    """
+    key = "songList" if schema == _ArtistSongSchema else "list"
     data = func(identifier, page=1)
     total = int(data["totalNum"] if schema == _ArtistSongSchema else data["total"])
 
     def g():
-        nonlocal data
-        if data is None:
-            yield from ()
-        else:
-            page = 1
-            while data["songList"] if schema == _ArtistSongSchema else data["list"]:
-                obj_data_list = (
-                    data["songList"] if schema == _ArtistSongSchema else data["list"]
-                )
-                for obj_data in obj_data_list:
-                    obj = _deserialize(obj_data, schema)
-                    yield obj
-                page += 1
-                data = func(identifier, page)
+        if data is None or not data[key]:
+            return
+        page_size = len(data[key])
+        for obj_data in data[key]:
+            yield _deserialize(obj_data, schema)
+        if page_size >= total:
+            return
+
+        last_page = (total + page_size - 1) // page_size
+        executor = ThreadPoolExecutor(max_workers=fanout,
+                                      thread_name_prefix='qqmusic-pages')
+        # 每个 future 的结果是连续的若干页
+        futures = deque()
+        next_page = 2
+
+        def fetch_pages(pages):
+            with api.batch() as batch:
+                page_futures = [batch.submit(func, identifier, page) for page in pages]
+            return [future.result() for future in page_futures]
+
+        def submit():
+            nonlocal next_page
+            if api is not None:
+                if not futures and next_page <= last_page:
+                    pages = range(next_page, min(next_page + fanout, last_page + 1))
+                    futures.append(executor.submit(fetch_pages, pages))
+                    next_page = pages.stop
+                return
+            while len(futures) < fanout and next_page <= last_page:
+                futures.append(executor.submit(
+                    lambda page: [func(identifier, page)], next_page))
+                next_page += 1
+
+        try:
+            submit()
+            while futures:
+                for page_data in futures.popleft().result():
+                    obj_data_list = page_data[key]
+                    for obj_data in obj_data_list:
+                        yield _deserialize(obj_data, schema)
+                    if len(obj_data_list) < page_size:
+                        return
+                # 总数可能已经过时，最后一页是满的时候继续往后请求
+                if not futures and next_page > last_page:
+                    last_page += 1
+                submit()
+        finally:
+            # reader 没有被读完时，不再请求剩下的页
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     return SequentialReader(g(), total)
 
 
 def search(keyword, **kwargs):
     type_ = SearchType.parse(kwargs["type_"])
-    type_type_map = {
-        SearchType.so: 0,
-        SearchType.ar: 1,
-        SearchType.al: 2,
-        SearchType.pl: 3,
-        SearchType.vi: 4,
-    }
-    data = provider.api.search(keyword, type_=type_type_map[type_])
-    if type_ == SearchType.so:
-        songs = [_deserialize(song, QQSongSchema) for song in data]
-        return SimpleSearchResult(q=keyword, songs=songs)
-    if type_ == SearchType.ar:
-        artists = [_deserialize(artist, SearchArtistSchema) for artist in data]
-        return SimpleSearchResult(q=keyword, artists=artists)
-    elif type_ == SearchType.al:
-        albums = [_deserialize(album, SearchAlbumSchema) for album in data]
-        return SimpleSearchResult(q=keyword, albums=albums)
-    elif type_ == SearchType.pl:
-        playlists = [_deserialize(playlist, SearchPlaylistSchema) for playlist in data]
-        return SimpleSearchResult(q=keyword, playlists=playlists)
-    elif type_ == SearchType.vi:
-        models = [_deserialize(model, SearchMVSchema) for model in data]
-        return SimpleSearchResult(q=keyword, videos=models)
+    models = provider.searcher.search(keyword, type_, limit=kwargs.get("limit", 20))
+    return SimpleSearchResult(q=keyword, **{SEARCH_TYPES[type_][2]: models})
 
 
 provider = QQProvider()
@@ -602,4 +976,5 @@ from .schemas import (  # noqa
     SearchArtistSchema,
     SearchPlaylistSchema,
     SearchMVSchema,
+    deserialize,
 )  # noqa
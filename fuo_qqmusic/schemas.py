@@ -13,6 +13,8 @@ from feeluown.library import (
     VideoModel,
 )
 
+from .identity import identity_map
+
 logger = logging.getLogger(__name__)
 
 
@@ -39,6 +41,9 @@ def create_model(model_cls, data, fields_to_cache=None):
     """
     maybe this function should be provided by feeluown
 
+    歌曲以及歌曲中的歌手、专辑，同一个 (model_cls, identifier) 总是返回同一个对象，
+    见 :mod:`fuo_qqmusic.identity`。
+
     :param fields_to_cache: list of fields name to be cached
     """
     if fields_to_cache is not None:
@@ -47,11 +52,11 @@ def create_model(model_cls, data, fields_to_cache=None):
             value = data.pop(field)
             if value is not None:
                 cache_data[field] = value
-        model = model_cls(**data)
+        model = identity_map.get_or_create(model_cls, data)
         for field, value in cache_data.items():
             model.cache_set(field, value)
     else:
-        model = model_cls(**data)
+        model = identity_map.get_or_create(model_cls, data)
     return model
 
 
@@ -74,7 +79,7 @@ class _SongArtistSchema(Schema):
 
     @post_load
     def create_model(self, data, **kwargs):
-        return BriefArtistModel(**data)
+        return create_model(BriefArtistModel, data)
 
 
 class _SongAlbumSchema(Schema):
@@ -83,7 +88,7 @@ class _SongAlbumSchema(Schema):
 
     @post_load
     def create_model(self, data, **kwargs):
-        return BriefAlbumModel(**data)
+        return create_model(BriefAlbumModel, data)
 
 
 class QQSongSchema(Schema):
@@ -99,34 +104,38 @@ class QQSongSchema(Schema):
 
     @post_load
     def create_model(self, data, **kwargs):
-        song = SongModel(
-            identifier=data["identifier"],
-            source=SOURCE,
-            duration=data["duration"] * 1000,
-            title=data["title"],
-            artists=data.get("artists", []),
-            album=data["album"],
-        )
-        # FIXME: mid,media_id,mv_id 这几个字段应该合并成一个字段。
-        # 因为它们都是不变的，并且可以在同一个请求中拿到。
-        song.cache_set("mid", data["mid"])
-        song.cache_set("media_id", data["files"]["media_mid"])
-        song.cache_set("mv_id", data["mv"].get("vid", 0))
-        # 记录有哪些资源文件, 没有权限的用户依然获取不到
-        quality_suffix = []
-        files = data["files"]
-        if files.get("size_flac"):  # has key and value is not empty
-            quality_suffix.append(("shq", "F000", 800, "flac"))
-        elif files.get("size_ape"):
-            quality_suffix.append(("shq", "A000", 800, "ape"))
-        if files.get("size_320") or files.get("size_320mp3"):
-            quality_suffix.append(("hq", "M800", 320, "ape"))
-        if files.get("size_aac") or files.get("size_192aac"):
-            quality_suffix.append(("sq", "C600", 192, "m4a"))
-        if files.get("size_128") or files.get("size_128mp3"):
-            quality_suffix.append(("lq", "M500", 128, "mp3"))
-        song.cache_set("quality_suffix", quality_suffix)
-        return song
+        return _create_song(data)
+
+
+def _create_song(data):
+    song = create_model(SongModel, dict(
+        identifier=data["identifier"],
+        source=SOURCE,
+        duration=data["duration"] * 1000,
+        title=data["title"],
+        artists=data.get("artists", []),
+        album=data["album"],
+    ))
+    # FIXME: mid,media_id,mv_id 这几个字段应该合并成一个字段。
+    # 因为它们都是不变的，并且可以在同一个请求中拿到。
+    song.cache_set("mid", data["mid"])
+    song.cache_set("media_id", data["files"]["media_mid"])
+    song.cache_set("mv_id", data["mv"].get("vid", 0))
+    # 记录有哪些资源文件, 没有权限的用户依然获取不到
+    quality_suffix = []
+    files = data["files"]
+    if files.get("size_flac"):  # has key and value is not empty
+        quality_suffix.append(("shq", "F000", 800, "flac"))
+    elif files.get("size_ape"):
+        quality_suffix.append(("shq", "A000", 800, "ape"))
+    if files.get("size_320") or files.get("size_320mp3"):
+        quality_suffix.append(("hq", "M800", 320, "ape"))
+    if files.get("size_aac") or files.get("size_192aac"):
+        quality_suffix.append(("sq", "C600", 192, "m4a"))
+    if files.get("size_128") or files.get("size_128mp3"):
+        quality_suffix.append(("lq", "M500", 128, "mp3"))
+    song.cache_set("quality_suffix", quality_suffix)
+    return song
 
 
 class _ArtistSongSchema(Schema):
@@ -246,31 +255,35 @@ class QQAlbumSchema(Schema):
 
     @post_load
     def create_model(self, data, **kwargs):
-        singer_name = data["artist_info"]["Fsinger_name"]
-        artist = BriefArtistModel(
-            identifier=data["artist_info"]["Fsinger_id"],
-            source=SOURCE,
-            # split('/')：有的专辑有个多歌手，只有第一个才是正确的专辑艺人
-            # split('(')：有的非中文歌手拥有别名在括号里
-            name=singer_name.split("/")[0].split("(")[0].strip(),
-        )
-        # 非中文专辑会把专辑的中文翻译加进去, 为保持前后一致此外去掉括号里的中文翻译
-        if data["songs"]:
-            album_name = data["songs"][0].album.name
-        else:
-            album_name = data["album_info"]["Falbum_name"]
-        mid = data["album_info"]["Falbum_mid"]
-        album = AlbumModel(
-            identifier=data["album_info"]["Falbum_id"],
-            source=SOURCE,
-            name=album_name,
-            description=data["album_desc"]["Falbum_desc"],
-            songs=data["songs"] or [],
-            artists=[artist],
-            cover=get_cover(mid, 2)
-        )
-        album.cache_set("mid", mid)
-        return album
+        return _create_album(data)
+
+
+def _create_album(data):
+    singer_name = data["artist_info"]["Fsinger_name"]
+    artist = create_model(BriefArtistModel, dict(
+        identifier=data["artist_info"]["Fsinger_id"],
+        source=SOURCE,
+        # split('/')：有的专辑有个多歌手，只有第一个才是正确的专辑艺人
+        # split('(')：有的非中文歌手拥有别名在括号里
+        name=singer_name.split("/")[0].split("(")[0].strip(),
+    ))
+    # 非中文专辑会把专辑的中文翻译加进去, 为保持前后一致此外去掉括号里的中文翻译
+    if data["songs"]:
+        album_name = data["songs"][0].album.name
+    else:
+        album_name = data["album_info"]["Falbum_name"]
+    mid = data["album_info"]["Falbum_mid"]
+    album = create_model(AlbumModel, dict(
+        identifier=data["album_info"]["Falbum_id"],
+        source=SOURCE,
+        name=album_name,
+        description=data["album_desc"]["Falbum_desc"],
+        songs=data["songs"] or [],
+        artists=[artist],
+        cover=get_cover(mid, 2)
+    ))
+    album.cache_set("mid", mid)
+    return album
 
 
 class QQPlaylistSchema(Schema):
@@ -360,3 +373,178 @@ class SearchMVSchema(Schema):
     @post_load
     def create_model(self, data, **kwargs):
         return create_model(VideoModel, data)
+
+
+# 以下是几个高频 schema 的快速反序列化函数。
+#
+# marshmallow 的字段校验和嵌套 schema 开销很大，加载一个歌单时，大部分时间都花在这里。
+# 这些函数直接从接口数据中取出字段，构造和 schema 完全相同的 model。
+# 数据格式不符合预期时，回退到 marshmallow，由它给出详细的错误信息。
+
+def _load_song_artist(data):
+    return create_model(BriefArtistModel, {
+        "identifier": int(data["id"]), "name": data["name"], "source": SOURCE})
+
+
+def _load_song_album(data):
+    return create_model(BriefAlbumModel, {
+        "identifier": int(data["id"]), "name": data["name"], "source": SOURCE})
+
+
+def _load_song(data):
+    loaded = {
+        "identifier": int(data["id"]),
+        "mid": data["mid"],
+        "duration": float(data["interval"]),
+        "title": data["title"],
+        "album": _load_song_album(data["album"]),
+        "files": data.get("file", {}),
+        "mv": data["mv"],
+    }
+    if "singer" in data:
+        loaded["artists"] = [_load_song_artist(each) for each in data["singer"]]
+    return _create_song(loaded)
+
+
+def _load_artist_song(data):
+    return _load_song(data["songInfo"])
+
+
+def _load_brief_album(data):
+    return create_model(BriefAlbumModel, {
+        "identifier": int(data["albumID"]),
+        "mid": data["albumMID"],
+        "name": data["albumName"],
+        "source": SOURCE,
+    }, ["mid"])
+
+
+def _load_album(data):
+    songs = data.get("getSongInfo")
+    return _create_album({
+        "album_info": data["getAlbumInfo"],
+        "album_desc": data["getAlbumDesc"],
+        "artist_info": data["getSingerInfo"],
+        "songs": None if songs is None else [_load_song(each) for each in songs],
+    })
+
+
+def _load_playlist(data):
+    loaded = {
+        "identifier": int(data["disstid"]),
+        "name": data["dissname"],
+        "cover": data["logo"],
+        "source": SOURCE,
+        "description": "",
+    }
+    fields_to_cache = []
+    if "songlist" in data:
+        songs = data["songlist"]
+        loaded["songs"] = None if songs is None else [_load_song(each) for each in songs]
+        if songs is not None:
+            fields_to_cache = ["songs"]
+    return create_model(PlaylistModel, loaded, fields_to_cache)
+
+
+def _load_search_artist(data):
+    return create_model(ArtistModel, {
+        "identifier": int(data["singerID"]),
+        "mid": data["singerMID"],
+        "name": data["singerName"],
+        "pic_url": data["singerPic"],
+        "source": SOURCE,
+        "hot_songs": [],
+        "description": "",
+        "aliases": [],
+    }, ["mid"])
+
+
+def _load_search_album(data):
+    return create_model(AlbumModel, {
+        "identifier": int(data["albumID"]),
+        "mid": data["albumMID"],
+        "name": data["albumName"],
+        "cover": data["albumPic"],
+        "released": data["publicTime"],
+        "song_count": int(data["song_count"]),
+        "artists": [_load_song_artist(each) for each in data["singer_list"]],
+        "source": SOURCE,
+        "description": "",
+        "songs": [],
+    }, ["mid"])
+
+
+def _load_search_playlist(data):
+    creator = data["creator"]
+    return create_model(PlaylistModel, {
+        "identifier": int(data["dissid"]),
+        "name": data["dissname"],
+        "cover": data["imgurl"],
+        "creator": create_model(UserModel, {
+            "identifier": creator["creator_uin"],
+            "mid": creator["encrypt_uin"],
+            "name": creator["name"],
+            "avatar_url": creator["avatarUrl"],
+            "source": SOURCE,
+        }, ["mid"]),
+        "description": data["introduction"],
+        "play_count": int(data["listennum"]),
+        "source": SOURCE,
+    })
+
+
+def _load_search_mv(data):
+    return create_model(VideoModel, {
+        "identifier": data["v_id"],
+        "title": data["mv_name"],
+        "artists": [_load_song_artist(each) for each in data["singer_list"]],
+        "duration": int(data["duration"]),
+        "cover": data["mv_pic_url"],
+        "play_count": int(data["play_count"]),
+        "source": SOURCE,
+    })
+
+
+_FAST_LOADERS = {
+    QQSongSchema: _load_song,
+    _ArtistSongSchema: _load_artist_song,
+    _BriefAlbumSchema: _load_brief_album,
+    QQAlbumSchema: _load_album,
+    QQPlaylistSchema: _load_playlist,
+    SearchArtistSchema: _load_search_artist,
+    SearchAlbumSchema: _load_search_album,
+    SearchPlaylistSchema: _load_search_playlist,
+    SearchMVSchema: _load_search_mv,
+}
+
+# fast: 有快速反序列化函数的 schema 使用它；strict: 总是使用 marshmallow 做完整的校验
+DESERIALIZE_MODES = ('fast', 'strict')
+_deserialize_mode = 'fast'
+_schemas = {}
+
+
+def set_deserialize_mode(mode):
+    global _deserialize_mode
+    if mode not in DESERIALIZE_MODES:
+        raise ValueError(f'invalid deserialize mode: {mode}')
+    _deserialize_mode = mode
+
+
+def get_deserialize_mode():
+    return _deserialize_mode
+
+
+def deserialize(data, schema_cls):
+    if _deserialize_mode == 'fast':
+        loader = _FAST_LOADERS.get(schema_cls)
+        if loader is not None:
+            try:
+                return loader(data)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                logger.debug(f'fast deserialize failed, '
+                             f'fallback to {schema_cls.__name__}')
+    # schema 对象是无状态的，可以复用
+    schema = _schemas.get(schema_cls)
+    if schema is None:
+        schema = _schemas[schema_cls] = schema_cls()
+    return schema.load(data)
@@ -0,0 +1,390 @@
+"""
+搜索
+
+QQ 音乐的搜索接口一次只能搜一种类型，但是多种类型的搜索可以放在同一个
+musicu.fcg 请求中。feeluown 的全局搜索会在几个线程中同时搜索歌曲、歌手、
+专辑等，SearchEngine 把同一个关键词在一个很短的时间窗口内的搜索合并成一个请求，
+这样整个搜索页面只需要一次请求。后面的页由 reader 在需要的时候再请求。
+
+搜索结果按照（规范化之后的关键词，类型，页）缓存一段时间。LiveSearch 用于边输入边搜索：
+它合并连续的输入，丢弃过时的搜索，并用前缀关键词的缓存结果立即显示临时结果。
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from feeluown.library import SearchType
+from feeluown.utils.reader import SequentialReader
+
+from .api import SEARCH_MAX_PAGE_SIZE
+from .excs import QQIOError
+from .schemas import (
+    deserialize,
+    QQSongSchema,
+    SearchAlbumSchema,
+    SearchArtistSchema,
+    SearchMVSchema,
+    SearchPlaylistSchema,
+)
+
+logger = logging.getLogger(__name__)
+
+# SearchType -> (API.search 的 type_, schema, SimpleSearchResult 的字段)
+SEARCH_TYPES = {
+    SearchType.so: (0, QQSongSchema, 'songs'),
+    SearchType.ar: (1, SearchArtistSchema, 'artists'),
+    SearchType.al: (2, SearchAlbumSchema, 'albums'),
+    SearchType.pl: (3, SearchPlaylistSchema, 'playlists'),
+    SearchType.vi: (4, SearchMVSchema, 'videos'),
+}
+
+
+def normalize_keyword(keyword):
+    """大小写和多余的空格不影响搜索结果
+
+    只用于缓存和合并搜索的 key，发送给服务端的依然是原始的关键词。
+    """
+    return ' '.join(keyword.split()).casefold()
+
+
+class SearchCache:
+    """
+    :param ttl: 单位是秒
+    :param max_entries: 超过之后按照 LRU 淘汰
+    """
+
+    def __init__(self, ttl=300, max_entries=256):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        # (keyword, SearchType, page_size, page) -> (models, expired_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, models):
+        with self._lock:
+            self._entries[key] = (models, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def longest_prefix(self, keyword, type_, page_size):
+        """
+        :return: 关键词是 keyword 的前缀、并且最长的第一页结果，没有时返回 None
+        """
+        now = time.monotonic()
+        best, best_len = None, 0
+        with self._lock:
+            for (kw, t, size, page), (models, expired_at) in self._entries.items():
+                if t == type_ and size == page_size and page == 1 \
+                        and expired_at >= now and len(kw) > best_len \
+                        and keyword.startswith(kw):
+                    best, best_len = models, len(kw)
+        return best
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SearchEngine:
+    """
+    :param window: 单位是秒。第一个搜索最多等待这么久，收集同一个关键词的其它类型。
+        所有类型都到齐时不再等待
+    """
+
+    def __init__(self, api, window=0.02, cache_ttl=300):
+        self._api = api
+        self._window = window
+        self._cond = threading.Condition()
+        # (规范化之后的 keyword, page_size) -> {SearchType: Future}，正在收集的第一页搜索
+        self._groups = {}
+        self.cache = SearchCache(ttl=cache_ttl)
+        # 实际发送的请求数
+        self.requests = 0
+
+    def search(self, keyword, type_, limit=20):
+        """搜索一种类型，返回最多 limit 个 model
+
+        同时发起的、关键词相同的其它类型的搜索会和它合并成一个请求。
+        """
+        page_size = min(limit, SEARCH_MAX_PAGE_SIZE)
+        first_page = self.cache.get((normalize_keyword(keyword), type_, page_size, 1))
+        if first_page is None:
+            first_page = self._search_coalesced(keyword, type_, page_size)
+        if limit <= page_size:
+            return _dedupe(first_page)[:limit]
+        reader = self.create_reader(keyword, type_, page_size=page_size,
+                                    limit=limit, first_page=first_page)
+        return reader.read_range(0, limit)
+
+    def search_many(self, keyword, types, limit=20, page=1):
+        """在一个请求中搜索多种类型，已经缓存的类型不会被请求
+
+        :return: {SearchType: [model]}，失败的类型不在结果中
+        """
+        key_keyword = normalize_keyword(keyword)
+        page_size = min(limit, SEARCH_MAX_PAGE_SIZE)
+        result, missing = {}, []
+        for type_ in types:
+            models = self.cache.get((key_keyword, type_, page_size, page))
+            if models is None:
+                missing.append(type_)
+            else:
+                result[type_] = models
+        if not missing:
+            return result
+        with self._cond:
+            self.requests += 1
+        data = self._api.search_multi(keyword,
+                                      [SEARCH_TYPES[type_][0] for type_ in missing],
+                                      limit=page_size, page=page)
+        for type_ in missing:
+            qq_type, schema, _ = SEARCH_TYPES[type_]
+            if qq_type in data:
+                models = [deserialize(item, schema) for item in data[qq_type]]
+                self.cache.set((key_keyword, type_, page_size, page), models)
+                result[type_] = models
+        return result
+
+    def provisional(self, keyword, types, limit=20):
+        """用缓存中前缀关键词的结果，立即给出临时的搜索结果
+
+        比如输入“周杰伦”时，从“周杰”的结果中挑出包含“周杰伦”的。
+        关键词本身的结果已经缓存时，直接返回它。
+
+        :return: ({SearchType: [model]}, 是否是关键词本身的结果)
+        """
+        keyword = normalize_keyword(keyword)
+        page_size = min(limit, SEARCH_MAX_PAGE_SIZE)
+        exact = {type_: self.cache.get((keyword, type_, page_size, 1))
+                 for type_ in types}
+        if all(models is not None for models in exact.values()):
+            return exact, True
+        result = {}
+        for type_ in types:
+            models = self.cache.longest_prefix(keyword, type_, page_size)
+            if models:
+                result[type_] = [model for model in models
+                                 if keyword in _model_text(model)]
+        return result, False
+
+    def create_readers(self, keyword, types, page_size=20, limit=None):
+        """为每种类型创建一个 reader，所有类型的第一页在一个请求中获取
+
+        :return: {SearchType: SequentialReader}
+        """
+        page_size = min(page_size, SEARCH_MAX_PAGE_SIZE)
+        first_pages = self.search_many(keyword, types, limit=page_size)
+        return {type_: self.create_reader(keyword, type_, page_size, limit,
+                                          first_page=first_pages.get(type_, []))
+                for type_ in types}
+
+    def create_reader(self, keyword, type_, page_size=20, limit=None,
+                      first_page=None):
+        """按页读取搜索结果，在前面的页中出现过的结果会被去掉
+
+        :param limit: 最多读取的数量，None 表示直到没有更多结果
+        :param first_page: 已经获取到的第一页
+        """
+        page_size = min(page_size, SEARCH_MAX_PAGE_SIZE)
+
+        def g():
+            seen = set()
+            page, count, models = 1, 0, first_page
+            while True:
+                if models is None:
+                    models = self.search_many(keyword, [type_], page_size, page)\
+                        .get(type_)
+                    if models is None:
+                        raise QQIOError(f'search {keyword} page:{page} failed')
+                for model in models:
+                    if model.identifier in seen:
+                        continue
+                    seen.add(model.identifier)
+                    yield model
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+                # 不满一页说明没有更多结果了
+                if len(models) < page_size:
+                    return
+                page, models = page + 1, None
+
+        return SequentialReader(g(), None)
+
+    def _search_coalesced(self, keyword, type_, page_size):
+        key = (normalize_keyword(keyword), page_size)
+        with self._cond:
+            group = self._groups.get(key)
+            leader = group is None
+            if leader:
+                group = self._groups[key] = {}
+            future = group.get(type_)
+            if future is None:
+                future = group[type_] = Future()
+            self._cond.notify_all()
+        if leader:
+            with self._cond:
+                # 界面上的几种类型的搜索是在不同的线程中先后发起的，相差几毫秒，
+                # 所以第一个搜索总是等待一个窗口，除非所有类型都已经到齐
+                self._cond.wait_for(lambda: len(group) >= len(SEARCH_TYPES),
+                                    timeout=self._window)
+                self._groups.pop(key)
+            # 发送给服务端的是第一个搜索的原始关键词
+            self._fetch_group(keyword, page_size, group)
+        return future.result()
+
+    def _fetch_group(self, keyword, page_size, group):
+        if len(group) > 1:
+            logger.debug(f'search {keyword} {len(group)} types in one request')
+        try:
+            result = self.search_many(keyword, list(group), limit=page_size)
+        except Exception as e:  # noqa
+            for future in group.values():
+                future.set_exception(e)
+            return
+        for type_, future in group.items():
+            if type_ in result:
+                future.set_result(result[type_])
+            else:
+                future.set_exception(QQIOError(f'search {keyword} {type_} failed'))
+
+
+class LiveSearch:
+    """边输入边搜索
+
+    每次输入变化时调用 feed。如果有缓存的结果，callback 会被立即调用一次，
+    final 为 False 表示是前缀关键词的临时结果；停止输入 delay 秒之后才真正搜索。
+    同时最多只有一个搜索请求，正在等待或者已经发出的过时搜索，它们的结果会被丢弃。
+
+    callback(keyword, {SearchType: [model]}, final) 在 feed 的调用线程
+    或者后台线程中被调用。
+
+    :param delay: 单位是秒，连续输入的间隔小于它时，只搜索最后一个关键词
+    """
+
+    def __init__(self, engine, types, callback, delay=0.3, limit=20):
+        self._engine = engine
+        self._types = [SearchType.parse(type_) for type_ in types]
+        self._callback = callback
+        self._delay = delay
+        self._limit = limit
+        self._cond = threading.Condition()
+        self._generation = 0
+        # (generation, keyword, 开始搜索的时间)
+        self._pending = None
+        self._closed = False
+        self._thread = None
+        self.inputs = self.requests = 0
+        self.debounced = self.superseded = self.cache_hits = 0
+
+    def feed(self, keyword):
+        with self._cond:
+            self.inputs += 1
+            self._generation += 1
+            if self._pending is not None:
+                self.debounced += 1
+            self._pending = None
+            generation = self._generation
+        if not keyword.strip():
+            return
+        result, exact = self._engine.provisional(keyword, self._types, self._limit)
+        if exact:
+            with self._cond:
+                self.cache_hits += 1
+            self._callback(keyword, result, True)
+            return
+        if any(result.values()):
+            self._callback(keyword, result, False)
+        with self._cond:
+            if generation != self._generation:
+                return
+            self._pending = (generation, keyword, time.monotonic() + self._delay)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='qqmusic-live-search')
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._pending is None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._pending[2] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                generation, keyword, _ = self._pending
+                self._pending = None
+                self.requests += 1
+            try:
+                result = self._engine.search_many(keyword, self._types,
+                                                  limit=self._limit)
+            except Exception:  # noqa
+                logger.exception(f'search {keyword} failed')
+                continue
+            with self._cond:
+                if generation != self._generation:
+                    self.superseded += 1
+                    continue
+            self._callback(keyword, result, True)
+
+    def stats(self):
+        """
+        :return: saved 是和每次输入都搜索一次相比，节省的请求数
+        """
+        with self._cond:
+            return {
+                'inputs': self.inputs,
+                'requests': self.requests,
+                'saved': self.inputs - self.requests,
+                'debounced': self.debounced,
+                'superseded': self.superseded,
+                'cache_hits': self.cache_hits,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+
+def _model_text(model):
+    """用来匹配关键词的文本：名字，以及歌手和专辑的名字"""
+    parts = [getattr(model, 'title', None) or getattr(model, 'name', '')]
+    parts.extend(artist.name for artist in getattr(model, 'artists', None) or [])
+    album = getattr(model, 'album', None)
+    if album is not None:
+        parts.append(album.name)
+    return normalize_keyword(' '.join(parts))
+
+
+def _dedupe(models):
+    seen = set()
+    result = []
+    for model in models:
+        if model.identifier not in seen:
+            seen.add(model.identifier)
+            result.append(model)
+    return result
@@ -0,0 +1,161 @@
+"""
+歌曲、专辑、歌手元数据的本地存储
+
+把接口返回的原始数据（压缩后）存在一个 sqlite 数据库中，这样重启之后不需要重新请求。
+数据库只是一个缓存，数据不兼容（schema 版本变化）或者损坏时，直接重建即可。
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from . import codec
+
+logger = logging.getLogger(__name__)
+
+# 存储格式发生不兼容的变化时，增加这个值，旧的数据会被丢弃
+SCHEMA_VERSION = 1
+
+
+class MetadataStore:
+    """
+    :param path: 数据库文件路径
+    :param max_bytes: 压缩后数据的总大小上限，超过之后按照最近访问时间淘汰
+    :param max_age: 单位是秒，超过这个时间的数据被认为已经过期
+    """
+
+    # 读的时候会更新访问时间，为了减少写操作，间隔小于这个值时不更新
+    touch_interval = 600
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, max_age=7 * 24 * 3600):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = None
+        self._bytes = 0
+        # 打开数据库失败时，不再尝试，相当于没有本地存储
+        self._broken = False
+
+    def _get_conn(self):
+        if self._conn is None and not self._broken:
+            try:
+                self._conn = self._connect()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f'open metadata store failed: {e}')
+                self._broken = True
+        return self._conn
+
+    def _connect(self):
+        dirname = os.path.dirname(self._path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # 连接在多个线程（run_fn 的线程池）之间共享，由 self._lock 保护
+        conn = sqlite3.connect(self._path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            logger.info(f'metadata store schema version changed: '
+                        f'{version} -> {SCHEMA_VERSION}, rebuild it')
+            conn.execute('DROP TABLE IF EXISTS metadata')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS metadata (
+                type TEXT NOT NULL,
+                identifier TEXT NOT NULL,
+                mid TEXT,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (type, identifier)
+            )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_metadata_mid '
+                     'ON metadata (type, mid)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_metadata_accessed_at '
+                     'ON metadata (accessed_at)')
+        conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+        conn.commit()
+        self._bytes = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM metadata').fetchone()[0]
+        return conn
+
+    def get(self, type_, identifier):
+        return self._get('identifier', type_, str(identifier))
+
+    def get_by_mid(self, type_, mid):
+        return self._get('mid', type_, mid)
+
+    def _get(self, column, type_, value):
+        with self._lock:
+            conn = self._get_conn()
+            if conn is None:
+                return None
+            row = conn.execute(
+                f'SELECT identifier, data, created_at, accessed_at FROM metadata '
+                f'WHERE type=? AND {column}=?', (type_, value)).fetchone()
+            if row is None:
+                return None
+            identifier, blob, created_at, accessed_at = row
+            now = time.time()
+            if now - created_at > self._max_age:
+                return None
+            if now - accessed_at > self.touch_interval:
+                conn.execute('UPDATE metadata SET accessed_at=? '
+                             'WHERE type=? AND identifier=?',
+                             (now, type_, identifier))
+                conn.commit()
+        return codec.loads(zlib.decompress(blob))
+
+    def put(self, type_, identifier, data, mid=None):
+        blob = zlib.compress(codec.dumps(data).encode())
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            if conn is None:
+                return
+            row = conn.execute('SELECT size FROM metadata WHERE type=? AND identifier=?',
+                               (type_, str(identifier))).fetchone()
+            conn.execute('INSERT OR REPLACE INTO metadata '
+                         '(type, identifier, mid, data, size, created_at, accessed_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (type_, str(identifier), mid, blob, len(blob), now, now))
+            self._bytes += len(blob) - (row[0] if row else 0)
+            if self._bytes > self._max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        # 多淘汰一些，避免每次写入都触发淘汰
+        target = self._max_bytes * 0.9
+        while self._bytes > target:
+            rows = conn.execute('SELECT type, identifier, size FROM metadata '
+                                'ORDER BY accessed_at LIMIT 500').fetchall()
+            if not rows:
+                break
+            keys = []
+            for type_, identifier, size in rows:
+                if self._bytes <= target:
+                    break
+                keys.append((type_, identifier))
+                self._bytes -= size
+            conn.executemany('DELETE FROM metadata WHERE type=? AND identifier=?',
+                             keys)
+
+    def stats(self):
+        with self._lock:
+            conn = self._get_conn()
+            if conn is None:
+                return {}
+            count = conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+            return {'entries': count, 'bytes': self._bytes,
+                    'max_bytes': self._max_bytes}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
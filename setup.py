@@ -31,6 +31,10 @@ setup(
         'requests',
         'marshmallow>=3.0,<4.0.0'
     ],
+    extras_require={
+        'aio': ['aiohttp'],
+        'fast': ['orjson'],
+    },
     entry_points={
         'fuo.plugins_v1': [
             'qqmusic = fuo_qqmusic',
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+QQ 音乐接口的本地模拟服务器
+
+实现了 API 用到的 musicu.fcg（按照 module/method 分发，支持一个请求中包含多个 key）
+和 c.y.qq.com 上的几个 fcg 接口，数据来自 data/fixtures。可以配置延迟、
+HTTP 错误率和 code != 0 的响应比例，用来做压力测试和故障测试::
+
+    python tests/standin.py --port 8000 --latency 0.02,0.08 --error-rate 0.01
+
+然后用 API(base_url='http://127.0.0.1:8000') 把请求发给它。
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_fixture(name):
+    with open(os.path.join(ROOT, 'data/fixtures', name), encoding='utf-8') as f:
+        return json.load(f)
+
+
+TRACKS = read_fixture('cgi_get_track_info.json')['data']['tracks']
+ALBUM = read_fixture('album_3913679.json')
+DISS = read_fixture('get_diss_info.json')['req']['data']
+FEED = read_fixture('get_recommend_feed.json')['data']
+SEARCH_ARTISTS = read_fixture('search_artists.json')
+SEARCH_PLAYLISTS = read_fixture('search_playlists.json')
+LYRIC = base64.b64encode('[00:00.00]QQ 音乐模拟服务器\n'.encode()).decode()
+
+
+def track_for(song_id):
+    """任何 id 都有对应的歌曲，数据来自 fixture"""
+    song_id = int(song_id)
+    return dict(TRACKS[song_id % len(TRACKS)], id=song_id, mid=f'{song_id:014d}')
+
+
+# ---------- musicu.fcg 的 module/method ----------
+
+def search(param):
+    search_type = param.get('search_type', 0)
+    num = param.get('num_per_page', 20)
+    page = param.get('page_num', 1)
+    if search_type == 0:
+        key_ = 'song'
+        items = [track_for(page * 1000 + i) for i in range(num)]
+    elif search_type == 1:
+        key_, items = 'singer', SEARCH_ARTISTS
+    elif search_type == 3:
+        key_, items = 'songlist', SEARCH_PLAYLISTS
+    else:
+        key_, items = {2: 'album', 4: 'mv'}.get(search_type, 'song'), []
+    return {'body': {key_: {'list': items[:num]}}}
+
+
+def song_detail(param):
+    return {'track_info': track_for(param['song_id'])}
+
+
+def track_info(param):
+    return {'tracks': [track_for(song_id) for song_id in param['ids']]}
+
+
+def vkey(param):
+    midurlinfo = [{'songmid': mid, 'filename': filename,
+                   'purl': f'{filename}?vkey=standin&songmid={mid}'}
+                  for mid, filename in zip(param['songmid'], param['filename'])]
+    return {'midurlinfo': midurlinfo, 'expiration': 80400}
+
+
+def singer_songs(param):
+    total = 200
+    begin, num = param.get('begin', 0), param.get('num', 50)
+    songs = [{'songInfo': track_for(i)} for i in range(begin, min(begin + num, total))]
+    return {'singerMid': f'{param["singerid"]:014d}', 'totalNum': total,
+            'songList': songs}
+
+
+def singer_detail(param):
+    mid = param['singer_mids'][0]
+    return {'singer_list': [{
+        'basic_info': {'singer_id': int(mid), 'singer_mid': mid,
+                       'name': f'歌手 {int(mid)}'},
+        'ex_info': {'desc': ''},
+    }]}
+
+
+MUSICU_HANDLERS = {
+    ('music.search.SearchCgiService', 'DoSearchForQQMusicDesktop'): search,
+    ('music.pf_song_detail_svr', 'get_song_detail'): song_detail,
+    ('music.trackInfo.UniformRuleCtrl', 'CgiGetTrackInfo'): track_info,
+    ('vkey.GetVkeyServer', 'CgiGetVkey'): vkey,
+    ('music.musichallSong.SongListInter', 'GetSingerSongList'): singer_songs,
+    ('music.musichallSinger.SingerInfoInter', 'GetSingerDetail'): singer_detail,
+    ('recommend.RecommendFeedServer', 'get_recommend_feed'): lambda param: FEED,
+    ('music.musicasset.PlaylistDetailWrite', 'AddSonglist'): lambda param: {},
+    ('music.musicasset.PlaylistDetailWrite', 'DelSonglist'): lambda param: {},
+}
+
+
+# ---------- c.y.qq.com 的 fcg 接口 ----------
+
+def album_detail(query, server):
+    return {'code': 0, 'data': ALBUM}
+
+
+def playlist_detail(query, server):
+    pid = int(query['disstid'])
+    begin = int(query.get('song_begin', 0))
+    num = int(query.get('song_num', 50))
+    total = server.playlist_size
+    songs = [track_for(pid * 100000 + i) for i in range(begin, min(begin + num, total))]
+    return {'code': 0, 'cdlist': [{
+        'disstid': pid,
+        'dirid': pid % 1000,
+        'dissname': f'歌单 {pid}',
+        'logo': DISS['dirinfo']['picurl'],
+        'total_song_num': total,
+        'songnum': total,
+        'songlist': songs,
+    }]}
+
+
+def lyric(query, server):
+    return {'code': 0, 'lyric': LYRIC}
+
+
+def singer_albums(query, server):
+    return {'code': 0, 'data': {'total': 0, 'list': []}}
+
+
+FCG_HANDLERS = {
+    '/v8/fcg-bin/fcg_v8_album_detail_cp.fcg': album_detail,
+    '/qzone/fcg-bin/fcg_ucc_getcdinfo_byids_cp.fcg': playlist_detail,
+    '/lyric/fcgi-bin/fcg_query_lyric_new.fcg': lyric,
+    '/v8/fcg-bin/fcg_v8_singer_album.fcg': singer_albums,
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(b'')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._handle(self.rfile.read(length))
+
+    def _handle(self, body):
+        server = self.server.standin
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        server.stats[url.path] += 1
+        server.sleep()
+        if server.chance(server.error_rate):
+            server.stats['http_errors'] += 1
+            self._send(500, b'')
+            return
+        if url.path == '/cgi-bin/musicu.fcg':
+            payload = json.loads(body or query['data'])
+            js = server.handle_musicu(payload)
+        elif url.path in FCG_HANDLERS:
+            js = FCG_HANDLERS[url.path](query, server)
+        else:
+            self._send(404, b'')
+            return
+        if server.chance(server.code_error_rate):
+            server.stats['code_errors'] += 1
+            js = {'code': 500001}
+        self._send(200, json.dumps(js, ensure_ascii=False).encode('utf-8'))
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandinServer:
+    """
+    :param latency: 每个请求的延迟，单位是秒。可以是一个数字，
+        或者 (min, max)，表示在这个范围内均匀分布
+    :param error_rate: 返回 HTTP 500 的比例
+    :param code_error_rate: 返回 code != 0 的比例
+    :param playlist_size: 每个歌单中歌曲的数量
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 code_error_rate=0, playlist_size=1000, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.code_error_rate = code_error_rate
+        self.playlist_size = playlist_size
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.standin = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name='qqmusic-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def chance(self, rate):
+        if not rate:
+            return False
+        with self._random_lock:
+            return self._random.random() < rate
+
+    def sleep(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            with self._random_lock:
+                latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def handle_musicu(self, payload):
+        js = {'code': 0, 'ts': int(time.time() * 1000)}
+        for key, req in payload.items():
+            if key == 'comm':
+                continue
+            handler = MUSICU_HANDLERS.get((req.get('module'), req.get('method')))
+            if handler is None:
+                js[key] = {'code': 1000, 'data': {}}
+            else:
+                js[key] = {'code': 0, 'data': handler(req.get('param') or {})}
+        return js
+
+
+def parse_latency(value):
+    if ',' in value:
+        low, high = value.split(',')
+        return float(low), float(high)
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='QQ 音乐接口的本地模拟服务器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=parse_latency, default=0,
+                        help='单位是秒，比如 0.05 或者 0.02,0.08')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--code-error-rate', type=float, default=0)
+    parser.add_argument('--playlist-size', type=int, default=1000)
+    args = parser.parse_args()
+    server = StandinServer(args.host, args.port, latency=args.latency,
+                           error_rate=args.error_rate,
+                           code_error_rate=args.code_error_rate,
+                           playlist_size=args.playlist_size)
+    print(f'serving on {server.base_url}')
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,13 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import requests
 from fuo_qqmusic.api import API
+from fuo_qqmusic.policy import RequestPolicy
 import pytest
 
 
@@ -52,5 +61,448 @@ def test_api():
     print(api.remove_from_dislike_list(items, type_=API.DislikeListType.song))
 
 
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        body = json.dumps({'code': 0, 'data': {}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _JsonHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_api_session_reuses_connections(local_server):
+    api = API()
+    for _ in range(3):
+        api._session.get(local_server + '/x.fcg')
+    stats = api.connection_stats()
+    assert stats['opened'] == 1
+    assert stats['reused'] == 2
+    api.close()
+
+
+def test_api_session_does_not_keep_response_cookies():
+    received = []
+
+    class Handler(_JsonHandler):
+        def do_GET(self):
+            received.append(self.headers.get('Cookie'))
+            body = b'{"code": 0}'
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'qqmusic_key=secret; Path=/')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/x.fcg'
+    api = API()
+    try:
+        api.set_cookies({'uin': '10001'})
+        api._request('rpc', 'GET', url, cookies=api._cookies)
+        api.set_cookies(None)
+        api._request('rpc', 'GET', url, cookies=api._cookies)
+    finally:
+        api.close()
+        server.shutdown()
+        server.server_close()
+    assert received == ['uin=10001', None]
+
+
+def test_api_batch_merges_rpc_requests():
+    api = API()
+    sent = []
+
+    def send_rpc(payload, endpoint='rpc'):
+        sent.append(payload)
+        js = {'code': 0}
+        for key, value in payload.items():
+            if key != 'comm':
+                js[key] = {'code': 0, 'data': {'songInfoList': [value['param']]}}
+        return js
+
+    with patch.object(api, '_send_rpc', side_effect=send_rpc):
+        with api.batch() as batch:
+            f1 = batch.submit(api.song_similar, 1)
+            f2 = batch.submit(api.song_similar, 2)
+            f3 = batch.rpc({'req_0': {'module': 'm', 'method': 'x', 'param': 3}})
+    assert len(sent) == 1
+    assert f1.result() == [{'songid': 1}]
+    assert f2.result() == [{'songid': 2}]
+    assert f3.result()['req_0']['data'] == {'songInfoList': [3]}
+
+
+def test_api_batch_sends_write_alone():
+    api = API()
+    sent = []
+
+    def send_rpc(payload, endpoint='rpc'):
+        sent.append((endpoint, sorted(k for k in payload if k != 'comm')))
+        return {'code': 0, **{k: {'code': 0, 'data': {'songInfoList': []}}
+                              for k in payload if k != 'comm'}}
+
+    with patch.object(api, '_send_rpc', side_effect=send_rpc):
+        with api.batch() as batch:
+            batch.submit(api.song_similar, 1)
+            batch.submit(api.playlist_add_songs, 1, [2])
+    # 写接口使用它自己的策略，超时的时候不会被重试
+    assert sorted(sent) == [('playlist_add_songs', ['req_0']),
+                            ('song_similar', ['simsongs'])]
+    assert api.get_policy('playlist_add_songs').max_attempts() == 1
+
+
+def test_api_request_retries_idempotent_endpoint():
+    api = API(policies={
+        'read': RequestPolicy(retries=2, backoff=0),
+        'write': RequestPolicy(retries=2, backoff=0, idempotent=False),
+    })
+    error = requests.ConnectionError('reset')
+    with patch.object(api._session, 'request', side_effect=[error, error, 'ok']):
+        assert api._request('read', 'GET', 'http://x') == 'ok'
+    with patch.object(api._session, 'request', side_effect=[error, 'ok']) as mock:
+        with pytest.raises(requests.ConnectionError):
+            api._request('write', 'POST', 'http://x')
+    assert mock.call_count == 1
+
+
+def test_api_hedged_request_wins_over_stalled_request():
+    api = API(policies={'read': RequestPolicy(timeout=0.2, hedge=True)})
+    responses = iter([0.5, 0])
+
+    def request(*args, **kwargs):
+        time.sleep(next(responses))
+        return 'ok'
+
+    with patch.object(api._session, 'request', side_effect=request):
+        assert api._request('read', 'GET', 'http://x') == 'ok'
+    assert api.hedge_stats() == {'read': {'fired': 1, 'won': 1}}
+
+
+def test_api_hedge_skipped_when_executor_saturated():
+    api = API(pool_size=2, policies={'read': RequestPolicy(timeout=0.1, hedge=True)})
+
+    def request(*args, **kwargs):
+        time.sleep(0.15)
+        return 'ok'
+
+    with patch.object(api._session, 'request', side_effect=request):
+        threads = [threading.Thread(target=api._request, args=('read', 'GET', 'x'))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    # 线程池一直是满的，排队的时间不会触发对冲请求
+    assert api.hedge_stats() == {}
+    api.close()
+
+
+def test_api_cache_read_endpoint_and_invalidate_on_write():
+    api = API()
+    js = {'code': 0, 'cdlist': [{'dirid': 1}], 'req_0': {'code': 0}}
+    with patch.object(api, '_request') as mock_request, \
+            patch.object(api, '_send_rpc', return_value=js):
+        mock_request.return_value.content = json.dumps(js).encode()
+        assert api.playlist_detail(1) == {'dirid': 1}
+        assert api.playlist_detail('1', offset=0) == {'dirid': 1}
+        assert mock_request.call_count == 1
+        # 只清掉被修改的歌单的缓存
+        api.playlist_add_songs(5, [2])
+        api.playlist_detail(1)
+        assert mock_request.call_count == 1
+        api.playlist_add_songs(1, [2])
+        api.playlist_detail(1)
+        assert mock_request.call_count == 2
+    assert api.cache_stats()['hits'] == 2
+
+
+def test_api_cache_size_from_response_bytes():
+    api = API()
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content = b'{"code": 0, "data": {"name": "x"}}'
+    resp.request = requests.Request('GET', 'http://x').prepare()
+    with patch.object(api._session, 'request', return_value=resp), \
+            patch('fuo_qqmusic.cache._estimate_size') as mock_estimate:
+        assert api.album_detail(1) == {'name': 'x'}
+    assert not mock_estimate.called
+    assert api.cache_stats()['bytes'] == len(resp.content)
+
+
+def test_api_rpc_request_uses_post_for_large_payload():
+    api = API()
+    method, _, params, body = api._rpc_request({'req_0': {'ids': [1]}})
+    assert method == 'GET' and body is None and 'data' in params
+
+    ids = list(range(1000))
+    payload = api._batch_song_details_payload(ids)
+    method, _, params, body = api._rpc_request(payload)
+    assert method == 'POST' and 'data' not in params
+    assert json.loads(body)['req_0']['param']['ids'] == ids
+
+
+def test_api_song_url_requests():
+    api = API(cache_size=0)
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content = b'{"code": 500001}'
+    resp.request = requests.Request('GET', 'http://x').prepare()
+    with patch.object(api._session, 'request', return_value=resp) as mock:
+        assert api.get_song_url('0001') == {}
+        # 旧接口的请求格式不变：data 直接拼接在 URL 上，其它参数服务端要求必须有
+        method, url = mock.call_args[0]
+        params = mock.call_args[1]['params']
+        assert method == 'GET'
+        assert json.loads(url.split('?data=', 1)[1])['req_0']['param']['songmid'] == \
+            ['0001']
+        assert params['-'].startswith('getplaysongvkey')
+        assert params['g_tk'] == 5381 and params['platform'] == 'yqq.json'
+        assert 'loginUin' in params
+        # 顶层 code 不为 0 时，和以前一样返回空字符串
+        assert api.get_song_url_v2('0001', '0001', 'M500') == ''
+
+
+def test_api_song_urls_match_by_filename():
+    api = API()
+    items = [('0001', 'a', 'M500'), ('0001', 'a', 'M800'), ('0002', 'b', 'M500')]
+    # 服务端调整了顺序，并且少返回了一个
+    js = {'req_0': {'data': {'midurlinfo': [
+        {'songmid': '0002', 'filename': 'M500b.mp3', 'purl': 'b'},
+        {'songmid': '0001', 'filename': 'M500a.mp3', 'purl': 'a'},
+    ]}}}
+    urls, _ = api._parse_song_urls(js, items)
+    assert urls == ['http://isure.stream.qqmusic.qq.com/a', '',
+                    'http://isure.stream.qqmusic.qq.com/b']
+
+
+def test_async_api_rpc(local_server):
+    pytest.importorskip('aiohttp')
+    from fuo_qqmusic.aio_api import AsyncAPI
+
+    api = API()
+    aio_api = AsyncAPI(api)
+
+    async def rpc():
+        try:
+            return await aio_api.rpc({'req_0': {}})
+        finally:
+            await aio_api.close()
+
+    url = local_server + '/cgi-bin/musicu.fcg'
+    with patch.object(api, '_rpc_request', return_value=('GET', url, {}, None)):
+        js = asyncio.run(rpc())
+    assert js['code'] == 0
+
+
+def test_async_api_song_url_matches_sync_api_on_code_error():
+    pytest.importorskip('aiohttp')
+    from fuo_qqmusic.aio_api import AsyncAPI
+    from .standin import StandinServer
+
+    async def get_song_url():
+        try:
+            return await aio_api.get_song_url_v2('0001', 'M500m0001', 'M500')
+        finally:
+            await aio_api.close()
+
+    with StandinServer(code_error_rate=1) as server:
+        api = API(base_url=server.base_url)
+        aio_api = AsyncAPI(api)
+        assert api.get_song_url_v2('0001', 'M500m0001', 'M500') == ''
+        assert asyncio.run(get_song_url()) == ''
+        api.close()
+
+
+def test_async_api_song_urls_are_chunked():
+    pytest.importorskip('aiohttp')
+    from fuo_qqmusic.api import VKEY_CHUNK_SIZE, VKEY_CHUNKS_PER_RPC
+    from fuo_qqmusic.aio_api import AsyncAPI
+    from .standin import StandinServer
+
+    step = VKEY_CHUNK_SIZE * VKEY_CHUNKS_PER_RPC
+    items = [(f'{i:014d}', f'm{i}', 'M500') for i in range(step + 10)]
+
+    async def get_song_urls():
+        try:
+            return await aio_api.get_song_urls(items)
+        finally:
+            await aio_api.close()
+
+    with StandinServer() as server:
+        api = API(base_url=server.base_url)
+        aio_api = AsyncAPI(api)
+        urls = asyncio.run(get_song_urls())
+        assert server.stats['/cgi-bin/musicu.fcg'] == 2
+        assert urls == api.get_song_urls(items)
+        api.close()
+    assert all(f'songmid={mid}' in url for url, (mid, _, _) in zip(urls, items))
+
+
+def test_async_api_shares_cache_and_retries():
+    pytest.importorskip('aiohttp')
+    import socket
+    from fuo_qqmusic.aio_api import AsyncAPI
+    from .standin import StandinServer
+
+    async def run(coro):
+        try:
+            return await coro
+        finally:
+            await aio_api.close()
+
+    with StandinServer() as server:
+        api = API(base_url=server.base_url)
+        aio_api = AsyncAPI(api)
+        track = api.song_detail(1)
+        # 命中同步接口的缓存，不需要请求
+        assert asyncio.run(run(aio_api.song_detail(1))) == track
+        assert server.stats['/cgi-bin/musicu.fcg'] == 1
+        api.close()
+
+    # 没有服务在监听的端口，连接失败时按照 album_detail 的策略重试
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    api = API(base_url=f'http://127.0.0.1:{port}', policies={
+        'album_detail': RequestPolicy(timeout=1, retries=2, backoff=0)})
+    aio_api = AsyncAPI(api)
+    with pytest.raises(Exception):
+        asyncio.run(run(aio_api.album_detail(1)))
+    assert api.metrics_snapshot()['endpoints']['album_detail']['retries'] == 2
+    api.close()
+
+
+def test_api_base_url_points_to_standin_server():
+    from .standin import StandinServer
+
+    with StandinServer(playlist_size=120) as server:
+        api = API(base_url=server.base_url + '/')
+        assert api.playlist_detail(1, offset=100, limit=50)['total_song_num'] == 120
+        assert len(api.batch_song_details([1, 2, 3])) == 3
+        assert server.stats['/cgi-bin/musicu.fcg'] == 1
+        api.close()
+
+
+def test_api_metrics():
+    from .standin import StandinServer
+
+    with StandinServer() as server:
+        api = API(base_url=server.base_url)
+        api.album_detail(1)
+        api.album_detail(1)
+        api.batch_song_details([1, 2])
+        # 子请求失败时，顶层的 code 依然是 0
+        api.rpc({'req_0': {'module': 'x', 'method': 'y', 'param': {}}})
+        api.close()
+    snapshot = api.metrics_snapshot()
+    album = snapshot['endpoints']['album_detail']
+    assert album['requests'] == 1
+    assert album['bytes_in'] > 0
+    assert album['latency_buckets']['+Inf'] == 1
+    assert album['cache_hit_ratio'] == 0.5
+    assert snapshot['rpc']['x.y']['code_error_rate'] == 1
+    assert snapshot['rpc']['music.trackInfo.UniformRuleCtrl.CgiGetTrackInfo'] == {
+        'calls': 1, 'code_errors': 0, 'code_error_rate': 0}
+    text = api.metrics_prometheus()
+    assert 'qqmusic_request_duration_seconds_count{endpoint="album_detail"} 1' in text
+    assert 'qqmusic_rpc_code_errors_total{method="x.y"} 1' in text
+
+
+def test_api_capture_and_replay(tmp_path):
+    from .standin import StandinServer
+    from fuo_qqmusic.capture import ReplayMissError
+
+    path = str(tmp_path / 'capture.jsonl')
+    with StandinServer() as server:
+        api = API(base_url=server.base_url, cache_size=0)
+        api.set_cookies({'uin': '10001', 'qqmusic_key': 'secret-key'})
+        api.start_capture(path)
+        tracks = api.batch_song_details([1, 2])
+        urls, _ = api.get_song_urls_with_expiration([('0001', 'M500m0001', 'M500')])
+        lyric = api.get_lyric_by_songmid('0001')
+        api.stop_capture()
+        api.close()
+    with open(path, encoding='utf-8') as f:
+        content = f.read()
+    assert '10001' not in content and 'secret-key' not in content
+    assert 'vkey=standin' not in content
+
+    # 回放时不需要服务器，也不需要登录
+    replay_api = API(base_url=server.base_url, cache_size=0)
+    replay_api.start_replay(path, speed=0)
+    assert replay_api.batch_song_details([1, 2]) == tracks
+    assert replay_api.get_song_urls_with_expiration(
+        [('0001', 'M500m0001', 'M500')])[0] == [urls[0].replace('standin', '***')]
+    # 歌词请求带有时间戳参数 pcachetime，回放时的值和录制时不一样
+    with patch('time.time', return_value=time.time() + 60):
+        assert replay_api.get_lyric_by_songmid('0001') == lyric
+    with pytest.raises(ReplayMissError):
+        replay_api.batch_song_details([3])
+
+
+def test_capture_redacts_user_params():
+    from fuo_qqmusic.capture import redact_request
+
+    request = redact_request('GET', 'http://x/fcg_get_profile_homepage.fcg',
+                             {'params': {'cid': 205360838, 'userid': 10001,
+                                         'loginUin': '10001'}})
+    assert request['params'] == {'cid': 205360838, 'userid': 0, 'loginUin': '***'}
+
+
+def test_codec_loads_response_charset():
+    from fuo_qqmusic import codec
+
+    def response(content, content_type):
+        resp = requests.Response()
+        resp._content = content
+        resp.headers['Content-Type'] = content_type
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        return resp
+
+    js = {'name': '周杰伦'}
+    text = json.dumps(js, ensure_ascii=False)
+    assert codec.loads_response(
+        response(text.encode('gbk'), 'application/json; charset=GBK')) == js
+    # 没有声明编码时，不使用 requests 猜的 ISO-8859-1
+    assert codec.loads_response(response(text.encode(), 'text/html')) == js
+    assert codec.loads_response(
+        response(text.encode('utf-8-sig'), 'application/json')) == js
+
+
+def test_json_codecs_produce_same_rpc_request():
+    from fuo_qqmusic import codec
+
+    api = API()
+    payload = api._search_payload('周杰伦', 0, 30, 1)[0]
+    payload['comm'] = api.get_common_params()
+    data_strs = []
+    for name in codec.JSON_CODECS:
+        codec.set_json_codec(name)
+        try:
+            _, _, params, _ = api._rpc_request(payload)
+            data_strs.append(params['data'])
+            assert codec.loads(codec.dumps(payload).encode()) == payload
+        finally:
+            codec.set_json_codec('orjson' if 'orjson' in codec.JSON_CODECS else 'json')
+    # 签名是根据 data 字符串计算的，不同的实现必须得到相同的结果
+    assert len(set(data_strs)) == 1
+
+
 if __name__ == "__main__":
     test_api()
@@ -1,11 +1,22 @@
 import json
 import os
+import threading
+import time
+from concurrent.futures import wait
 from unittest.mock import patch
 
 import pytest
 
+from feeluown.library import BriefPlaylistModel, BriefSongModel, SearchType
+from feeluown.media import Quality
+
 from fuo_qqmusic import provider
 from fuo_qqmusic.api import API
+from fuo_qqmusic.media_cache import MediaUrlCache
+from fuo_qqmusic.search import SEARCH_TYPES
+from fuo_qqmusic.provider import (
+    _deserialize, _playlist_pages_executor, search, QQSongSchema)
+from fuo_qqmusic.store import MetadataStore
 
 
 def _read_json_fixture(path):
@@ -20,7 +31,441 @@ def album_3913679():
     return _read_json_fixture('album_3913679.json')
 
 
+@pytest.fixture
+def tracks():
+    return _read_json_fixture('cgi_get_track_info.json')['data']['tracks']
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path):
+    store = MetadataStore(str(tmp_path / 'metadata.sqlite3'))
+    provider._playlist_pages.clear()
+    with patch.object(provider, 'store', store):
+        yield store
+    store.close()
+
+
 def test_provider_album_get(album_3913679):
-    patch.object(API, 'album_detail', return_value=album_3913679)
-    album = provider.album_get('3913679')
+    with patch.object(API, 'album_detail', return_value=album_3913679):
+        album = provider.album_get('3913679')
     assert album.identifier == '3913679'
+
+
+def test_provider_async_gets_use_store(album_3913679, tracks, store):
+    import asyncio
+    pytest.importorskip('aiohttp')
+    from fuo_qqmusic.aio_api import AsyncAPI
+
+    async def get():
+        await provider.a_album_get('3913679')
+        await provider.a_song_get(tracks[0]['id'])
+        return (await provider.a_album_get('3913679'),
+                await provider.a_song_get(tracks[0]['id']))
+
+    with patch.object(AsyncAPI, 'album_detail', return_value=album_3913679) as album, \
+            patch.object(AsyncAPI, 'song_detail', return_value=tracks[0]) as song:
+        album_model, song_model = asyncio.run(get())
+    assert album.call_count == 1 and song.call_count == 1
+    assert album_model.identifier == '3913679'
+    assert song_model.identifier == str(tracks[0]['id'])
+    assert store.get('song', tracks[0]['id']) == tracks[0]
+
+
+def test_provider_album_get_from_store(album_3913679, store):
+    with patch.object(API, 'album_detail', return_value=album_3913679) as mock:
+        provider.album_get('3913679')
+        album = provider.album_get('3913679')
+    assert mock.call_count == 1
+    assert album.identifier == '3913679'
+    assert store.get_by_mid('album', album.cache_get('mid')[0]) == album_3913679
+
+
+def test_provider_songs_resolve_media(tracks):
+    songs = [_deserialize(track, QQSongSchema) for track in tracks]
+
+    def get_song_urls(items):
+        # only lq is playable
+        urls = [f'http://x/{t}' if t == 'M500' else '' for _, _, t in items]
+        return urls, 3600
+
+    with patch.object(API, 'get_song_urls_with_expiration',
+                      side_effect=get_song_urls) as mock:
+        provider.songs_resolve_media(songs)
+        provider.songs_resolve_media(songs)
+    assert mock.call_count == 1
+    for song in songs:
+        assert provider.song_list_quality(song) == [Quality.Audio.lq]
+
+
+def test_provider_songs_resolve_media_skips_songs_without_mid(tracks):
+    song = _deserialize(tracks[0], QQSongSchema)
+    broken = BriefSongModel(source='qqmusic', identifier='1', title='')
+    broken.cache_set('mid', None)
+    broken.cache_set('media_id', None)
+    broken.cache_set('quality_suffix', [('lq', 'M500', 128, 'mp3')])
+
+    def get_song_urls(items):
+        assert all(mid is not None for mid, _, _ in items)
+        return [f'http://x/{t}' for _, _, t in items], 3600
+
+    with patch.object(API, 'get_song_urls_with_expiration',
+                      side_effect=get_song_urls) as mock:
+        provider.songs_resolve_media([song, broken], force=True)
+        assert mock.call_count == 1
+        # 没有 mid 的歌曲不会被当成缓存命中
+        assert provider._song_media_cache_get(broken) is None
+
+
+def test_provider_songs_resolve_media_expiring(tracks):
+    songs = [_deserialize(track, QQSongSchema) for track in tracks]
+    for song in songs:
+        provider.media_cache.invalidate(song.cache_get('mid')[0])
+
+    def get_song_urls(items):
+        # 有效时间比 margin 还短，下次使用前需要重新获取
+        return [f'http://x/{t}' for _, _, t in items], 60
+
+    with patch.object(API, 'get_song_urls_with_expiration',
+                      side_effect=get_song_urls) as mock:
+        provider.songs_resolve_media(songs)
+        provider.songs_resolve_media(songs)
+        assert mock.call_count == 2
+        media = provider.song_get_media(songs[0], Quality.Audio.lq)
+    assert mock.call_count == 3
+    assert media.url == 'http://x/M500'
+
+
+def test_provider_songs_keep_media_fresh(tracks):
+    songs = [_deserialize(track, QQSongSchema) for track in tracks[:2]]
+    now = [1000.0]
+    cache = MediaUrlCache(refresh_func=provider._refresh_media, clock=lambda: now[0])
+
+    def get_song_urls(items):
+        return [f'http://x/{t}?t={now[0]}' for _, _, t in items], 3600
+
+    def wait_calls(mock, count, timeout=2):
+        deadline = time.monotonic() + timeout
+        while mock.call_count < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return mock.call_count
+
+    with patch.object(provider, 'media_cache', cache), \
+            patch.object(API, 'get_song_urls_with_expiration',
+                         side_effect=get_song_urls) as mock:
+        provider.songs_resolve_media(songs)
+        provider.songs_keep_media_fresh(songs)
+        # 链接还有很长的有效时间，不会刷新
+        assert wait_calls(mock, 2, timeout=0.2) == 1
+
+        # 快要失效时，后台刷新它们，播放时不需要再请求
+        now[0] += 3600 - 300
+        provider.songs_keep_media_fresh(songs)
+        assert wait_calls(mock, 2) == 2
+        media = provider.song_get_media(songs[0], Quality.Audio.lq)
+        assert media.url.endswith(f't={now[0]}')
+        assert mock.call_count == 2
+        cache.watch([])
+
+
+def test_media_cache_evicts_expiration_with_last_quality():
+    cache = MediaUrlCache(capacity=2)
+    cache.set_mapping('a', {Quality.Audio.lq: None, Quality.Audio.hq: None})
+    cache.set_mapping('b', {Quality.Audio.lq: None})
+    # a 的 hq 还在缓存中，依然需要知道它什么时候失效
+    assert 'a' in cache._mid_expired_at
+    cache.set_mapping('c', {Quality.Audio.lq: None})
+    assert 'a' not in cache._mid_expired_at
+
+
+def test_provider_songs_prefetch(tracks):
+    songs = [_deserialize(track, QQSongSchema) for track in tracks]
+    for song in songs:
+        provider.media_cache.invalidate(song.cache_get('mid')[0])
+
+    def get_song_urls(items):
+        return [f'http://x/{t}' for _, _, t in items], 3600
+
+    with patch.object(API, 'get_song_urls_with_expiration',
+                      side_effect=get_song_urls) as mock, \
+            patch.object(API, 'get_lyric_by_songmid', return_value='') as lyric:
+        provider.prefetcher.depth = 2
+        provider.songs_prefetch(songs)
+        wait(list(provider.prefetcher._futures.values()))
+        assert mock.call_count == 2
+        assert lyric.call_count == 2
+
+        hits = provider.prefetcher.hits
+        provider.song_get_media(songs[0], Quality.Audio.lq)
+        assert provider.prefetcher.hits == hits + 1
+        assert mock.call_count == 2
+
+
+def test_create_g_fetch_pages_concurrently():
+    from fuo_qqmusic.provider import create_g, _ArtistSongSchema
+
+    total, page_size = 230, 50
+    running = []
+    max_running = 0
+    lock = threading.Lock()
+
+    def artist_songs(artist_id, page=1):
+        nonlocal max_running
+        with lock:
+            running.append(page)
+            max_running = max(max_running, len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(page)
+        begin = (page - 1) * page_size
+        songs = list(range(begin, min(begin + page_size, total)))
+        return {'totalNum': total, 'songList': songs}
+
+    with patch('fuo_qqmusic.provider._deserialize', side_effect=lambda d, _: d):
+        reader = create_g(artist_songs, 1, _ArtistSongSchema)
+        assert reader.count == total
+        assert list(reader) == list(range(total))
+    assert max_running > 1
+
+
+def test_provider_artist_and_playlist_round_trips():
+    from .standin import StandinServer
+
+    with StandinServer(playlist_size=50) as server:
+        api = API(base_url=server.base_url)
+        with patch.object(provider, 'api', api), \
+                patch.object(provider._playlist_mutations, '_api', api):
+            artist = provider.artist_get('7')
+            songs = list(provider.artist_create_songs_rd(artist))
+            # 第一页和歌手详情各一个请求，剩下的三页合并成一个请求
+            assert server.stats['/cgi-bin/musicu.fcg'] == 3
+
+            playlist = provider.playlist_get('1001')
+            provider.playlist_create_songs_rd(playlist).read_range(0, 10)
+            provider.playlist_add_song(playlist, songs[0])
+        api.close()
+    assert artist.name == '歌手 7'
+    assert len(songs) == 200
+    # 修改歌单时，dirid 来自已经获取的第一页
+    assert server.stats['/qzone/fcg-bin/fcg_ucc_getcdinfo_byids_cp.fcg'] == 1
+    assert server.stats['/cgi-bin/musicu.fcg'] == 4
+
+
+def test_provider_playlist_songs_reader(tracks):
+    from fuo_qqmusic.provider import PLAYLIST_PAGE_SIZE
+
+    total = 250
+
+    def playlist_detail(pid, offset=0, limit=50):
+        songlist = []
+        for i in range(offset, min(offset + limit, total)):
+            track = dict(tracks[0])
+            track['id'] = i
+            songlist.append(track)
+        return {'disstid': pid, 'dissname': 'x', 'logo': '',
+                'total_song_num': total, 'songlist': songlist}
+
+    with patch.object(API, 'playlist_detail', side_effect=playlist_detail) as mock:
+        playlist = provider.playlist_get(1)
+        reader = provider.playlist_create_songs_rd(playlist)
+        assert reader.count == total
+        assert reader.read(0).identifier == '0'
+        # 第一页之后，只需要再获取第二页，第三页在后台预取
+        songs = reader.read_range(PLAYLIST_PAGE_SIZE + 10, PLAYLIST_PAGE_SIZE + 20)
+        assert [song.identifier for song in songs] == \
+            [str(i) for i in range(PLAYLIST_PAGE_SIZE + 10, PLAYLIST_PAGE_SIZE + 20)]
+        assert [song.identifier for song in reader.readall()] == \
+            [str(i) for i in range(total)]
+        offsets = sorted(call.kwargs.get('offset', 0) for call in mock.call_args_list)
+    assert offsets == [0, PLAYLIST_PAGE_SIZE, 2 * PLAYLIST_PAGE_SIZE]
+
+
+def test_provider_playlist_mutations_update_pages(tracks, store):
+    total = 250
+
+    def playlist_detail(pid, offset=0, limit=50):
+        songlist = []
+        for i in range(offset, min(offset + limit, total)):
+            track = dict(tracks[0])
+            track['id'] = i
+            songlist.append(track)
+        return {'disstid': pid, 'dirid': 3, 'dissname': 'x', 'logo': '',
+                'total_song_num': total, 'songlist': songlist}
+
+    song = _deserialize(tracks[1], QQSongSchema)
+    store.put('dirid', '1', 3)
+    with patch.object(API, 'playlist_detail', side_effect=playlist_detail) as detail, \
+            patch.object(API, 'playlist_add_songs', return_value=True), \
+            patch.object(API, 'playlist_remove_songs', return_value=True):
+        playlist = provider.playlist_get(1)
+        provider.playlist_create_songs_rd(playlist).read_range(0, 10)
+
+        provider.playlist_add_song(playlist, song)
+        reader = provider.playlist_create_songs_rd(provider.playlist_get(1))
+        assert reader.count == total + 1
+        assert reader.read(0) is song
+        assert reader.read(1).identifier == '0'
+
+        provider.playlist_remove_songs(playlist, [song, reader.read(1)])
+        reader = provider.playlist_create_songs_rd(provider.playlist_get(1))
+        assert reader.count == total - 1
+        assert reader.read(0).identifier == '1'
+        # 修改歌单之后，不需要重新获取整个歌单，最多重新获取位置变化的后面几页
+        offsets = [call.kwargs.get('offset', 0) for call in detail.call_args_list]
+        assert offsets.count(0) == 1
+
+
+def test_provider_playlist_readers_share_threads(tracks):
+    def playlist_detail(pid, offset=0, limit=50):
+        return {'disstid': pid, 'dissname': 'x', 'logo': '',
+                'total_song_num': 1000, 'songlist': [tracks[0]] * limit}
+
+    futures = []
+    submit = _playlist_pages_executor.submit
+
+    def record(*args):
+        futures.append(submit(*args))
+        return futures[-1]
+
+    readers = []  # 界面上打开的歌单
+    with patch.object(API, 'playlist_detail', side_effect=playlist_detail), \
+            patch.object(_playlist_pages_executor, 'submit', side_effect=record):
+        for pid in range(20):
+            playlist = BriefPlaylistModel(source='qqmusic', identifier=str(pid),
+                                          name='x')
+            readers.append(provider.playlist_create_songs_rd(playlist))
+            readers[-1].read_range(0, 10)
+        # 等后台的预取结束，避免它们在之后的测试中调用 playlist_detail
+        wait(futures)
+    threads = [t for t in threading.enumerate() if t.name.startswith('qqmusic-pages')]
+    assert len(threads) <= 4
+
+
+def test_provider_playlist_mutations_are_merged(tracks, store):
+    songs = [_deserialize(track, QQSongSchema) for track in tracks]
+    playlist = BriefPlaylistModel(source='qqmusic', identifier='100', name='x')
+    store.put('dirid', '100', 3)
+
+    with patch.object(API, 'playlist_add_songs', return_value=True) as add, \
+            patch.object(API, 'playlist_remove_songs', return_value=True) as remove, \
+            patch.object(API, 'playlist_detail') as detail:
+        threads = [threading.Thread(target=provider.playlist_add_song,
+                                    args=(playlist, song)) for song in songs]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.01)
+        # 在同一个窗口内又被删除的歌曲，只需要发送删除请求
+        provider.playlist_remove_song(playlist, songs[0])
+        for thread in threads:
+            thread.join()
+    assert detail.call_count == 0
+    assert add.call_count == 1
+    assert sorted(add.call_args[0][1]) == sorted(int(s.identifier) for s in songs[1:])
+    remove.assert_called_once_with(3, [int(songs[0].identifier)])
+
+
+def test_provider_recommendations_share_feed():
+    feed = _read_json_fixture('get_recommend_feed.json')['data']
+    provider.rec_feed.invalidate()
+
+    with patch.object(API, 'get_recommend_feed', return_value=feed) as mock, \
+            patch.object(API, 'batch_song_details', return_value=[]) as details:
+        playlists = provider.rec_list_daily_playlists()
+        collection = provider.rec_a_collection_of_songs()
+    assert mock.call_count == 1
+    assert len(playlists) == 12
+    assert collection.name
+    assert len(details.call_args[0][0]) > 0
+
+
+def test_provider_search_types_are_merged(tracks):
+    provider.searcher.cache.clear()
+    artists = _read_json_fixture('search_artists.json')
+    data = {0: tracks * 10, 1: artists, 2: [], 3: []}
+    with patch.object(API, 'search_multi', return_value=data) as mock:
+        # 和界面一样，每种类型在一个线程中搜索，先后相差几毫秒
+        threads = []
+        for type_ in (SearchType.so, SearchType.ar, SearchType.al, SearchType.pl):
+            threads.append(threading.Thread(target=search, args=('Jay  Chou',),
+                                            kwargs={'type_': type_, 'limit': 5}))
+            threads[-1].start()
+            time.sleep(0.003)
+        for thread in threads:
+            thread.join()
+        result = search('jay chou', type_=SearchType.so, limit=3)
+    assert mock.call_count == 2
+    # 发送给服务端的是原始的关键词
+    assert mock.call_args_list[0][0][0] == 'Jay  Chou'
+    assert sorted(mock.call_args_list[0][0][1]) == [0, 1, 2, 3]
+    assert mock.call_args_list[0][1]['limit'] == 5
+    # 重复的歌曲被去掉，并且结果不超过 limit
+    assert [song.identifier for song in result.songs] == \
+        [str(track['id']) for track in tracks][:3]
+
+
+def test_provider_search_stops_waiting_when_all_types_joined(tracks):
+    provider.searcher.cache.clear()
+    data = {0: tracks, 1: [], 2: [], 3: [], 4: []}
+    with patch.object(API, 'search_multi', return_value=data) as mock, \
+            patch.object(provider.searcher, '_window', 5):
+        start = time.monotonic()
+        threads = [threading.Thread(target=search, args=('x',),
+                                    kwargs={'type_': type_, 'limit': 5})
+                   for type_ in SEARCH_TYPES]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert time.monotonic() - start < 1
+    assert mock.call_count == 1
+
+
+def test_provider_search_reader_dedupes_pages(tracks):
+    provider.searcher.cache.clear()
+    songs = [dict(track, id=i, mid=str(i)) for i, track in enumerate(tracks * 10)]
+    artists = _read_json_fixture('search_artists.json')
+
+    def search_multi(keyword, types, limit, page):
+        # 第二页和第一页有重叠，第三页不满一页
+        start = (page - 1) * (limit - 5)
+        end = start + limit if page < 3 else start + 2
+        return {0: songs[start:end], 1: artists}
+
+    with patch.object(API, 'search_multi', side_effect=search_multi) as mock:
+        readers = provider.search_create_readers('x', ['so', 'ar'], page_size=20)
+        assert mock.call_count == 1
+        assert readers[SearchType.ar].read_range(0, 5)
+        result = list(readers[SearchType.so])
+    assert mock.call_count == 3
+    assert [song.identifier for song in result] == [str(i) for i in range(35)]
+
+
+def test_provider_live_search_debounces_and_reuses_prefix(tracks):
+    provider.searcher.cache.clear()
+    results = []
+    done = threading.Event()
+
+    def callback(keyword, result, final):
+        results.append((keyword, final, len(result[SearchType.so])))
+        if final:
+            done.set()
+
+    # 所有歌曲的名字中都包含 keyword
+    data = {0: [dict(track, title=f'晴天 {i}', id=i, mid=str(i))
+                for i, track in enumerate(tracks)]}
+    live = provider.search_create_live(['so'], callback, delay=0.05)
+    with patch.object(API, 'search_multi', return_value=data) as mock:
+        for keyword in ('晴', '晴天'):
+            live.feed(keyword)
+        assert done.wait(1)
+        done.clear()
+        # 前缀“晴天”的结果被立即用作临时结果
+        live.feed('晴天 2')
+        assert results[-1] == ('晴天 2', False, 1)
+        assert done.wait(1)
+        live.feed(' 晴天 ')  # 命中缓存，不需要请求
+    live.close()
+    assert mock.call_count == 2
+    assert results[0] == ('晴天', True, len(tracks))
+    assert results[-1] == (' 晴天 ', True, len(tracks))
+    assert live.stats() == {'inputs': 4, 'requests': 2, 'saved': 2, 'debounced': 1,
+                            'superseded': 0, 'cache_hits': 1}
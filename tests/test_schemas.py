@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+from marshmallow import ValidationError
+
+from fuo_qqmusic.identity import identity_map
+from fuo_qqmusic.schemas import (
+    deserialize,
+    set_deserialize_mode,
+    QQAlbumSchema,
+    QQSongSchema,
+    SearchArtistSchema,
+    SearchPlaylistSchema,
+)
+
+
+def _read_json_fixture(path):
+    path = os.path.join('data/fixtures', path)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('fixture, get_items, schema_cls', [
+    ('cgi_get_track_info.json', lambda js: js['data']['tracks'], QQSongSchema),
+    ('album_3913679.json', lambda js: [js], QQAlbumSchema),
+    ('search_artists.json', lambda js: js, SearchArtistSchema),
+    ('search_playlists.json', lambda js: js, SearchPlaylistSchema),
+])
+def test_fast_deserialize_is_identical_to_strict(fixture, get_items, schema_cls):
+    for item in get_items(_read_json_fixture(fixture)):
+        set_deserialize_mode('strict')
+        expected = deserialize(item, schema_cls)
+        identity_map.clear()
+        set_deserialize_mode('fast')
+        model = deserialize(item, schema_cls)
+        assert model is not expected
+        assert model.model_dump() == expected.model_dump()
+        # model 的缓存（mid/quality_suffix 等）也要相同
+        assert model.__pydantic_private__ == expected.__pydantic_private__
+
+
+def test_fast_deserialize_fallback_to_strict():
+    # 数据不完整时，由 marshmallow 给出详细的错误信息
+    with pytest.raises(ValidationError):
+        deserialize({'id': 1}, QQSongSchema)
+
+
+def test_lazy_model_list():
+    from fuo_qqmusic.lazy import LazyModelList
+
+    tracks = _read_json_fixture('cgi_get_track_info.json')['data']['tracks']
+    songs = LazyModelList(tracks, QQSongSchema, memo_size=2)
+    assert len(songs) == len(tracks)
+    assert not songs._memo
+    assert songs[0] is songs[0]
+    assert songs[-1].identifier == str(tracks[-1]['id'])
+    assert [song.identifier for song in songs[1:3]] == \
+        [str(track['id']) for track in tracks[1:3]]
+    assert len(songs._memo) == 2
+
+
+def test_identity_map():
+    tracks = _read_json_fixture('cgi_get_track_info.json')['data']['tracks']
+    song = deserialize(tracks[0], QQSongSchema)
+    song.cache_set('lyric', 'x')
+    same = deserialize(tracks[0], QQSongSchema)
+    assert same is song
+    assert same.cache_get('lyric') == ('x', True)
+    songs = [deserialize(track, QQSongSchema) for track in tracks]
+    artists = {id(artist) for song in songs for artist in song.artists}
+    assert len(artists) == len({artist.identifier
+                                for song in songs for artist in song.artists})
+    # 稀疏的数据不会覆盖已有的字段
+    sparse = dict(tracks[0], title='')
+    assert deserialize(sparse, QQSongSchema).title == song.title
+    # 详情 model 不会被合并
+    artist = {'singerID': 1, 'singerMID': 'x', 'singerName': 'y', 'singerPic': ''}
+    assert deserialize(artist, SearchArtistSchema) is not \
+        deserialize(artist, SearchArtistSchema)
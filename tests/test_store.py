@@ -0,0 +1,15 @@
+from fuo_qqmusic.store import MetadataStore
+
+
+def test_store_evict_least_recently_accessed(tmp_path):
+    store = MetadataStore(str(tmp_path / 'metadata.sqlite3'), max_bytes=2000)
+    store.touch_interval = 0
+    for i in range(100):
+        # random-ish data so that it can't be compressed too much
+        store.put('song', i, {'id': i, 'title': str(i ** 10)}, mid=f'mid{i}')
+        store.get('song', 0)
+    assert store.stats()['bytes'] <= 2000
+    assert store.get('song', 0) == {'id': 0, 'title': '0'}
+    assert store.get_by_mid('song', 'mid99')['id'] == 99
+    assert store.get('song', 1) is None
+    store.close()